@@ -1,7 +1,24 @@
 # Run Tests!
 
+# scripts import the modules of their sibling directories
+export PYTHONPATH=$(pwd)/scripts/cligen:$(pwd)/scripts/RT${PYTHONPATH:+:$PYTHONPATH}
+
 coverage run --source=scripts -m pytest \
     scripts/cligen/daily_clifile_editor.py \
+    scripts/cligen/clifile_index.py \
+    scripts/cligen/sparse_precip.py \
+    scripts/cligen/precip_archive.py \
+    scripts/cligen/clifile_locator.py \
+    scripts/cligen/clifile_store.py \
+    scripts/cligen/clifile_transform.py \
+    scripts/cligen/clifile_recipe.py \
+    scripts/cligen/verify_clifile.py \
+    scripts/cligen/add_new_year.py \
+    scripts/cligen/clifile_rfactor.py \
+    scripts/cligen/clifile_dirty.py \
     scripts/cligen/arb_precip_delta.py \
     scripts/RT/env2database.py \
+    scripts/RT/run_cache.py \
+    scripts/RT/runtime_history.py \
+    scripts/RT/wepp_jobs.py \
     scripts/import/flowpath_importer.py
@@ -9,6 +9,9 @@ fi
 # Remove any previous run's error files
 find /i/0/error -type f -exec rm {} \;
 
+# The RT scripts use the climate file modules of cligen
+export PYTHONPATH=$(pwd)/cligen${PYTHONPATH:+:$PYTHONPATH}
+
 cd cligen
 # usage of 1 day ago here is problematic during spring CST -> CDT
 python proctor_tile_edit.py 0 $(date --date '16 hours ago' +'%Y %m %d')
@@ -1,16 +1,39 @@
-"""Place jobs into our DEP queue!"""
+"""Place jobs into our DEP queue!
+
+Usage:
+    python enqueue_jobs.py <scenario> [dirty <YYYY-mm-dd> [<YYYY-mm-dd>]]
+
+With `dirty`, only flowpaths are run whose climate file materially changed
+over the inclusive dates, per the daily editor's manifests, or whose
+management, slope or soil file changed since their last run.
+
+Batches are enqueued longest first, by the wall time the workers recorded
+for each flowpath or a model of it.  Set `max_priority` in rabbitmq.json
+to also use a RabbitMQ priority queue, which needs the `dep` queue to be
+recreated.
+
+The climate file modules of scripts/cligen must be on the PYTHONPATH.
+"""
 import json
 import sys
 import os
 import datetime
 import time
-from io import StringIO
 
 import pika
 import requests
 from pyiem.util import get_dbconn, logger
-
-YEARS = datetime.date.today().year - 2006
+from clifile_dirty import read_dirty
+from clifile_recipe import CLIFN_RE, get_scenario_fn, load_recipe
+from runtime_history import load_history, predict
+from wepp_jobs import (
+    DESCRIPTOR_TYPE,
+    WeppRun,
+    encode_batch,
+    get_priority,
+    get_queue_arguments,
+    group_batches,
+)
 
 
 def get_rabbitmqconn():
@@ -30,131 +53,69 @@ def get_rabbitmqconn():
     )
 
 
-class WeppRun:
-    """Represents a single run of WEPP.
+def inputs_changed(wr):
+    """Have the non-climate inputs changed since the last successful run.
 
-    Filenames have a 51 character restriction.
+    A run without output or with a newer error file counts as changed.
     """
-
-    def __init__(self, huc12, fpid, clifile, scenario, ofe_count, is_irr):
-        """We initialize with a huc12 identifier and a flowpath id"""
-        self.huc12 = huc12
-        self.huc8 = huc12[:8]
-        self.subdir = f"{huc12[:8]}/{huc12[8:]}"
-        self.fpid = fpid
-        self.clifile = clifile
-        self.scenario = scenario
-        self.ofe_count = ofe_count
-        self.is_irr = is_irr
-
-    def _getfn(self, prefix):
-        """boilerplate code to get a filename."""
-        return (
-            f"/i/{self.scenario}/{prefix}/{self.subdir}/"
-            f"{self.huc12}_{self.fpid}.{prefix}"
-        )
-
-    def get_wb_fn(self):
-        """Return the water balance filename for this run"""
-        return self._getfn("wb")
-
-    def get_env_fn(self):
-        """Return the event filename for this run"""
-        return self._getfn("env")
-
-    def get_ofe_fn(self):
-        """Return the filename used for OFE output"""
-        return self._getfn("ofe")
-
-    def get_man_fn(self):
-        """Return the management filename for this run"""
-        return self._getfn("man")
-
-    def get_slope_fn(self):
-        """Return the slope filename for this run"""
-        return self._getfn("slp")
-
-    def get_soil_fn(self):
-        """Return the soil filename for this run"""
-        return self._getfn("sol")
-
-    def get_clifile_fn(self):
-        """Return the climate filename for this run"""
-        return self.clifile
-
-    def get_runfile_fn(self):
-        """Return the run filename for this run"""
-        return self._getfn("run")
-
-    def get_yield_fn(self):
-        """Filename to be used for yield output"""
-        return self._getfn("yld")
-
-    def get_event_fn(self):
-        """Filename to be used for event output"""
-        return self._getfn("event")
-
-    def get_crop_fn(self):
-        """Filename to be used for crop output."""
-        return self._getfn("crop")
-
-    def get_graphics_fn(self):
-        """Filename to be used for crop output."""
-        return self._getfn("grph")
-
-    def get_irrigation_fn(self):
-        """Filename providing irrigation data."""
-        return f"/i/{self.scenario}/irrigation/ofe{self.ofe_count}.txt"
-
-    def make_runfile(self):
-        """Create a runfile for our runs"""
-        out = StringIO()
-        out.write("E\n")  # English units
-        out.write("Yes\n")  # Run Hillslope
-        out.write("1\n")  # Continuous simulation
-        out.write("1\n")  # hillslope version
-        out.write("No\n")  # pass file output?
-        out.write("1\n")  # abbreviated annual output
-        out.write("No\n")  # initial conditions output
-        out.write("/dev/null\n")  # soil loss output file
-        out.write("Yes\n")  # Do water balance output
-        out.write(f"{self.get_wb_fn()}\n")  # water balance output file
-        out.write("No\n")  # crop output
-        # out.write("%s\n" % (self.get_crop_fn(),))  # crop output file
-        out.write("No\n")  # soil output
-        out.write("No\n")  # distance and sed output
-        if self.huc12 in ["090201081101", "090201081102", "090201060605"]:
-            out.write("Yes\n")  # large graphics output
-            out.write(f"{self.get_graphics_fn()}\n")
-        else:
-            out.write("No\n")  # large graphics output
-        out.write("Yes\n")  # event by event output
-        out.write(f"{self.get_env_fn()}\n")  # event file output
-        out.write("No\n")  # element output
-        # out.write("%s\n" % (self.get_ofe_fn(),))
-        out.write("No\n")  # final summary output
-        out.write("No\n")  # daily winter output
-        out.write("Yes\n")  # plant yield output
-        out.write(f"{self.get_yield_fn()}\n")  # yield file
-        out.write(f"{self.get_man_fn()}\n")  # management file
-        out.write(f"{self.get_slope_fn()}\n")  # slope file
-        out.write(f"{self.get_clifile_fn()}\n")  # climate file
-        out.write(f"{self.get_soil_fn()}\n")  # soil file
-        if self.is_irr:
-            out.write("2\n")  # Irrigation
-            out.write(f"{self.get_irrigation_fn()}\n")
-        else:
-            out.write("0\n")  # Irrigation
-        out.write(f"{YEARS}\n")  # years 2007-
-        out.write("0\n")  # route all events
-        out.seek(0)
-        return out.read()
+    try:
+        envtime = os.stat(wr.get_env_fn()).st_mtime
+    except FileNotFoundError:
+        return True
+    for fn in [
+        wr.get_error_fn(),
+        wr.get_man_fn(),
+        wr.get_slope_fn(),
+        wr.get_soil_fn(),
+    ]:
+        try:
+            if os.stat(fn).st_mtime > envtime:
+                return True
+        except FileNotFoundError:
+            continue
+    return False
+
+
+class DirtyFilter:
+    """Decide which runs are needed given the daily editor's manifests."""
+
+    def __init__(self, dates):
+        """Constructor.
+
+        Args:
+          dates (list): dates the climate files were edited for
+        """
+        self.dates = dates
+        self.dirty = {}  # climate scenario to set of climate files
+
+    def __call__(self, clfile, wr):
+        """Is this run needed."""
+        m = CLIFN_RE.match(clfile)
+        clscenario = m["scenario"] if m else None
+        if clscenario not in self.dirty:
+            self.dirty[clscenario] = (
+                set()
+                if m is None
+                else read_dirty(clscenario, self.dates, m["basedir"])
+            )
+        return clfile in self.dirty[clscenario] or inputs_changed(wr)
 
 
 def main(argv):
     """Go main Go."""
     scenario = int(argv[1])
     log = logger()
+    needed = None
+    if len(argv) > 2 and argv[2] == "dirty":
+        sts = datetime.date.fromisoformat(argv[3])
+        ets = datetime.date.fromisoformat(argv[4]) if len(argv) > 4 else sts
+        needed = DirtyFilter(
+            [
+                sts + datetime.timedelta(days=i)
+                for i in range((ets - sts).days + 1)
+            ]
+        )
+        log.warning("Only enqueueing runs changed from %s to %s", sts, ets)
     myhucs = []
     if os.path.isfile("myhucs.txt"):
         log.warning("Using myhucs.txt to filter job submission")
@@ -169,34 +130,89 @@ def main(argv):
         "where id = %s",
         (scenario,),
     )
-    flscenario, _clscenario = icursor.fetchone()
+    flscenario, clscenario = icursor.fetchone()
+    # The workers generate the climate files of a recipe on demand
+    recipe = load_recipe(clscenario)
+    if recipe is not None:
+        log.warning("Climate scenario %s is %s", clscenario, recipe)
 
     icursor.execute(
-        "SELECT huc_12, fpath, climate_file, ofe_count, irrigated "
-        "from flowpaths where scenario = %s",
+        "SELECT huc_12, fpath, climate_file, ofe_count, irrigated, "
+        "real_length from flowpaths where scenario = %s "
+        "ORDER by huc_12, fpath",
         (flscenario,),
     )
-    totaljobs = icursor.rowcount
-    connection = get_rabbitmqconn()
-    channel = connection.channel()
-    channel.queue_declare(queue="dep", durable=True)
-    sts = datetime.datetime.now()
+    rows = []
+    jobs = []
     for row in icursor:
         if myhucs and row[0] not in myhucs:
             continue
         clfile = row[2]
-        if scenario >= 142:
+        if recipe is not None:
+            clfile = get_scenario_fn(clfile, clscenario)
+        elif scenario >= 142:
             # le sigh
             clfile = clfile.replace("/0/", f"/{scenario}/")
         wr = WeppRun(row[0], row[1], clfile, scenario, row[3], row[4])
+        # manifests list the climate files that the editor changed
+        if needed is not None and not needed(row[2], wr):
+            continue
+        rows.append((row[0], row[1], row[3], row[5], row[4]))
+        jobs.append(wr)
+    # Longest batches first, so the last ones to finish are short
+    history = load_history(scenario)
+    seconds = predict(rows, history)
+    batches = sorted(
+        group_batches(
+            (wr.huc12, (wr.get_descriptor(), sec), sec)
+            for wr, sec in zip(jobs, seconds)
+        ),
+        key=lambda batch: sum(x[1] for x in batch),
+        reverse=True,
+    )
+    log.warning(
+        "Predicted %.1f hours of runs, %s with history",
+        seconds.sum() / 3600.0,
+        sum(1 for row in rows if row[:2] in history),
+    )
+    connection = get_rabbitmqconn()
+    channel = connection.channel()
+    arguments = get_queue_arguments()
+    channel.queue_declare(queue="dep", durable=True, arguments=arguments)
+    # The blocking channel waits for the broker to confirm each publish,
+    # one round trip per batch message rather than per run
+    channel.confirm_delivery()
+    sts = datetime.datetime.now()
+    totaljobs = 0
+    totalmsgs = 0
+    for rank, batch in enumerate(batches):
+        totaljobs += len(batch)
+        totalmsgs += 1
         channel.basic_publish(
             exchange="",
             routing_key="dep",
-            body=wr.make_runfile(),
+            body=encode_batch([x[0] for x in batch]),
             properties=pika.BasicProperties(
-                delivery_mode=2  # make message persistent
+                content_type=DESCRIPTOR_TYPE,
+                delivery_mode=2,  # make message persistent
+                priority=(
+                    None
+                    if arguments is None
+                    else get_priority(
+                        rank, len(batches), arguments["x-max-priority"]
+                    )
+                ),
             ),
         )
+    log.warning(
+        "Enqueued %s of %s runs in %s messages",
+        totaljobs,
+        icursor.rowcount,
+        totalmsgs,
+    )
+    if totaljobs == 0:
+        connection.close()
+        return
     # Wait a few seconds for the dust to settle
     time.sleep(10)
     connection.close()
@@ -211,8 +227,10 @@ def main(argv):
             auth=("guest", "guest"),
         )
         queueinfo = req.json()
-        # jobs either ready or unawked
-        jobsleft = queueinfo["messages_persistent"]
+        # batches either ready or unawked, scaled to runs
+        jobsleft = int(
+            queueinfo["messages_persistent"] / totalmsgs * totaljobs
+        )
         done = totaljobs - jobsleft
         if (jobsleft / float(totaljobs)) < percentile:
             log.warning(
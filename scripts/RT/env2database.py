@@ -6,7 +6,6 @@ also do any of the following:
     # See usage
     python env2database.py -h
 """
-import gzip
 import os
 import re
 import argparse
@@ -19,12 +18,15 @@ import pandas as pd
 from tqdm import tqdm
 import geopandas as gpd
 from affine import Affine
+from shapely.geometry import box
 from pyiem import dep as dep_utils
 from pyiem.grid.zs import CachingZonalStats
-from pyiem.util import get_dbconn, get_dbconnstr, logger
+from pyiem.iemre import daily_offset
+from pyiem.util import get_dbconn, get_dbconnstr, logger, ncopen
 
 LOG = logger()
-PRECIP_AFF = Affine(0.01, 0.0, dep_utils.WEST, 0.0, -0.01, dep_utils.NORTH)
+# Yearly archive written by cligen/proctor_tile_edit.py
+PRECIP_ARCHIVE = "/mnt/idep2/data/dailyprecip/%Y_precip.nc"
 CONFIG = {"subset": False}
 
 # Maximum precip value allowed, will alert otherwise, see dailyerosion/dep#65
@@ -117,6 +119,47 @@ def compute_res(df, date, slopes, qc_precip):
     )
 
 
+def compute_precip_window(geoms):
+    """Return the archive (yslice, xslice, affine) covering the geometries.
+
+    The archive grid has its first row at the southern edge, the affine is
+    for the window after being flipped north up.
+    """
+    (west, south, east, north) = geoms.total_bounds
+    ys = int((dep_utils.NORTH - dep_utils.SOUTH) * 100.0)
+    xs = int((dep_utils.EAST - dep_utils.WEST) * 100.0)
+    y0 = max(0, int((south - dep_utils.SOUTH) * 100.0) - 1)
+    y1 = min(ys, int((north - dep_utils.SOUTH) * 100.0) + 2)
+    x0 = max(0, int((west - dep_utils.WEST) * 100.0) - 1)
+    x1 = min(xs, int((east - dep_utils.WEST) * 100.0) + 2)
+    affine = Affine(
+        0.01,
+        0.0,
+        dep_utils.WEST + x0 * 0.01,
+        0.0,
+        -0.01,
+        dep_utils.SOUTH + y1 * 0.01,
+    )
+    return slice(y0, y1), slice(x0, x1), affine
+
+
+def read_precip(date, yslice, xslice):
+    """Read a window of the daily precip archive, north up.
+
+    Returns:
+      np.ndarray or None when the date has not been processed
+    """
+    fn = date.strftime(PRECIP_ARCHIVE)
+    if not os.path.isfile(fn):
+        return None
+    offset = daily_offset(date)
+    with ncopen(fn) as nc:
+        if np.ma.is_masked(nc.variables["processed"][offset]):
+            return None
+        pcp = nc.variables["precip"][offset, yslice, xslice]
+    return np.flipud(np.ma.filled(pcp, np.nan).astype(np.float64))
+
+
 def load_precip(dates, huc12s):
     """Compute the HUC12 spatially averaged precip
 
@@ -143,21 +186,21 @@ def load_precip(dates, huc12s):
     if CONFIG["subset"]:
         huc12df = huc12df.loc[huc12s]
 
-    czs = CachingZonalStats(PRECIP_AFF)
+    # Only read the part of the archive grid covering the HUC12s
+    yslice, xslice, affine = compute_precip_window(huc12df["geo"])
+    czs = CachingZonalStats(affine)
     # 2. Loop over dates
     res = {}
     progress = tqdm(dates, disable=(not sys.stdout.isatty()))
     for date in progress:
         progress.set_description(date.strftime("%Y-%m-%d"))
-        fn = date.strftime("/mnt/idep2/data/dailyprecip/%Y/%Y%m%d.npy.gz")
-        if not os.path.isfile(fn):
-            LOG.info("Missing precip: %s", fn)
+        pcp = read_precip(date, yslice, xslice)
+        if pcp is None:
+            LOG.info("Missing precip: %s", date.strftime(PRECIP_ARCHIVE))
             for huc12 in huc12df.index.values:
                 d = res.setdefault(huc12, [])
                 d.append(0)
             continue
-        with gzip.GzipFile(fn, "r") as fh:
-            pcp = np.flipud(np.load(file=fh))
         # nodata here represents the value that is set to missing within the
         # source dataset!, setting to zero has strange side affects
         pcp = np.where(pcp < 0, np.nan, pcp)
@@ -431,3 +474,23 @@ def test_all_dates():
     dates = determine_dates(args)
     assert len(dates) > 600  # arb
     assert dates[0] == pd.Timestamp("2007/01/01")
+
+
+def test_precip_window():
+    """Test that the whole domain window matches the full grid."""
+    geoms = gpd.GeoSeries(
+        [
+            box(
+                dep_utils.WEST,
+                dep_utils.SOUTH,
+                dep_utils.EAST,
+                dep_utils.NORTH,
+            )
+        ]
+    )
+    yslice, xslice, affine = compute_precip_window(geoms)
+    assert yslice.start == 0
+    assert xslice.start == 0
+    assert affine.almost_equals(
+        Affine(0.01, 0.0, dep_utils.WEST, 0.0, -0.01, dep_utils.NORTH)
+    )
@@ -8,12 +8,15 @@ import numpy as np
 import pandas as pd
 from tqdm import tqdm
 from pyiem import dep as dep_utils
-from pyiem.util import get_dbconn
+from pyiem.iemre import daily_offset
+from pyiem.util import get_dbconn, ncopen
 import geopandas as gpd
 from rasterstats import zonal_stats
 from affine import Affine
 
 PRECIP_AFF = Affine(0.01, 0.0, dep_utils.WEST, 0.0, -0.01, dep_utils.NORTH)
+# Yearly archive written by cligen/proctor_tile_edit.py
+PRECIP_ARCHIVE = "/mnt/idep2/data/dailyprecip/%Y_precip.nc"
 
 
 def find_huc12s():
@@ -120,13 +123,19 @@ def load_precip():
     myres = {}
     for mydate in tqdm(DATES, disable=(not sys.stdout.isatty())):
         myres[mydate] = {}
-        fn = mydate.strftime("/mnt/idep2/data/dailyprecip/%Y/%Y%m%d.npy")
-        if not os.path.isfile(fn):
-            print("Missing precip: %s" % (fn,))
+        fn = mydate.strftime(PRECIP_ARCHIVE)
+        pcp = None
+        if os.path.isfile(fn):
+            offset = daily_offset(mydate)
+            with ncopen(fn) as nc:
+                if not np.ma.is_masked(nc.variables["processed"][offset]):
+                    pcp = np.ma.filled(nc.variables["precip"][offset], np.nan)
+        if pcp is None:
+            print("Missing precip: %s %s" % (fn, mydate))
             for myhuc12 in huc12df.index.values:
                 myres[mydate][myhuc12] = 0
             continue
-        pcp = np.flipud(np.load(fn))
+        pcp = np.flipud(pcp.astype(np.float64))
         # nodata here represents the value that is set to missing within the
         # source dataset!, setting to zero has strange side affects
         zs = zonal_stats(
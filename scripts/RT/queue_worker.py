@@ -1,4 +1,8 @@
-"""We do work when jobs are placed in the queue."""
+"""We do work when jobs are placed in the queue.
+
+Climate scenarios defined by a recipe are generated with the cligen
+scripts, which must be on the PYTHONPATH.
+"""
 from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 import json
@@ -13,6 +17,10 @@ import traceback
 
 import pika
 from pyiem.util import logger
+from clifile_recipe import ClifileCache
+from run_cache import RunCache, get_salt
+from runtime_history import RuntimeRecorder
+from wepp_jobs import decode_message, get_queue_arguments
 
 LOG = logger()
 FILENAME_RE = re.compile(
@@ -21,8 +29,15 @@ FILENAME_RE = re.compile(
 )
 MEMORY = {
     "runs": 0,
+    "failures": 0,
     "timestamp": time.time(),
+    # Results of previous runs with identical inputs, opened by main
+    "results": None,
 }
+# Worker-local climate files of climate scenarios defined by a recipe
+CLIFILES = ClifileCache()
+# Wall time of the runs, so that enqueue_jobs.py can start long runs first
+RUNTIMES = RuntimeRecorder()
 
 
 def get_rabbitmqconn():
@@ -42,46 +57,81 @@ def get_rabbitmqconn():
     )
 
 
-def drain(ch, delivery_tag, _rundata):
+def drain(ch, delivery_tag, _rundata, _content_type=None):
     """NOOP to clear out the queue via a hackery"""
     cb = partial(ack_message, ch, delivery_tag)
     ch.connection.add_callback_threadsafe(cb)
 
 
-def run(ch, delivery_tag, rundata):
-    """Actually run wepp for this event"""
+def run_wepp(rundata):
+    """Run wepp for this run file, recording an error file on failure.
+
+    Returns:
+      bool if the run was successful
+    """
     # We run timeout to keep things from hanging indefinitely, we tried 60
     # seconds but it was too short as sometimes latency happens.
-    with subprocess.Popen(
-        ["timeout", "-s", "9", "600", "wepp"],
-        stderr=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stdin=subprocess.PIPE,
-    ) as proc:
-        (stdoutdata, stderrdata) = proc.communicate(rundata)
-    if stdoutdata[-13:-1] != b"SUCCESSFULLY":
-        # So our job failed and we now have to figure out a filename to use
-        # for the error file.  This is a quasi-hack here, but the env file
-        # should always point to the right scenario being run.
-        m = FILENAME_RE.search(rundata.decode("ascii"))
-        if m:
-            d = m.groupdict()
-            errorfn = (
-                f"/i/{d['scenario']}/error/{d['huc8']}/{d['huc812']}/"
-                f"{d['huc12']}_{d['fpath']}.error"
-            )
-            LOG.info("Errored: %s", errorfn)
-            os.makedirs(os.path.dirname(errorfn), exist_ok=True)
-            with open(errorfn, "wb") as fp:
-                hn = f"Hostname: {socket.gethostname()}\n"
-                fp.write(hn.encode("ascii"))
-                fp.write(stdoutdata)
-                fp.write(stderrdata)
-    cb = partial(ack_message, ch, delivery_tag)
+    results = MEMORY["results"]
+    key = None
+    with CLIFILES.runfile(rundata) as weppdata:
+        if results is not None:
+            key = results.get_key(weppdata)
+        if key is not None and results.lookup(key, weppdata):
+            return True
+        sts = time.time()
+        with subprocess.Popen(
+            ["timeout", "-s", "9", "600", "wepp"],
+            stderr=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stdin=subprocess.PIPE,
+        ) as proc:
+            (stdoutdata, stderrdata) = proc.communicate(weppdata)
+    # This is a quasi-hack here, but the env file should always point to
+    # the right scenario being run.
+    m = FILENAME_RE.search(rundata.decode("ascii"))
+    if m:
+        RUNTIMES.record(
+            m["scenario"], m["huc12"], m["fpath"], time.time() - sts
+        )
+    if stdoutdata[-13:-1] == b"SUCCESSFULLY":
+        if key is not None:
+            results.store(key, weppdata)
+        return True
+    # So our job failed and we now have to figure out a filename to use
+    # for the error file.
+    if m:
+        d = m.groupdict()
+        errorfn = (
+            f"/i/{d['scenario']}/error/{d['huc8']}/{d['huc812']}/"
+            f"{d['huc12']}_{d['fpath']}.error"
+        )
+        LOG.info("Errored: %s", errorfn)
+        os.makedirs(os.path.dirname(errorfn), exist_ok=True)
+        with open(errorfn, "wb") as fp:
+            hn = f"Hostname: {socket.gethostname()}\n"
+            fp.write(hn.encode("ascii"))
+            fp.write(stdoutdata)
+            fp.write(stderrdata)
+    return False
+
+
+def run(ch, delivery_tag, body, content_type=None):
+    """Actually run wepp for the runs of this message, then ack it once"""
+    runs = decode_message(body, content_type)
+    failures = 0
+    for rundata in runs:
+        try:
+            failures += not run_wepp(rundata)
+        except Exception as exp:  # pylint: disable=broad-except
+            # One bad run file must not hold back the rest of a batch
+            LOG.error("run failed: %s", exp)
+            failures += 1
+    MEMORY["failures"] += failures
+    cb = partial(ack_message, ch, delivery_tag, len(runs))
     ch.connection.add_callback_threadsafe(cb)
 
 
-def ack_message(ch, delivery_tag):
+def ack_message(ch, delivery_tag, runs=1):
     """Note that `ch` must be the same pika channel instance via which
     the message being ACKed was retrieved (AMQP protocol constraint).
     """
@@ -91,23 +141,26 @@ def ack_message(ch, delivery_tag):
         # Channel is already closed, so we can't ACK this message;
         # log and/or do something that makes sense for your app in this case.
         pass
-    MEMORY["runs"] += 1
+    MEMORY["runs"] += runs
 
 
-def run_consumer(jobfunc, executor):
+def run_consumer(jobfunc, executor, prefetch):
     """Our main runloop."""
     LOG.info("Starting queue_worker")
 
     conn = get_rabbitmqconn()
     channel = conn.channel()
-    channel.queue_declare("dep", durable=True)
-    # otherwise rabbitmq will send everything
-    channel.basic_qos(prefetch_count=300)
+    channel.queue_declare("dep", durable=True, arguments=get_queue_arguments())
+    # otherwise rabbitmq will send everything, a batch message only waits
+    # unacked on a thread to run it, within the consumer_timeout
+    channel.basic_qos(prefetch_count=prefetch)
 
-    def proxy(mychannel, method, _props, rundata):
+    def proxy(mychannel, method, props, body):
         """Wrapper around jobfunc."""
         delivery_tag = method.delivery_tag
-        executor.submit(jobfunc, mychannel, delivery_tag, rundata)
+        executor.submit(
+            jobfunc, mychannel, delivery_tag, body, props.content_type
+        )
 
     # make us acknowledge the message
     channel.basic_consume("dep", proxy, auto_ack=False)
@@ -119,14 +172,27 @@ def print_timing():
     """Print timing information."""
     while True:
         time.sleep(300)
+        RUNTIMES.flush()
         runs = MEMORY["runs"]
         dt = time.time() - MEMORY["timestamp"]
         rate = runs / dt
+        failures = MEMORY["failures"]
         MEMORY["runs"] = 0
+        MEMORY["failures"] = 0
         MEMORY["timestamp"] = time.time()
         if runs == 0:
             continue
-        LOG.info("%s runs over %.3fs for %.3f r/s", runs, dt, rate)
+        LOG.info(
+            "%s runs (%s failed) over %.3fs for %.3f r/s",
+            runs,
+            failures,
+            dt,
+            rate,
+        )
+        if CLIFILES.entries:
+            LOG.info("generated climate files: %s", CLIFILES.stats)
+        if MEMORY["results"] is not None:
+            LOG.info("result cache: %s", MEMORY["results"].stats)
 
 
 def main(argv):
@@ -137,6 +203,8 @@ def main(argv):
     # argv[1] is the scenario and unused
     num_workers = int(argv[2])
     jobfunc = run if len(argv) < 4 else drain
+    # records the outputs in place, maxbytes would also keep copies of them
+    MEMORY["results"] = RunCache(salt=get_salt())
     # Start a thread to print timing every 300 seconds
     threading.Thread(target=print_timing).start()
     while True:
@@ -144,7 +212,8 @@ def main(argv):
         # connection.  Run until something bad happens, then start again!
         try:
             with ThreadPoolExecutor(max_workers=num_workers) as executor:
-                run_consumer(jobfunc, executor)
+                # one batch per thread, no batches waiting on a busy pool
+                run_consumer(jobfunc, executor, num_workers)
             LOG.warning("run_consumer exited cleanly, sleeping 30 seconds")
             time.sleep(30)
         except KeyboardInterrupt:
@@ -0,0 +1,276 @@
+"""Cache of WEPP results keyed by a hash of the run's inputs.
+
+The key is a sha256 of the run file, the content of every input file it
+references and the identity of the `wepp` executable.  Input file digests
+are kept by (mtime, size), so a file is only read again once it changed.
+
+When a run's key was seen before and its outputs are still in place, WEPP
+does not need to run.  By default only the (mtime, size) of the outputs
+are recorded.  With `maxbytes`, copies of the outputs are also kept in the
+cache directory to restore them from, evicted least recently used first to
+stay within `maxbytes`.
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+
+from pyiem.util import logger
+
+LOG = logger()
+CACHEDIR = "/var/tmp/dep_runcache"
+PATH_RE = re.compile(rb"^(/\S+)$", re.M)
+INPUTS = (".man", ".slp", ".sol", ".cli", ".txt")
+OUTPUTS = (".wb", ".env", ".yld", ".grph", ".ofe", ".crop", ".event")
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS digests(
+    fn TEXT PRIMARY KEY, mtime_ns INT, size INT, digest TEXT);
+CREATE TABLE IF NOT EXISTS results(
+    key TEXT PRIMARY KEY, outputs TEXT, nbytes INT, last_used REAL);
+"""
+
+
+def parse_runfile(rundata):
+    """Return the (input, output) filenames referenced by the run file."""
+    inputs = []
+    outputs = []
+    for m in PATH_RE.finditer(rundata):
+        fn = m.group(1).decode("ascii")
+        if fn.endswith(INPUTS):
+            inputs.append(fn)
+        elif fn.endswith(OUTPUTS):
+            outputs.append(fn)
+    return inputs, outputs
+
+
+def _stat(fn):
+    """Return (mtime_ns, size) or None."""
+    try:
+        st = os.stat(fn)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+class RunCache:
+    """Thread safe result cache for the queue worker."""
+
+    def __init__(self, cachedir=CACHEDIR, maxbytes=0, salt=""):
+        """Constructor.
+
+        Args:
+          cachedir (str): local directory for the index and output copies
+          maxbytes (int): limit of the output copies, zero keeps no copies
+          salt (str): mixed into every key, e.g. the wepp executable stat
+        """
+        self.cachedir = cachedir
+        self.maxbytes = maxbytes
+        self.salt = salt.encode("ascii")
+        os.makedirs(cachedir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            f"{cachedir}/index.db", check_same_thread=False
+        )
+        self.conn.executescript(SCHEMA)
+        self.stats = {
+            "hits": 0,
+            "restores": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+            "hashed": 0,
+        }
+
+    def digest(self, fn):
+        """Return the sha256 of the file, or None when it does not exist."""
+        st = _stat(fn)
+        if st is None:
+            return None
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT digest from digests where fn = ? and mtime_ns = ? "
+                "and size = ?",
+                (fn, *st),
+            ).fetchone()
+        if row is not None:
+            return row[0]
+        digest = hashlib.sha256()
+        with open(fn, "rb") as fh:
+            for block in iter(lambda: fh.read(1024 * 1024), b""):
+                digest.update(block)
+        res = digest.hexdigest()
+        with self.lock:
+            self.stats["hashed"] += 1
+            self.conn.execute(
+                "INSERT OR REPLACE into digests values (?, ?, ?, ?)",
+                (fn, *st, res),
+            )
+            self.conn.commit()
+        return res
+
+    def get_key(self, rundata):
+        """Return the key of this run, None if an input is missing."""
+        key = hashlib.sha256(self.salt + rundata)
+        for fn in parse_runfile(rundata)[0]:
+            digest = self.digest(fn)
+            if digest is None:
+                return None
+            key.update(digest.encode("ascii"))
+        return key.hexdigest()
+
+    def _copydir(self, key):
+        """Where the output copies of this key live."""
+        return f"{self.cachedir}/{key[:2]}/{key}"
+
+    def lookup(self, key, rundata):
+        """Make the outputs of a previous identical run current.
+
+        Returns:
+          bool if the outputs are in place and WEPP does not need to run
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT outputs from results where key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            self.stats["misses"] += 1
+            return False
+        recorded = json.loads(row[0])
+        restored = False
+        for fn in parse_runfile(rundata)[1]:
+            if fn in recorded and _stat(fn) == tuple(recorded[fn]):
+                continue
+            copyfn = f"{self._copydir(key)}/{os.path.basename(fn)}"
+            if not os.path.isfile(copyfn):
+                self.stats["misses"] += 1
+                return False
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            tmpfn = f"{fn}.{os.getpid()}.{threading.get_ident()}.tmp"
+            shutil.copyfile(copyfn, tmpfn)
+            os.replace(tmpfn, fn)
+            recorded[fn] = _stat(fn)
+            restored = True
+        with self.lock:
+            self.stats["restores" if restored else "hits"] += 1
+            self.conn.execute(
+                "UPDATE results SET outputs = ?, last_used = ? WHERE key = ?",
+                (json.dumps(recorded), time.time(), key),
+            )
+            self.conn.commit()
+        return True
+
+    def store(self, key, rundata):
+        """Record the outputs of a successful run."""
+        recorded = {}
+        nbytes = 0
+        copydir = self._copydir(key)
+        for fn in parse_runfile(rundata)[1]:
+            st = _stat(fn)
+            if st is None:
+                continue
+            recorded[fn] = st
+            if self.maxbytes > 0:
+                os.makedirs(copydir, exist_ok=True)
+                shutil.copyfile(fn, f"{copydir}/{os.path.basename(fn)}")
+                nbytes += st[1]
+        with self.lock:
+            self.stats["stores"] += 1
+            self.conn.execute(
+                "INSERT OR REPLACE into results values (?, ?, ?, ?)",
+                (key, json.dumps(recorded), nbytes, time.time()),
+            )
+            self.conn.commit()
+        self.evict()
+
+    def evict(self):
+        """Drop the least recently used copies beyond `maxbytes`."""
+        with self.lock:
+            total = self.conn.execute(
+                "SELECT coalesce(sum(nbytes), 0) from results"
+            ).fetchone()[0]
+            if total <= self.maxbytes:
+                return
+            rows = self.conn.execute(
+                "SELECT key, nbytes from results where nbytes > 0 "
+                "ORDER by last_used ASC"
+            ).fetchall()
+            for key, nbytes in rows:
+                if total <= self.maxbytes * 0.9:
+                    break
+                shutil.rmtree(self._copydir(key), ignore_errors=True)
+                # The outputs can still be kept when they are in place
+                self.conn.execute(
+                    "UPDATE results SET nbytes = 0 WHERE key = ?", (key,)
+                )
+                total -= nbytes
+                self.stats["evictions"] += 1
+            self.conn.commit()
+
+
+def get_salt(executable="wepp"):
+    """Return a string identifying the executable, new builds change keys."""
+    path = shutil.which(executable)
+    if path is None:
+        return ""
+    st = os.stat(path)
+    return f"{path}:{st.st_mtime_ns}:{st.st_size}"
+
+
+def test_cache(tmp_path):
+    """Test that an identical run is skipped and outputs restored."""
+    (tmp_path / "a.man").write_text("man")
+    (tmp_path / "a.cli").write_text("cli")
+    env = tmp_path / "out" / "a.env"
+    rundata = (
+        f"E\nYes\n{tmp_path}/out/a.env\n{tmp_path}/a.man\n{tmp_path}/a.cli\n"
+        "0\n"
+    ).encode("ascii")
+    assert parse_runfile(rundata) == (
+        [f"{tmp_path}/a.man", f"{tmp_path}/a.cli"],
+        [f"{tmp_path}/out/a.env"],
+    )
+    cache = RunCache(str(tmp_path / "cache"), maxbytes=100)
+    key = cache.get_key(rundata)
+    assert not cache.lookup(key, rundata)
+    env.parent.mkdir()
+    env.write_text("results")
+    cache.store(key, rundata)
+    # A fresh instance reads the index from disk
+    cache = RunCache(str(tmp_path / "cache"), maxbytes=100)
+    assert cache.get_key(rundata) == key
+    assert cache.stats["hashed"] == 0
+    assert cache.lookup(key, rundata)
+    env.unlink()
+    assert cache.lookup(key, rundata)
+    assert env.read_text() == "results"
+    assert cache.stats == {
+        "hits": 1,
+        "restores": 1,
+        "misses": 0,
+        "stores": 0,
+        "evictions": 0,
+        "hashed": 0,
+    }
+    # By default, outputs that are gone can not be restored
+    cache2 = RunCache(str(tmp_path / "cache2"))
+    cache2.store(key, rundata)
+    assert not os.path.isdir(cache2._copydir(key))
+    assert cache2.lookup(key, rundata)
+    env.unlink()
+    assert not cache2.lookup(key, rundata)
+    assert cache.lookup(key, rundata)
+    # An input change is a new key
+    (tmp_path / "a.cli").write_text("cli2")
+    assert cache.get_key(rundata) != key
+    assert cache.get_key(rundata.replace(b"a.man", b"b.man")) is None
+    # Copies beyond maxbytes are evicted, kept outputs still count
+    cache.maxbytes = 1
+    cache.evict()
+    assert cache.stats["evictions"] == 1
+    assert cache.lookup(key, rundata)
+    env.unlink()
+    assert not cache.lookup(key, rundata)
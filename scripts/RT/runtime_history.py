@@ -0,0 +1,149 @@
+"""History of the WEPP wall time of each flowpath, to schedule long runs first.
+
+Workers buffer the wall time of their runs and flush them as small csv
+files to `/i/<scenario>/runtime/`.  `enqueue_jobs.py` merges these into
+`history.csv` with the latest time of each flowpath and predicts the
+flowpaths without history from their OFE count, length and irrigation.
+"""
+import csv
+import glob
+import os
+import socket
+import threading
+import time
+
+import numpy as np
+
+HISTORY = "history.csv"
+# seconds = a + b * ofe_count + c * real_length + d * irrigated, used until
+# there is enough history to fit the coefficients
+DEFAULT_MODEL = np.array([2.0, 1.0, 0.01, 5.0])
+MIN_FIT = 100
+
+
+def get_history_dir(scenario, basedir="/i"):
+    """Return the runtime history directory of this scenario."""
+    return f"{basedir}/{scenario}/runtime"
+
+
+class RuntimeRecorder:
+    """Thread safe buffer of the wall times of a worker's runs."""
+
+    def __init__(self, basedir="/i"):
+        """Constructor."""
+        self.basedir = basedir
+        self.lock = threading.Lock()
+        self.rows = {}  # scenario to list of rows
+
+    def record(self, scenario, huc12, fpath, seconds):
+        """Record the wall time of a run."""
+        row = (huc12, int(fpath), round(seconds, 3), int(time.time()))
+        with self.lock:
+            self.rows.setdefault(scenario, []).append(row)
+
+    def flush(self):
+        """Write out the buffered rows, one new file per scenario."""
+        with self.lock:
+            rows, self.rows = self.rows, {}
+        for scenario, myrows in rows.items():
+            mydir = get_history_dir(scenario, self.basedir)
+            os.makedirs(mydir, exist_ok=True)
+            fn = (
+                f"{mydir}/{socket.gethostname()}_{os.getpid()}_"
+                f"{time.time():.0f}.csv"
+            )
+            # the tmp suffix keeps a partial file from being merged
+            tmpfn = f"{fn}.{os.getpid()}.tmp"
+            with open(tmpfn, "w", encoding="ascii", newline="") as fh:
+                csv.writer(fh).writerows(myrows)
+            os.replace(tmpfn, fn)
+
+
+def load_history(scenario, basedir="/i"):
+    """Merge the worker files into the history and return it.
+
+    Returns:
+      dict of (huc12, fpath) to the latest wall time in seconds
+    """
+    mydir = get_history_dir(scenario, basedir)
+    histfn = f"{mydir}/{HISTORY}"
+    latest = {}
+    merged = sorted(glob.glob(f"{mydir}/*.csv"))
+    if histfn in merged:
+        # the merged history goes first, the worker files are newer
+        merged.remove(histfn)
+        merged.insert(0, histfn)
+    for fn in merged:
+        with open(fn, encoding="ascii", newline="") as fh:
+            for huc12, fpath, seconds, valid in csv.reader(fh):
+                key = (huc12, int(fpath))
+                if key not in latest or int(valid) >= latest[key][1]:
+                    latest[key] = (float(seconds), int(valid))
+    if len(merged) > 1 or (merged and merged[0] != histfn):
+        tmpfn = f"{histfn}.{os.getpid()}.tmp"
+        with open(tmpfn, "w", encoding="ascii", newline="") as fh:
+            csv.writer(fh).writerows(
+                (key[0], key[1], val[0], val[1])
+                for key, val in sorted(latest.items())
+            )
+        os.replace(tmpfn, histfn)
+        for fn in merged:
+            if fn != histfn:
+                os.unlink(fn)
+    return {key: val[0] for key, val in latest.items()}
+
+
+def predict(rows, history):
+    """Predict the wall time of the runs.
+
+    Args:
+      rows (list): (huc12, fpath, ofe_count, real_length, irrigated) tuples
+      history (dict): from `load_history`
+
+    Returns:
+      np.ndarray of seconds, the history where known, else the model
+    """
+    if not rows:
+        return np.zeros(0)
+    features = np.array(
+        [[1.0, row[2], row[3] or 0, bool(row[4])] for row in rows]
+    )
+    known = np.array([(row[0], row[1]) in history for row in rows])
+    seconds = np.array([history.get((row[0], row[1]), np.nan) for row in rows])
+    model = DEFAULT_MODEL
+    if known.sum() >= MIN_FIT:
+        model = np.linalg.lstsq(features[known], seconds[known], rcond=None)[0]
+    return np.where(known, seconds, features @ model)
+
+
+def test_history(tmp_path):
+    """Test the merge of the worker files and the prediction."""
+    basedir = str(tmp_path)
+    recorder = RuntimeRecorder(basedir)
+    recorder.record(0, "070801050101", "1", 10.0)
+    recorder.record(0, "070801050101", "2", 30.0)
+    recorder.flush()
+    recorder.flush()  # nothing buffered, nothing written
+    assert len(os.listdir(get_history_dir(0, basedir))) == 1
+    assert load_history(0, basedir) == {
+        ("070801050101", 1): 10.0,
+        ("070801050101", 2): 30.0,
+    }
+    time.sleep(1)
+    recorder.record(0, "070801050101", "1", 20.0)
+    recorder.flush()
+    assert load_history(0, basedir)[("070801050101", 1)] == 20.0
+    assert os.listdir(get_history_dir(0, basedir)) == [HISTORY]
+    rows = [
+        ("070801050101", 1, 3, 100.0, False),
+        ("070801050101", 3, 1, 10.0, False),
+        ("070801050101", 4, 9, 500.0, True),
+    ]
+    res = predict(rows, load_history(0, basedir))
+    assert res[0] == 20.0
+    assert res[2] > res[1]
+    # enough history fits the model
+    history = {("a", i): 2.0 + 3.0 * i for i in range(MIN_FIT)}
+    rows = [("a", i, i, 0, False) for i in range(MIN_FIT)]
+    res = predict(rows + [("b", 0, 200, 0, False)], history)
+    np.testing.assert_allclose(res[-1], 602.0)
@@ -0,0 +1,279 @@
+"""The message formats of the DEP queue, shared by publisher and worker.
+
+A message is either a single WEPP run file, as it always was, or a batch
+of one HUC12 encoded as a JSON list with one of two content types:
+
+- `BATCH_TYPE`: a list of run files
+- `DESCRIPTOR_TYPE`: a list of `DESCRIPTOR` value lists, the worker renders
+  the run files with `WeppRun`, so run options change without re-enqueueing
+
+A batch is acked once, after all of its runs are done, so its predicted
+wall time is capped by `MAXSECONDS`, well within RabbitMQ's default
+`consumer_timeout` of 30 minutes for an unacked message.
+"""
+import datetime
+import json
+from io import StringIO
+
+BATCH_TYPE = "application/x-dep-batch+json"
+DESCRIPTOR_TYPE = "application/x-dep-jobs+json"
+DESCRIPTOR = (
+    "scenario",
+    "huc12",
+    "fpath",
+    "clifile",
+    "ofe_count",
+    "irrigated",
+)
+BATCHSIZE = 50
+MAXSECONDS = 600
+
+
+class WeppRun:
+    """Represents a single run of WEPP.
+
+    Filenames have a 51 character restriction.
+    """
+
+    def __init__(self, huc12, fpid, clifile, scenario, ofe_count, is_irr):
+        """We initialize with a huc12 identifier and a flowpath id"""
+        self.huc12 = huc12
+        self.huc8 = huc12[:8]
+        self.subdir = f"{huc12[:8]}/{huc12[8:]}"
+        self.fpid = fpid
+        self.clifile = clifile
+        self.scenario = scenario
+        self.ofe_count = ofe_count
+        self.is_irr = is_irr
+
+    def _getfn(self, prefix):
+        """boilerplate code to get a filename."""
+        return (
+            f"/i/{self.scenario}/{prefix}/{self.subdir}/"
+            f"{self.huc12}_{self.fpid}.{prefix}"
+        )
+
+    def get_wb_fn(self):
+        """Return the water balance filename for this run"""
+        return self._getfn("wb")
+
+    def get_env_fn(self):
+        """Return the event filename for this run"""
+        return self._getfn("env")
+
+    def get_ofe_fn(self):
+        """Return the filename used for OFE output"""
+        return self._getfn("ofe")
+
+    def get_man_fn(self):
+        """Return the management filename for this run"""
+        return self._getfn("man")
+
+    def get_slope_fn(self):
+        """Return the slope filename for this run"""
+        return self._getfn("slp")
+
+    def get_soil_fn(self):
+        """Return the soil filename for this run"""
+        return self._getfn("sol")
+
+    def get_clifile_fn(self):
+        """Return the climate filename for this run"""
+        return self.clifile
+
+    def get_error_fn(self):
+        """Return the filename queue_worker writes when this run fails"""
+        return self._getfn("error")
+
+    def get_runfile_fn(self):
+        """Return the run filename for this run"""
+        return self._getfn("run")
+
+    def get_yield_fn(self):
+        """Filename to be used for yield output"""
+        return self._getfn("yld")
+
+    def get_event_fn(self):
+        """Filename to be used for event output"""
+        return self._getfn("event")
+
+    def get_crop_fn(self):
+        """Filename to be used for crop output."""
+        return self._getfn("crop")
+
+    def get_graphics_fn(self):
+        """Filename to be used for crop output."""
+        return self._getfn("grph")
+
+    def get_irrigation_fn(self):
+        """Filename providing irrigation data."""
+        return f"/i/{self.scenario}/irrigation/ofe{self.ofe_count}.txt"
+
+    def make_runfile(self):
+        """Create a runfile for our runs"""
+        out = StringIO()
+        out.write("E\n")  # English units
+        out.write("Yes\n")  # Run Hillslope
+        out.write("1\n")  # Continuous simulation
+        out.write("1\n")  # hillslope version
+        out.write("No\n")  # pass file output?
+        out.write("1\n")  # abbreviated annual output
+        out.write("No\n")  # initial conditions output
+        out.write("/dev/null\n")  # soil loss output file
+        out.write("Yes\n")  # Do water balance output
+        out.write(f"{self.get_wb_fn()}\n")  # water balance output file
+        out.write("No\n")  # crop output
+        # out.write("%s\n" % (self.get_crop_fn(),))  # crop output file
+        out.write("No\n")  # soil output
+        out.write("No\n")  # distance and sed output
+        if self.huc12 in ["090201081101", "090201081102", "090201060605"]:
+            out.write("Yes\n")  # large graphics output
+            out.write(f"{self.get_graphics_fn()}\n")
+        else:
+            out.write("No\n")  # large graphics output
+        out.write("Yes\n")  # event by event output
+        out.write(f"{self.get_env_fn()}\n")  # event file output
+        out.write("No\n")  # element output
+        # out.write("%s\n" % (self.get_ofe_fn(),))
+        out.write("No\n")  # final summary output
+        out.write("No\n")  # daily winter output
+        out.write("Yes\n")  # plant yield output
+        out.write(f"{self.get_yield_fn()}\n")  # yield file
+        out.write(f"{self.get_man_fn()}\n")  # management file
+        out.write(f"{self.get_slope_fn()}\n")  # slope file
+        out.write(f"{self.get_clifile_fn()}\n")  # climate file
+        out.write(f"{self.get_soil_fn()}\n")  # soil file
+        if self.is_irr:
+            out.write("2\n")  # Irrigation
+            out.write(f"{self.get_irrigation_fn()}\n")
+        else:
+            out.write("0\n")  # Irrigation
+        # workers outlive a new year, so this is not a module constant
+        years = datetime.date.today().year - 2006
+        out.write(f"{years}\n")  # years 2007-
+        out.write("0\n")  # route all events
+        out.seek(0)
+        return out.read()
+
+    def get_descriptor(self):
+        """Return the `DESCRIPTOR` values of this run."""
+        return [
+            self.scenario,
+            self.huc12,
+            self.fpid,
+            self.clifile,
+            self.ofe_count,
+            self.is_irr,
+        ]
+
+    @classmethod
+    def from_descriptor(cls, descriptor):
+        """Create from the `DESCRIPTOR` values."""
+        scenario, huc12, fpid, clifile, ofe_count, is_irr = descriptor
+        return cls(huc12, fpid, clifile, scenario, ofe_count, is_irr)
+
+
+def get_queue_arguments(fn="rabbitmq.json"):
+    """Return the dep queue arguments, a priority queue if configured.
+
+    The optional `max_priority` of rabbitmq.json enables priorities, the
+    publisher and the workers must agree as the queue is declared by both.
+    """
+    with open(fn, "r", encoding="utf-8") as fh:
+        config = json.load(fh)
+    if not config.get("max_priority"):
+        return None
+    return {"x-max-priority": int(config["max_priority"])}
+
+
+def get_priority(rank, total, max_priority):
+    """Return the priority of the rank-th longest of total messages."""
+    return max_priority - (rank * (max_priority + 1)) // total
+
+
+def group_batches(jobs, batchsize=BATCHSIZE, maxseconds=MAXSECONDS):
+    """Group the jobs into batches of the same HUC12.
+
+    Args:
+      jobs (iterable): (huc12, run, predicted seconds) tuples, ordered by
+        huc12
+      batchsize (int): the most runs within a batch
+      maxseconds (float): the most predicted seconds within a batch, a
+        longer run is a batch of its own
+
+    Yields:
+      list of runs
+    """
+    batch = []
+    current = None
+    seconds = 0
+    for huc12, job, sec in jobs:
+        if batch and (
+            huc12 != current
+            or len(batch) >= batchsize
+            or seconds + sec > maxseconds
+        ):
+            yield batch
+            batch = []
+            seconds = 0
+        current = huc12
+        batch.append(job)
+        seconds += sec
+    if batch:
+        yield batch
+
+
+def encode_batch(runs):
+    """Return the message body of these run files or descriptors."""
+    return json.dumps(runs).encode("ascii")
+
+
+def decode_message(body, content_type=None):
+    """Return the list of run files carried by the message."""
+    if content_type == DESCRIPTOR_TYPE:
+        return [
+            WeppRun.from_descriptor(desc).make_runfile().encode("ascii")
+            for desc in json.loads(body)
+        ]
+    if content_type != BATCH_TYPE:
+        return [body]
+    return [run.encode("ascii") for run in json.loads(body)]
+
+
+def test_batches():
+    """Test that batches do not span HUC12s and round trip."""
+    jobs = [("a", "1", 1), ("a", "2", 1), ("a", "3", 1), ("b", "4", 1)]
+    assert list(group_batches(jobs, 2)) == [["1", "2"], ["3"], ["4"]]
+    assert list(group_batches([], 2)) == []
+    # capped by the predicted seconds as well
+    jobs = [("a", "1", 400), ("a", "2", 300), ("a", "3", 900), ("a", "4", 1)]
+    assert list(group_batches(jobs)) == [["1"], ["2"], ["3"], ["4"]]
+    assert list(group_batches(jobs, maxseconds=1e9)) == [["1", "2", "3", "4"]]
+    body = encode_batch(["E\nYes\n", "E\nNo\n"])
+    assert decode_message(body, BATCH_TYPE) == [b"E\nYes\n", b"E\nNo\n"]
+    assert decode_message(b"E\nYes\n") == [b"E\nYes\n"]
+
+
+def test_priority(tmp_path):
+    """Test the priority queue configuration."""
+    fn = tmp_path / "rabbitmq.json"
+    fn.write_text('{"host": "localhost"}')
+    assert get_queue_arguments(str(fn)) is None
+    fn.write_text('{"host": "localhost", "max_priority": 9}')
+    assert get_queue_arguments(str(fn)) == {"x-max-priority": 9}
+    res = [get_priority(rank, 20, 9) for rank in range(20)]
+    assert res[0] == 9 and res[-1] == 0
+    assert res == sorted(res, reverse=True)
+
+
+def test_descriptors():
+    """Test that a descriptor renders the same run file."""
+    wr = WeppRun("070801050101", 12, "/i/0/cli/a.cli", 0, 3, True)
+    body = encode_batch([wr.get_descriptor()])
+    assert len(body) < len(wr.make_runfile()) / 5
+    (runfile,) = decode_message(body, DESCRIPTOR_TYPE)
+    assert runfile == wr.make_runfile().encode("ascii")
+    assert b"/i/0/irrigation/ofe3.txt\n" in runfile
+    assert b"/i/0/env/07080105/0101/070801050101_12.env\n" in runfile
+    years = datetime.date.today().year - 2006
+    assert runfile.endswith(f"\n{years}\n0\n".encode("ascii"))
@@ -1,34 +1,48 @@
 """Utility script that copies neighboring clifiles when it is discovered
-that we need new ones!"""
+that we need new ones!
+
+Usage:
+    python add_clifiles.py <scenario> [link]
+
+The `link` option hardlinks the new files to one stored copy of each
+source, see clifile_store.
+"""
 import os
 import sys
 import shutil
 
 from pyiem.util import get_dbconn
-from pyiem.dep import get_cli_fname
+from clifile_locator import ClifileLocator
+from clifile_store import seed_clifile
 
 
-def missing_logic(scenario, fn):
+def missing_logic(scenario, fn, locator=None, link=False):
     """Figure out what to do when this filename is missing"""
     print("Searching for replacement for '%s'" % (fn,))
     lon = float(fn[17:23])
     lat = float(fn[24:30])
     if not os.path.isdir(os.path.dirname(fn)):
         os.makedirs(os.path.dirname(fn))
-    # So there should be a file at an interval of 0.25
-    lon2 = lon - (lon * 100 % 25) / 100.0
-    lat2 = lat - (lat * 100 % 25) / 100.0
-    testfn = get_cli_fname(lon2, lat2, scenario)
-    if not os.path.isfile(testfn):
-        print("Whoa, why doesn't %s exist?" % (testfn,))
+    if locator is None:
+        locator = ClifileLocator(scenario)
+        locator.refresh()
+    # The file nearest to the point, the domain edge may lack a 0.25 file
+    testfn = locator.nearest(0 - lon, lat)[0]
+    if testfn is None:
+        print("Whoa, why are there no climate files?")
         sys.exit()
     print("%s->%s" % (testfn, fn))
-    shutil.copyfile(testfn, fn)
+    if link:
+        seed_clifile(testfn, fn)
+    else:
+        shutil.copyfile(testfn, fn)
+    locator.add(fn)
 
 
 def main(argv):
     """Go Main Go!"""
     scenario = argv[1]
+    link = len(argv) > 2 and argv[2] == "link"
     pgconn = get_dbconn("idep")
     cursor = pgconn.cursor()
     cursor.execute(
@@ -38,11 +52,15 @@ def main(argv):
     """,
         (scenario,),
     )
+    # One scan of the climate files, instead of a stat per flowpath
+    locator = ClifileLocator(scenario)
+    locator.refresh()
     for row in cursor:
         fn = "/i/%s/%s" % (scenario, row[0])
-        if os.path.isfile(fn):
+        if fn in locator or os.path.isfile(fn):
             continue
-        missing_logic(scenario, fn)
+        missing_logic(scenario, fn, locator, link)
+    locator.save()
 
 
 if __name__ == "__main__":
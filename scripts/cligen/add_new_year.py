@@ -4,47 +4,168 @@
 
 The previous year is choosen based on if the year to add is a leap year or not,
 if it is, then pick a year four years ago, if it isn't, use last year
+
+The analog year's bytes are found with the climate file index and appended
+to the file in place, then the fixed width header line is patched.  Only
+when the header line changes length is the file rewritten, atomically.
+The index is saved last, so an append cut short by a crash is found by
+the index's old file size and truncated away when the file is next run.
 """
-import glob
-import sys
 import os
-import subprocess
+import sys
+from multiprocessing import Pool
 
+import numpy as np
 from tqdm import tqdm
 from pyiem.util import logger
+from clifile_index import get_index_fn, load_index, save_index
+from clifile_store import break_link
 
 LOG = logger()
+HEADER_LINENUM = 4
+HEADER_FMT = (
+    "    %.2f   %.2f         289          %i        2007              %i\n"
+)
 
 
 def parse_filename(filename):
     """The filename tells us the location."""
-    tokens = filename.rsplit(".", 1)[0].split("x")
+    tokens = os.path.basename(filename).rsplit(".", 1)[0].split("x")
     return float(tokens[0]) * -1.0, float(tokens[1])
 
 
-def workflow(filename, newyear, analogyear):
-    """Effort this file, please"""
-    # Figure out what this file's lon/lat values are
+def patch_header(filename, newyear):
+    """Update the years simulated within the header line.
+
+    Returns:
+      int change of the file size, non-zero when the file was rewritten
+    """
     lon, lat = parse_filename(filename)
-    # LOG.debug("%s -> %.2f %.2f", filename, lon, lat)
-    lines = open(filename).readlines()
-    # Replace the header information denoting years simulated
     years_simulated = (newyear - 2007) + 1
-    lines[4] = (
-        "    %.2f   %.2f         289          %i        2007"
-        "              %i\n"
-    ) % (lat, lon, years_simulated, years_simulated)
-    data = "".join(lines)
-    if data.find("1\t1\t%s" % (newyear,)) > 0:
+    newline = HEADER_FMT % (lat, lon, years_simulated, years_simulated)
+    newline = newline.encode("ascii")
+    with open(filename, "r+b") as fh:
+        head = fh.read(4096)
+        pos = 0
+        for _ in range(HEADER_LINENUM):
+            pos = head.index(b"\n", pos) + 1
+        end = head.index(b"\n", pos) + 1
+        if end - pos == len(newline):
+            if head[pos:end] != newline:
+                fh.seek(pos)
+                fh.write(newline)
+            return 0
+        data = head[:pos] + newline + head[end:] + fh.read()
+    tmpfn = f"{filename}.{os.getpid()}.tmp"
+    with open(tmpfn, "wb") as fh:
+        fh.write(data)
+    os.replace(tmpfn, filename)
+    return len(newline) - (end - pos)
+
+
+def _patch(filename, idx, newyear):
+    """Patch the header, then save the index with the offsets moved."""
+    delta = patch_header(filename, newyear)
+    save_index(filename, np.concatenate([idx[:1], idx[1:] + delta]))
+
+
+def truncate_partial(filename, newyear):
+    """Cut off an append of the new year that a crash left incomplete.
+
+    The index is saved after the append, so it still holds the file size
+    prior to it, where the new year's first day line starts.
+
+    Returns:
+      bool if the file was truncated
+    """
+    idxfn = get_index_fn(filename)
+    if not os.path.isfile(idxfn):
+        return False
+    saved = np.fromfile(idxfn, np.int64)
+    if saved.size < 4:
+        return False
+    size = int(saved[-2])
+    marker = b"1\t1\t%i\t" % (newyear,)
+    with open(filename, "r+b") as fh:
+        if os.fstat(fh.fileno()).st_size <= size:
+            return False
+        fh.seek(size)
+        if fh.read(len(marker)) != marker:
+            return False
+        fh.truncate(size)
+    LOG.warning("%s had a partial %s, truncated", filename, newyear)
+    save_index(filename, saved[:-1])
+    return True
+
+
+def workflow(filename, newyear, analogyear):
+    """Effort this file, please
+
+    Returns:
+      str one of `added`, `present` or `noanalog`
+    """
+    break_link(filename)
+    truncate_partial(filename, newyear)
+    idx = load_index(filename)
+    months = idx.size - 2
+    first = int(idx[0])
+    if first + months - 1 >= newyear * 12 + 11:
         LOG.info("%s already has %s data", filename, newyear)
-        return
-    pos = data.find("1\t1\t%s" % (analogyear,))
-    pos2 = data.find("1\t1\t%s" % (analogyear + 1,))
-    content = data[pos:pos2] if pos2 > 0 else data[pos:]
-    with open("/tmp/%s" % (filename,), "w") as fh:
-        # careful here to get the line feeds right
-        fh.write(data + content.replace(str(analogyear), str(newyear)))
-    subprocess.call("mv /tmp/%s %s" % (filename, filename), shell=True)
+        _patch(filename, idx, newyear)
+        return "present"
+    if first + months - 1 >= newyear * 12:
+        # Some months of the new year, without an index to say so
+        ni = newyear * 12 - first
+        LOG.warning("%s has a partial %s, truncated", filename, newyear)
+        with open(filename, "r+b") as fh:
+            fh.truncate(int(idx[1 + ni]))
+        idx = np.concatenate([idx[: 1 + ni], idx[1 + ni : 2 + ni]])
+        months = ni
+    mi = analogyear * 12 - first
+    if mi < 0 or mi + 12 > months:
+        LOG.warning("%s lacks analog year %s", filename, analogyear)
+        return "noanalog"
+    start = int(idx[1 + mi])
+    end = int(idx[1 + mi + 12])
+    size = int(idx[-1])
+    with open(filename, "r+b") as fh:
+        fh.seek(start)
+        content = fh.read(end - start)
+        # day lines are d\tm\tyyyy\t..., both years have the same length
+        content = content.replace(
+            b"\t%i\t" % (analogyear,), b"\t%i\t" % (newyear,)
+        )
+        fh.seek(size)
+        fh.write(content)
+    # The new year has the same month offsets, shifted to the old file end
+    offsets = idx[1 + mi : 1 + mi + 12] - start + size
+    _patch(
+        filename,
+        np.concatenate([idx[:-1], offsets, [size + len(content)]]),
+        newyear,
+    )
+    return "added"
+
+
+def _worker(arg):
+    """Run workflow within the pool, never raise."""
+    try:
+        return workflow(*arg)
+    except Exception as exp:  # pylint: disable=broad-except
+        LOG.warning("%s failed: %s", arg[0], exp)
+        return "error"
+
+
+def find_files(clidir):
+    """Return the climate files within the directory."""
+    res = []
+    with os.scandir(clidir) as it:
+        for entry in it:
+            if not entry.is_dir():
+                continue
+            with os.scandir(entry.path) as it2:
+                res.extend(e.path for e in it2 if e.name.endswith(".cli"))
+    return res
 
 
 def compute_analog_year(year):
@@ -65,12 +186,14 @@ def main(argv):
     year = int(argv[2])
     analogyear = compute_analog_year(year)
     LOG.info("Using analog year %s for new year %s", analogyear, year)
-    os.chdir("/i/%s/cli" % (scenario,))
-    for mydir in tqdm(glob.glob("*")):
-        os.chdir(mydir)
-        for fn in glob.glob("*.cli"):
-            workflow(fn, year, analogyear)
-        os.chdir("..")
+    jobs = [(fn, year, analogyear) for fn in find_files(f"/i/{scenario}/cli")]
+    counts = {}
+    with Pool() as pool:
+        for res in tqdm(
+            pool.imap_unordered(_worker, jobs, chunksize=64), total=len(jobs)
+        ):
+            counts[res] = counts.get(res, 0) + 1
+    LOG.info("%s", counts)
 
 
 if __name__ == "__main__":
@@ -81,3 +204,67 @@ def test_analog():
     """Test that we can do the right thing."""
     assert compute_analog_year(2021) == 2019
     assert compute_analog_year(2020) == 2016
+
+
+def test_workflow(tmp_path):
+    """Test that a year gets appended and the header patched."""
+    src = os.path.join(
+        os.path.dirname(__file__),
+        "../../src/regression_tests/common/092.51x042.00.cli",
+    )
+    fn = str(tmp_path / "092.51x042.00.cli")
+    with open(src, "rb") as fh:
+        orig = fh.read()
+    with open(fn, "wb") as fh:
+        fh.write(orig)
+    assert workflow(fn, 2023, 2021) == "added"
+    with open(fn, "rb") as fh:
+        res = fh.read()
+    assert res.split(b"\n")[4] == (
+        b"    42.00   -92.51         289          17        2007"
+        b"              17"
+    )
+    pos = orig.index(b"1\t1\t2021\t")
+    pos2 = orig.index(b"1\t1\t2022\t")
+    assert res[len(orig) :] == orig[pos:pos2].replace(b"\t2021\t", b"\t2023\t")
+    # The saved index is still valid
+    saved = np.fromfile(f"{fn}.idx", np.int64)
+    assert (saved[:-1] == load_index(fn)).all()
+    os.unlink(f"{fn}.idx")
+    assert (saved[:-1] == load_index(fn)).all()
+    assert workflow(fn, 2023, 2021) == "present"
+    # A header line changing length rewrites the file
+    assert patch_header(fn, 2107) == 2
+    with open(fn, "rb") as fh:
+        assert fh.read().split(b"\n")[4].endswith(b"101")
+
+
+def test_partial_append(tmp_path):
+    """Test that an append cut short by a crash is not duplicated."""
+    src = os.path.join(
+        os.path.dirname(__file__),
+        "../../src/regression_tests/common/092.51x042.00.cli",
+    )
+    fn = str(tmp_path / "092.51x042.00.cli")
+    with open(src, "rb") as fh:
+        orig = fh.read()
+    pos = orig.index(b"1\t1\t2021\t")
+    partial = orig[pos : pos + 5000].replace(b"\t2021\t", b"\t2023\t")
+    for withindex in [True, False]:
+        with open(fn, "wb") as fh:
+            fh.write(orig)
+        load_index(fn)
+        with open(fn, "ab") as fh:
+            fh.write(
+                partial[: 5000 if withindex else partial.rindex(b"\n1\t2") + 1]
+            )
+        if not withindex:
+            os.unlink(f"{fn}.idx")
+        assert workflow(fn, 2023, 2021) == "added"
+        with open(fn, "rb") as fh:
+            res = fh.read()
+        assert res.count(b"\n1\t1\t2023\t") == 1
+        assert res.count(b"\n31\t12\t2023\t") == 1
+        saved = np.fromfile(f"{fn}.idx", np.int64)
+        os.unlink(f"{fn}.idx")
+        assert (saved[:-1] == load_index(fn)).all()
@@ -0,0 +1,77 @@
+"""Manifests of the climate files that materially changed on a date.
+
+The daily editor writes, per tile and date, the climate files whose new
+day has precipitation or whose breakpoints changed from what was in the
+file.  `enqueue_jobs.py` can then only run the flowpaths using those files.
+
+Manifests live at `/i/<scenario>/dirty/<YYYYmmdd>/<name>.txt` with one
+climate filename per line.
+"""
+import datetime
+import os
+
+
+def get_dirty_dir(scenario, valid, basedir="/i"):
+    """Return the manifest directory for this date."""
+    return f"{basedir}/{scenario}/dirty/{valid:%Y%m%d}"
+
+
+def is_material(old, new):
+    """Is the change of a climate file day material to a WEPP run.
+
+    Args:
+      old (str): the day text replaced, None if unknown
+      new (str): the new day text
+
+    Returns:
+      bool
+    """
+    if old is None or new.split("\t", 4)[3] != "0":
+        return True
+    # A dry day replacing a dry day only changes temperatures and the like
+    return old.split("\n", 1)[1] != new.split("\n", 1)[1]
+
+
+def write_dirty(scenario, valid, name, clifns, basedir="/i"):
+    """Atomically write a manifest of climate files for this date."""
+    mydir = get_dirty_dir(scenario, valid, basedir)
+    os.makedirs(mydir, exist_ok=True)
+    fn = f"{mydir}/{name}.txt"
+    tmpfn = f"{fn}.{os.getpid()}.tmp"
+    with open(tmpfn, "w", encoding="ascii") as fh:
+        fh.write("".join(f"{clifn}\n" for clifn in sorted(clifns)))
+    os.replace(tmpfn, fn)
+
+
+def read_dirty(scenario, dates, basedir="/i"):
+    """Return the set of climate files changed on any of the dates."""
+    res = set()
+    for valid in dates:
+        mydir = get_dirty_dir(scenario, valid, basedir)
+        if not os.path.isdir(mydir):
+            continue
+        for fn in os.listdir(mydir):
+            if not fn.endswith(".txt"):
+                continue
+            with open(f"{mydir}/{fn}", encoding="ascii") as fh:
+                res.update(line.strip() for line in fh if line.strip())
+    return res
+
+
+def test_manifest(tmp_path):
+    """Test the round trip and what counts as material."""
+    dry = "1\t6\t2021\t0\t20.0\t10.0\t300\t2.0\t0\t8.0\n"
+    wet = "1\t6\t2021\t1\t20.0\t10.0\t300\t2.0\t0\t8.0\n12.00 0.00\n"
+    assert is_material(None, dry)
+    assert is_material(dry, wet)
+    assert is_material(wet, dry)
+    assert not is_material(dry, dry.replace("20.0", "21.0"))
+    basedir = str(tmp_path)
+    valid = datetime.date(2021, 6, 1)
+    write_dirty(0, valid, "1_2", ["/i/0/cli/b.cli", "/i/0/cli/a.cli"], basedir)
+    write_dirty(0, valid, "1_3", [], basedir)
+    assert read_dirty(0, [valid], basedir) == {
+        "/i/0/cli/a.cli",
+        "/i/0/cli/b.cli",
+    }
+    assert read_dirty(0, [datetime.date(2021, 6, 2)], basedir) == set()
@@ -0,0 +1,219 @@
+"""Byte offset index for in-place editing of DEP climate files.
+
+Each climate file gets a `<clifile>.idx` sidecar, a raw int64 array of
+
+    [year * 12 + month - 1 of the first month, month start offsets...,
+     file size, file mtime_ns]
+
+The trailing file size and modification time let us detect a stale index,
+which is then rebuilt from a full read.  `load_index` returns the index
+without the modification time.  An edit seeks to the month holding the
+earliest edited day, splices in the new day text and rewrites only the
+tail of the file.
+"""
+import datetime
+import os
+
+import numpy as np
+
+
+def get_index_fn(clifn):
+    """Return the sidecar index filename for this climate file."""
+    return f"{clifn}.idx"
+
+
+def _monthkey(date):
+    """Months since year zero."""
+    return date.year * 12 + date.month - 1
+
+
+def _parse_blocks(buf):
+    """Split climate file day data into [date, bytes] blocks."""
+    blocks = []
+    for line in buf.splitlines(keepends=True):
+        # Day lines are tab delimited, breakpoints are space delimited
+        if b"\t" in line:
+            tokens = line.split(b"\t", 3)
+            date = datetime.date(
+                int(tokens[2]), int(tokens[1]), int(tokens[0])
+            )
+            blocks.append([date, line])
+        elif blocks:
+            blocks[-1][1] += line
+    return blocks
+
+
+def _month_offsets(blocks, offset):
+    """Return the (first monthkey, month start offsets) for the blocks."""
+    first = None
+    offsets = []
+    lastkey = None
+    for date, text in blocks:
+        key = _monthkey(date)
+        if key != lastkey:
+            if lastkey is not None and key != lastkey + 1:
+                raise ValueError(f"month gap before {date}")
+            if first is None:
+                first = key
+            offsets.append(offset)
+            lastkey = key
+        offset += len(text)
+    return first, offsets
+
+
+def build_index(clifn):
+    """Build and save the index for this climate file.
+
+    Returns:
+      np.ndarray index
+    """
+    with open(clifn, "rb") as fh:
+        buf = fh.read()
+    # The header has no tab characters, the first day line does
+    start = buf.rfind(b"\n", 0, buf.find(b"\t")) + 1
+    first, offsets = _month_offsets(_parse_blocks(buf[start:]), start)
+    if first is None:
+        raise ValueError(f"no daily data found in {clifn}")
+    idx = np.array([first, *offsets, len(buf)], np.int64)
+    save_index(clifn, idx)
+    return idx
+
+
+def save_index(clifn, idx):
+    """Atomically replace the index for this climate file, once written."""
+    idxfn = get_index_fn(clifn)
+    tmpfn = f"{idxfn}.{os.getpid()}.tmp"
+    mtime_ns = os.stat(clifn).st_mtime_ns
+    np.append(idx, mtime_ns).astype(np.int64).tofile(tmpfn)
+    os.replace(tmpfn, idxfn)
+
+
+def load_index(clifn):
+    """Return the index for this climate file, rebuilding it when stale."""
+    idxfn = get_index_fn(clifn)
+    if os.path.isfile(idxfn):
+        idx = np.fromfile(idxfn, np.int64)
+        st = os.stat(clifn)
+        if (
+            idx.size > 3
+            and idx[-2] == st.st_size
+            and idx[-1] == st.st_mtime_ns
+        ):
+            return idx[:-1]
+    return build_index(clifn)
+
+
+def splice_days(clifn, days, previous=None):
+    """Replace the text of the given days within the climate file.
+
+    Args:
+      clifn (str): the climate file to edit
+      days (dict): date to the full text of that day, ending in a newline
+      previous (dict): when given, filled with date to the replaced text
+
+    Returns:
+      list of dates that were not found in the file and so not edited
+    """
+    idx = load_index(clifn)
+    mi = _monthkey(min(days)) - idx[0]
+    missing = [
+        d for d in days if not 0 <= _monthkey(d) - idx[0] < idx.size - 2
+    ]
+    if len(missing) == len(days):
+        return sorted(missing)
+    # we can not seek before the first month in the file
+    mi = max(mi, 0)
+    pos = int(idx[1 + mi])
+    with open(clifn, "r+b") as fh:
+        fh.seek(pos)
+        blocks = _parse_blocks(fh.read())
+        found = {}
+        for i, block in enumerate(blocks):
+            if block[0] in days:
+                found[block[0]] = i
+                if previous is not None:
+                    previous[block[0]] = block[1].decode("ascii")
+                block[1] = days[block[0]].encode("ascii")
+        missing = sorted(d for d in days if d not in found)
+        if not found:
+            return missing
+        first = min(found.values())
+        start = pos + sum(len(b[1]) for b in blocks[:first])
+        fh.seek(start)
+        fh.write(b"".join(b[1] for b in blocks[first:]))
+        fh.truncate()
+        size = fh.tell()
+    _, offsets = _month_offsets(blocks, pos)
+    save_index(clifn, np.array([*idx[: 1 + mi], *offsets, size], np.int64))
+    return missing
+
+
+def _write_sample(fn, days):
+    """Write a header and some daily data."""
+    with open(fn, "w", encoding="ascii") as fh:
+        fh.write("4.30\n    42.00   -92.51    289    16    2007    16\n")
+        for i in range(days):
+            date = datetime.date(2007, 1, 1) + datetime.timedelta(days=i)
+            fh.write(f"{date.day}\t{date.month}\t{date.year}\t0\t1.0\n")
+
+
+def test_splice_days(tmp_path):
+    """Test that we can splice days and that the index stays valid."""
+    fn = str(tmp_path / "test.cli")
+    _write_sample(fn, 400)
+    with open(fn, encoding="ascii") as fh:
+        orig = fh.read()
+    day = datetime.date(2007, 12, 30)
+    text = "30\t12\t2007\t2\t1.0\n01.0000 0.00\n02.0000 5.00\n"
+    previous = {}
+    assert splice_days(fn, {day: text}, previous) == []
+    assert previous == {day: "30\t12\t2007\t0\t1.0\n"}
+    with open(fn, encoding="ascii") as fh:
+        res = fh.read()
+    assert res == orig.replace("30\t12\t2007\t0\t1.0\n", text)
+    # the saved index must match a fresh build
+    saved = np.fromfile(get_index_fn(fn), np.int64)
+    os.unlink(get_index_fn(fn))
+    assert (saved[:-1] == load_index(fn)).all()
+    # Edit two days and one that does not exist
+    days = {
+        datetime.date(2007, 2, 1): "1\t2\t2007\t0\t2.0\n",
+        datetime.date(2008, 1, 1): "1\t1\t2008\t0\t3.0\n",
+        datetime.date(2010, 1, 1): "1\t1\t2010\t0\t3.0\n",
+    }
+    assert splice_days(fn, days) == [datetime.date(2010, 1, 1)]
+    with open(fn, encoding="ascii") as fh:
+        res2 = fh.read()
+    assert "1\t2\t2007\t0\t2.0\n" in res2
+    assert "1\t1\t2008\t0\t3.0\n" in res2
+    assert text in res2
+
+
+def test_stale_index(tmp_path):
+    """Test that a file changed behind our back gets reindexed."""
+    fn = str(tmp_path / "test.cli")
+    _write_sample(fn, 40)
+    load_index(fn)
+    _write_sample(fn, 70)
+    day = datetime.date(2007, 3, 11)
+    assert splice_days(fn, {day: "11\t3\t2007\t0\t9.0\n"}) == []
+    with open(fn, encoding="ascii") as fh:
+        assert fh.read().endswith("11\t3\t2007\t0\t9.0\n")
+
+
+def test_same_size_edit(tmp_path):
+    """Test that an edit keeping the file size still reindexes."""
+    fn = str(tmp_path / "test.cli")
+    _write_sample(fn, 70)
+    idx = load_index(fn)
+    with open(fn, encoding="ascii") as fh:
+        text = fh.read()
+    # February starts two bytes earlier, the file size is unchanged
+    text = text.replace("31\t1\t2007\t0\t1.0\n", "31\t1\t2007\t0\t1\n")
+    text = text.replace("\n1\t2\t2007\t0\t1.0\n", "\n1\t2\t2007\t0\t1.000\n")
+    with open(fn, "w", encoding="ascii") as fh:
+        fh.write(text)
+    st = os.stat(fn)
+    os.utime(fn, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000))
+    assert os.path.getsize(fn) == idx[-1]
+    assert load_index(fn)[2] == idx[2] - 2
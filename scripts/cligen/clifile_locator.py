@@ -0,0 +1,215 @@
+"""Spatial index of the climate files available for a climate scenario.
+
+Rather than stat'ing candidate filenames around a point, we scan the
+`/i/<scenario>/cli` tree once and keep the coordinates of the files found
+in a KD-tree.  The scan is saved next to the `cli` directory together
+with each directory's mtime, so later refreshes only rescan directories
+that have changed.
+
+Usage:
+    python clifile_locator.py <scenario>
+
+builds or refreshes the index for the climate scenario.
+"""
+import os
+import sys
+
+import numpy as np
+from scipy.spatial import cKDTree
+from pyiem.dep import get_cli_fname
+from pyiem.util import logger
+
+LOG = logger()
+
+
+def get_locator_fn(scenario, basedir="/i"):
+    """Return the filename of the saved index for this scenario."""
+    return f"{basedir}/{scenario}/cli_locator.npz"
+
+
+def parse_cli_fname(fn):
+    """Return the (lon, lat) in hundredths of a degree for a climate file.
+
+    For example `/i/0/cli/092x041/092.30x041.22.cli` is (-9230, 4122).
+    """
+    lon, lat = os.path.basename(fn)[:-4].split("x")
+    return -int(round(float(lon) * 100)), int(round(float(lat) * 100))
+
+
+class ClifileLocator:
+    """Nearest available climate file lookups for a climate scenario."""
+
+    def __init__(self, scenario, basedir="/i"):
+        """Load the saved index for the scenario, if any.
+
+        Args:
+          scenario (int): the climate scenario
+          basedir (str): where the scenario directories live
+        """
+        self.scenario = scenario
+        self.basedir = basedir
+        self.clidir = f"{basedir}/{scenario}/cli"
+        self.dirs = {}  # directory name to mtime_ns when scanned
+        self.points = {}  # directory name to set of (lon, lat)
+        self._tree = None
+        self._coords = None
+        self.load()
+
+    def load(self):
+        """Read the saved index."""
+        fn = get_locator_fn(self.scenario, self.basedir)
+        if not os.path.isfile(fn):
+            return
+        with np.load(fn) as npz:
+            for dirname, mtime in zip(npz["dirs"], npz["mtimes"]):
+                self.dirs[str(dirname)] = int(mtime)
+                self.points[str(dirname)] = set()
+            for diridx, lon, lat in npz["points"]:
+                self.points[str(npz["dirs"][diridx])].add((int(lon), int(lat)))
+        self._tree = None
+
+    def save(self):
+        """Atomically replace the saved index."""
+        dirs = sorted(self.dirs)
+        points = [
+            (i, lon, lat)
+            for i, dirname in enumerate(dirs)
+            for lon, lat in self.points[dirname]
+        ]
+        fn = get_locator_fn(self.scenario, self.basedir)
+        tmpfn = f"{fn}.{os.getpid()}.tmp.npz"
+        np.savez(
+            tmpfn,
+            dirs=np.array(dirs, dtype=str),
+            mtimes=np.array([self.dirs[d] for d in dirs], np.int64),
+            points=np.array(points, np.int32).reshape(-1, 3),
+        )
+        os.replace(tmpfn, fn)
+
+    def refresh(self):
+        """Rescan the directories that changed since the last scan.
+
+        Returns:
+          int number of directories scanned
+        """
+        scanned = 0
+        found = set()
+        with os.scandir(self.clidir) as it:
+            for entry in it:
+                if not entry.is_dir():
+                    continue
+                found.add(entry.name)
+                mtime = entry.stat().st_mtime_ns
+                if self.dirs.get(entry.name) == mtime:
+                    continue
+                self.points[entry.name] = {
+                    parse_cli_fname(fn)
+                    for fn in os.listdir(entry.path)
+                    if fn.endswith(".cli")
+                }
+                self.dirs[entry.name] = mtime
+                scanned += 1
+        for dirname in set(self.dirs) - found:
+            self.dirs.pop(dirname)
+            self.points.pop(dirname)
+        if scanned or len(found) != len(self.dirs):
+            self._tree = None
+        LOG.debug("scanned %s of %s directories", scanned, len(found))
+        return scanned
+
+    def add(self, fn):
+        """Register a climate file that was just created."""
+        dirname = os.path.basename(os.path.dirname(fn))
+        self.points.setdefault(dirname, set()).add(parse_cli_fname(fn))
+        # leave the mtime alone, so the next refresh rescans the directory
+        self.dirs.setdefault(dirname, 0)
+        self._tree = None
+
+    def __contains__(self, fn):
+        """Is this climate file known to exist."""
+        if not fn.startswith(f"{self.clidir}/"):
+            return False
+        dirname = os.path.basename(os.path.dirname(fn))
+        return parse_cli_fname(fn) in self.points.get(dirname, ())
+
+    def __len__(self):
+        """Number of climate files known."""
+        return sum(len(pts) for pts in self.points.values())
+
+    def nearest(self, lon, lat, maxdist=None, p=2):
+        """Find the nearest available climate file.
+
+        Args:
+          lon (float): longitude
+          lat (float): latitude
+          maxdist (int): inclusive limit in hundredths of a degree, default
+            unlimited
+          p (float): the Minkowski norm, np.inf searches a square
+
+        Returns:
+          (filename, xoff, yoff) with the offsets in hundredths of a degree,
+          or (None, None, None) when there is nothing within `maxdist`
+        """
+        if self._tree is None:
+            self._coords = np.array(
+                [pt for pts in self.points.values() for pt in pts], np.int32
+            ).reshape(-1, 2)
+            self._tree = cKDTree(self._coords) if len(self._coords) else None
+        if self._tree is None:
+            return None, None, None
+        x = int(round(lon * 100))
+        y = int(round(lat * 100))
+        # the coordinates are integers, so half a unit makes it inclusive
+        dist, idx = self._tree.query(
+            [x, y],
+            p=p,
+            distance_upper_bound=np.inf if maxdist is None else maxdist + 0.5,
+        )
+        if not np.isfinite(dist):
+            return None, None, None
+        nx, ny = (int(v) for v in self._coords[idx])
+        fn = get_cli_fname(nx / 100.0, ny / 100.0, self.scenario)
+        return fn, nx - x, ny - y
+
+
+def main(argv):
+    """Build or refresh the index."""
+    locator = ClifileLocator(int(argv[1]))
+    scanned = locator.refresh()
+    locator.save()
+    LOG.info("%s files, rescanned %s directories", len(locator), scanned)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
+
+
+def _touch(basedir, lon, lat):
+    """Create an empty climate file."""
+    fn = get_cli_fname(lon, lat, 0).replace("/i", basedir, 1)
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    with open(fn, "w", encoding="ascii"):
+        pass
+    return fn
+
+
+def test_locator(tmp_path):
+    """Test that we find the nearest file and refresh incrementally."""
+    basedir = str(tmp_path)
+    _touch(basedir, -95.0, 42.0)
+    fn = _touch(basedir, -93.5, 41.25)
+    locator = ClifileLocator(0, basedir)
+    assert locator.refresh() == 2
+    assert fn in locator
+    res = locator.nearest(-93.47, 41.3)
+    assert res == (get_cli_fname(-93.5, 41.25, 0), -3, -5)
+    assert locator.nearest(-93.47, 41.3, maxdist=5) == (None, None, None)
+    # the corner of a square is further away than its side
+    assert locator.nearest(-93.47, 41.3, maxdist=5, p=np.inf)[1:] == (-3, -5)
+    locator.save()
+    # A new file is found after a refresh of only its directory
+    _touch(basedir, -93.48, 41.29)
+    locator = ClifileLocator(0, basedir)
+    assert len(locator) == 2
+    assert locator.refresh() == 1
+    assert locator.nearest(-93.47, 41.3)[1:] == (-1, -1)
@@ -0,0 +1,271 @@
+"""Climate scenarios defined as a recipe rather than a copy of the files.
+
+A recipe is a base climate scenario plus a `clifile_transform` chain and
+lives at `/i/<scenario>/cli_recipe.json`.  Nothing is written to the
+scenario's `cli` directory, instead the queue worker derives each climate
+file just before WEPP needs it into local scratch (tmpfs), keeping a
+least recently used cache of the files it generated.
+
+Usage:
+    python clifile_recipe.py <scenario> <base scenario> <chain>
+
+defines the recipe, for example `python clifile_recipe.py 42 0 multiply:1.1`
+"""
+import json
+import os
+import re
+import sys
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from pyiem.util import logger
+from clifile_transform import build_chain, parse_chain, transform_file
+
+LOG = logger()
+CLIFN_RE = re.compile(
+    r"^(?P<basedir>.*)/(?P<scenario>[0-9]+)/cli/(?P<rest>.+)$"
+)
+# The climate file line within a WEPP runfile
+RUNFILE_CLI_RE = re.compile(rb"^(\S+\.cli)$", re.M)
+CACHEDIR = "/dev/shm/dep_cli"
+MEMORY = {"recipes": {}}
+
+
+def get_recipe_fn(scenario, basedir="/i"):
+    """Return the recipe filename for this climate scenario."""
+    return f"{basedir}/{scenario}/cli_recipe.json"
+
+
+def save_recipe(scenario, base, chain, basedir="/i"):
+    """Define the climate scenario as the chain applied to the base."""
+    parse_chain(chain)  # fail early on a typo
+    fn = get_recipe_fn(scenario, basedir)
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    tmpfn = f"{fn}.{os.getpid()}.tmp"
+    with open(tmpfn, "w", encoding="utf-8") as fh:
+        json.dump({"base": int(base), "chain": chain}, fh)
+    os.replace(tmpfn, fn)
+
+
+def load_recipe(scenario, basedir="/i"):
+    """Return the recipe dict of this climate scenario or None.
+
+    Recipes are cached by the file's mtime.
+    """
+    fn = get_recipe_fn(scenario, basedir)
+    try:
+        mtime = os.stat(fn).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    key = (fn, mtime)
+    if key not in MEMORY["recipes"]:
+        with open(fn, encoding="utf-8") as fh:
+            MEMORY["recipes"][key] = json.load(fh)
+    return MEMORY["recipes"][key]
+
+
+def get_scenario_fn(clifn, scenario):
+    """Return the same climate file within another climate scenario."""
+    m = CLIFN_RE.match(clifn)
+    if m is None:
+        return clifn
+    return f"{m['basedir']}/{scenario}/cli/{m['rest']}"
+
+
+class ClifileCache:
+    """LRU cache of the climate files generated from recipes.
+
+    This is shared by the worker threads, an entry is pinned while a run
+    uses it so that it is not evicted underneath WEPP.
+    """
+
+    def __init__(self, cachedir=CACHEDIR, maxfiles=2000):
+        """Constructor.
+
+        Args:
+          cachedir (str): local scratch directory, ideally on tmpfs
+          maxfiles (int): number of generated files to keep around
+        """
+        self.cachedir = cachedir
+        self.maxfiles = maxfiles
+        # clifn to [localfn, pins, lock, version generated from]
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "evictions": 0}
+
+    def _evict(self):
+        """Remove the least recently used unpinned entries, under lock."""
+        for clifn in list(self.entries):
+            if len(self.entries) <= self.maxfiles:
+                break
+            localfn, pins = self.entries[clifn][:2]
+            if pins:
+                continue
+            self.entries.pop(clifn)
+            self.stats["evictions"] += 1
+            try:
+                os.unlink(localfn)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _source(clifn):
+        """Return the (recipe, source file, version) of a climate file.
+
+        The version is the source file's (mtime, size) and the recipe's
+        mtime, a generated file is stale once it changes.  None when the
+        file has no recipe or source.
+        """
+        m = CLIFN_RE.match(clifn)
+        if m is None:
+            return None
+        recipe = load_recipe(m["scenario"], m["basedir"])
+        if recipe is None:
+            return None
+        src = get_scenario_fn(clifn, recipe["base"])
+        try:
+            st = os.stat(src)
+            recipe_mtime = os.stat(
+                get_recipe_fn(m["scenario"], m["basedir"])
+            ).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        return recipe, src, (st.st_mtime_ns, st.st_size, recipe_mtime)
+
+    @staticmethod
+    def _generate(source, localfn):
+        """Derive the climate file from its recipe.
+
+        Returns:
+          bool if the file was generated
+        """
+        recipe, src, _version = source
+        try:
+            transform_file(src, localfn, build_chain(recipe["chain"]))
+        except OSError as exp:
+            LOG.warning("Failed to generate %s: %s", localfn, exp)
+            return False
+        return True
+
+    @contextmanager
+    def open(self, clifn):
+        """Yield a local filename with the content of the climate file.
+
+        Files that exist are used as is, otherwise the file is generated
+        from the scenario's recipe, again once the source file or recipe
+        changed.  If neither, the filename is yielded unchanged and WEPP
+        will fail as it always did.
+        """
+        if os.path.isfile(clifn):
+            yield clifn
+            return
+        with self.lock:
+            entry = self.entries.get(clifn)
+            if entry is None:
+                m = CLIFN_RE.match(clifn)
+                localfn = (
+                    f"{self.cachedir}/{m['scenario'] if m else 'x'}/"
+                    f"{os.path.basename(clifn)}"
+                )
+                entry = [localfn, 0, threading.Lock(), None]
+                self.entries[clifn] = entry
+            self.entries.move_to_end(clifn)
+            entry[1] += 1
+        outcome = None
+        try:
+            # only one thread generates a given file
+            with entry[2]:
+                source = self._source(clifn)
+                if source is None:
+                    pass
+                elif entry[3] == source[2] and os.path.isfile(entry[0]):
+                    outcome = "hits"
+                elif self._generate(source, entry[0]):
+                    # replaced atomically, running WEPPs keep the old file
+                    outcome = "misses" if entry[3] is None else "stale"
+                    entry[3] = source[2]
+            yield clifn if outcome is None else entry[0]
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if outcome is None:
+                    if not entry[1]:
+                        self.entries.pop(clifn, None)
+                else:
+                    self.stats[outcome] += 1
+                self._evict()
+
+    @contextmanager
+    def runfile(self, rundata):
+        """Yield the WEPP runfile bytes pointing at a usable climate file."""
+        m = RUNFILE_CLI_RE.search(rundata)
+        if m is None:
+            yield rundata
+            return
+        clifn = m.group(1).decode("ascii")
+        with self.open(clifn) as localfn:
+            if localfn != clifn:
+                rundata = (
+                    rundata[: m.start(1)]
+                    + localfn.encode("ascii")
+                    + rundata[m.end(1) :]
+                )
+            yield rundata
+
+
+def main(argv):
+    """Define a recipe."""
+    save_recipe(int(argv[1]), int(argv[2]), argv[3])
+    LOG.info("climate scenario %s is %s of %s", argv[1], argv[3], argv[2])
+
+
+if __name__ == "__main__":
+    main(sys.argv)
+
+
+def test_cache(tmp_path):
+    """Test that climate files are generated, reused and evicted."""
+    basedir = str(tmp_path / "i")
+    src = f"{basedir}/0/cli/092x041/092.30x041.22.cli"
+    os.makedirs(os.path.dirname(src))
+    with open(src, "w", encoding="ascii") as fh:
+        fh.write("\n" * 15 + "1\t3\t2007\t2\t1\t1\t1\t1\t0\t1\n1.0 0.0\n")
+        fh.write("2.0 10.0\n")
+    save_recipe(5, 0, "multiply:2", basedir)
+    assert load_recipe(6, basedir) is None
+    cache = ClifileCache(str(tmp_path / "shm"), maxfiles=1)
+    rundata = f"E\nYes\n{get_scenario_fn(src, 5)}\nsoil.sol\n".encode()
+    with cache.runfile(rundata) as newdata:
+        localfn = newdata.split(b"\n")[2].decode()
+        assert localfn == str(tmp_path / "shm" / "5" / "092.30x041.22.cli")
+        with open(localfn, encoding="ascii") as fh:
+            assert fh.read().endswith("2.0000 20.00\n")
+    with cache.open(get_scenario_fn(src, 5)):
+        pass
+    assert cache.stats["hits"] == 1 and cache.stats["misses"] == 1
+    # Existing files and scenarios without a recipe pass through
+    with cache.open(src) as fn:
+        assert fn == src
+    with cache.open(get_scenario_fn(src, 6)) as fn:
+        assert fn == get_scenario_fn(src, 6)
+    assert os.path.isfile(localfn)
+    save_recipe(7, 0, "shift:1", basedir)
+    with cache.open(get_scenario_fn(src, 7)):
+        pass
+    assert not os.path.isfile(localfn)
+    assert cache.stats["evictions"] == 1
+    # An edit of the source file regenerates the derived file
+    with cache.open(get_scenario_fn(src, 7)):
+        pass
+    assert cache.stats["hits"] == 2
+    with open(src, encoding="ascii") as fh:
+        text = fh.read()
+    with open(src, "w", encoding="ascii") as fh:
+        fh.write(text.replace("10.0", "11.0"))
+    st = os.stat(src)
+    os.utime(src, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000))
+    with cache.open(get_scenario_fn(src, 7)) as fn:
+        with open(fn, encoding="ascii") as fh:
+            assert fh.read().endswith("2.0 11.0\n")
+    assert cache.stats["stale"] == 1
@@ -0,0 +1,264 @@
+"""Yearly R-factor of climate files, cached by file and year.
+
+Every day's EI30 is computed at once from the breakpoints of a year, with
+the same 30 minute binning as `pyiem.dep.rfactor`.  The yearly totals are
+kept in a table with a CRC of each year's text, so that after a nightly
+edit only the years whose text changed are recomputed and files that were
+not modified at all are not read.
+
+Usage:
+    python clifile_rfactor.py <scenario>
+
+updates `/i/<scenario>/cli_rfactor.parquet` for the scenario.
+"""
+import os
+import re
+import sys
+import time
+import zlib
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from pyiem.util import logger
+
+LOG = logger()
+YEAR_RE = re.compile(rb"^1\t1\t([0-9]{4})\t", re.M)
+BINS = np.arange(0, 24.01, 0.5)
+# 3 inch per hour cap of the peak 30 minute intensity
+IMAX = 3.0 * 25.4
+COLUMNS = ["filename", "mtime_ns", "size", "year", "crc", "rfactor", "events"]
+
+
+def get_cache_fn(scenario, basedir="/i"):
+    """Return the cache table filename for this scenario."""
+    return f"{basedir}/{scenario}/cli_rfactor.parquet"
+
+
+def compute_ei30(text):
+    """Compute the daily EI30 of the climate file days.
+
+    Args:
+      text (bytes): day lines and their breakpoints
+
+    Returns:
+      np.ndarray of the EI30 (MJ mm ha-1 h-1) of each day with breakpoints
+    """
+    lines = np.array(text.split(b"\n"))
+    lines = lines[np.char.str_len(np.char.strip(lines)) > 0]
+    isday = np.char.find(lines, b"\t") >= 0
+    dayidx = np.cumsum(isday)[~isday] - 1
+    if not len(dayidx):
+        return np.zeros(0)
+    bp = np.array(list(map(float, b" ".join(lines[~isday]).split())))
+    times = bp[0::2]
+    accum = bp[1::2]
+    # Lay the days out 48 hours apart on one axis, so a single interp
+    # handles them all, days without breakpoints drop out
+    days, start, counts = np.unique(
+        dayidx, return_index=True, return_counts=True
+    )
+    offset = np.concatenate([[0], np.cumsum(accum[start + counts - 1])])
+    # The accumulation is flat between days, a point just before the first
+    # breakpoint keeps a non-zero first accumulation within its own day
+    xp = np.concatenate(
+        [days * 48.0 + times[start] - 1e-6, dayidx * 48.0 + times]
+    )
+    fp = np.concatenate([offset[:-1], offset[np.searchsorted(days, dayidx)]])
+    fp[len(days) :] += accum
+    order = np.argsort(xp, kind="stable")
+    grid = np.interp(
+        days[:, None] * 48.0 + BINS[None, :], xp[order], fp[order]
+    )
+    rate_mmhr = np.diff(grid, axis=1) * 2.0
+    e_r = 0.29 * (1.0 - 0.72 * np.exp(-0.082 * rate_mmhr))
+    energy = np.sum(e_r * rate_mmhr / 2.0, axis=1)
+    return energy * np.minimum(rate_mmhr.max(axis=1), IMAX)
+
+
+def compute_file(fn, cached=None):
+    """Compute the yearly R-factor of a climate file.
+
+    Args:
+      fn (str): the climate file
+      cached (pd.DataFrame): previous rows of this file, if any
+
+    Returns:
+      list of row tuples following `COLUMNS`
+    """
+    st = os.stat(fn)
+    if (
+        cached is not None
+        and len(cached.index) > 0
+        and cached["mtime_ns"].iloc[0] == st.st_mtime_ns
+        and cached["size"].iloc[0] == st.st_size
+    ):
+        return list(cached[COLUMNS].itertuples(index=False, name=None))
+    previous = {}
+    if cached is not None:
+        previous = {
+            (row.year, row.crc): (row.rfactor, row.events)
+            for row in cached.itertuples()
+        }
+    with open(fn, "rb") as fh:
+        data = fh.read()
+    starts = [(int(m.group(1)), m.start()) for m in YEAR_RE.finditer(data)]
+    rows = []
+    for i, (year, pos) in enumerate(starts):
+        end = starts[i + 1][1] if i + 1 < len(starts) else len(data)
+        text = data[pos:end]
+        crc = zlib.crc32(text)
+        if (year, crc) in previous:
+            rfactor, events = previous[(year, crc)]
+        else:
+            ei30 = compute_ei30(text)
+            rfactor, events = float(ei30.sum()), int((ei30 > 0).sum())
+        rows.append(
+            (fn, st.st_mtime_ns, st.st_size, year, crc, rfactor, events)
+        )
+    return rows
+
+
+def _worker(arg):
+    """Run compute_file within the pool, never raise."""
+    try:
+        return compute_file(*arg)
+    except Exception as exp:  # pylint: disable=broad-except
+        LOG.warning("%s failed: %s", arg[0], exp)
+        return []
+
+
+def read_cache(fn):
+    """Return the cache table, empty if it does not exist."""
+    if not os.path.isfile(fn):
+        return pd.DataFrame(columns=COLUMNS)
+    return pd.read_parquet(fn)
+
+
+def update(fns, cachefn, processes=None):
+    """Compute the yearly R-factor of the climate files, using the cache.
+
+    Args:
+      fns (list): climate files
+      cachefn (str): the cache table, which is updated
+      processes (int): the pool size, defaults to the CPU count
+
+    Returns:
+      pd.DataFrame with one row per file and year
+    """
+    sts = time.time()
+    cache = read_cache(cachefn)
+    groups = dict(tuple(cache.groupby("filename")))
+    rows = []
+    with Pool(processes) as pool:
+        for res in tqdm(
+            pool.imap_unordered(
+                _worker, [(fn, groups.get(fn)) for fn in fns], chunksize=64
+            ),
+            total=len(fns),
+            disable=not sys.stdout.isatty(),
+        ):
+            rows.extend(res)
+    df = pd.DataFrame(rows, columns=COLUMNS)
+    # keep the cached files we were not asked about this time
+    df = pd.concat(
+        [cache[~cache["filename"].isin(fns)], df], ignore_index=True
+    ).sort_values(["filename", "year"])
+    tmpfn = f"{cachefn}.{os.getpid()}.tmp"
+    df.to_parquet(tmpfn, index=False)
+    os.replace(tmpfn, cachefn)
+    LOG.info("%s files in %.1fs", len(fns), time.time() - sts)
+    return df[df["filename"].isin(fns)]
+
+
+def find_files(clidir):
+    """Return the climate files within the directory."""
+    res = []
+    with os.scandir(clidir) as it:
+        for entry in it:
+            if not entry.is_dir():
+                continue
+            with os.scandir(entry.path) as it2:
+                res.extend(e.path for e in it2 if e.name.endswith(".cli"))
+    return res
+
+
+def main(argv):
+    """Update the cache for a scenario."""
+    scenario = int(argv[1])
+    update(find_files(f"/i/{scenario}/cli"), get_cache_fn(scenario))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
+
+
+def _reference_rfactor(times, points):
+    """The per day loop of pyiem.dep.rfactor."""
+    if not times:
+        return 0
+    accum = np.interp(BINS, times, points, left=0, right=points[-1])
+    rate_mmhr = (accum[1:] - accum[0:-1]) * 2.0
+    e_r = 0.29 * (1.0 - 0.72 * np.exp(-0.082 * rate_mmhr))
+    return np.sum(e_r * rate_mmhr / 2.0) * min(IMAX, np.max(rate_mmhr))
+
+
+def test_compute_ei30():
+    """Test that we match the per day computation."""
+    fn = os.path.join(
+        os.path.dirname(__file__),
+        "../../src/regression_tests/common/092.51x042.00.cli",
+    )
+    with open(fn, "rb") as fh:
+        lines = fh.read().decode("ascii").split("\n")[15:]
+    expected = []
+    linenum = 0
+    while linenum < len(lines):
+        if not lines[linenum].strip():
+            linenum += 1
+            continue
+        breakpoints = int(lines[linenum].split()[3])
+        bps = [
+            [float(x) for x in line.split()]
+            for line in lines[linenum + 1 : linenum + 1 + breakpoints]
+        ]
+        if bps:
+            expected.append(
+                _reference_rfactor([x[0] for x in bps], [x[1] for x in bps])
+            )
+        linenum += breakpoints + 1
+    ei30 = compute_ei30("\n".join(lines).encode("ascii"))
+    np.testing.assert_allclose(ei30, expected, rtol=1e-6, atol=1e-6)
+
+
+def test_cache(tmp_path):
+    """Test that only changed years are recomputed."""
+    src = os.path.join(
+        os.path.dirname(__file__),
+        "../../src/regression_tests/common/092.51x042.00.cli",
+    )
+    fn = str(tmp_path / "test.cli")
+    with open(src, "rb") as fh:
+        data = fh.read()
+    with open(fn, "wb") as fh:
+        fh.write(data)
+    cachefn = str(tmp_path / "cache.parquet")
+    df = update([fn], cachefn, 1)
+    assert len(df.index) == 16
+    assert (df["rfactor"] > 0).all()
+    # Double the 2022 precip, the other years come from the cache
+    pos = data.index(b"1\t1\t2022\t")
+    head, tail = data[:pos], data[pos:].decode("ascii").split("\n")
+    tail = [
+        f"{x.split()[0]} {float(x.split()[1]) * 2:.2f}"
+        if x and "\t" not in x
+        else x
+        for x in tail
+    ]
+    with open(fn, "wb") as fh:
+        fh.write(head + "\n".join(tail).encode("ascii"))
+    df2 = update([fn], cachefn, 1).set_index("year")
+    df = df.set_index("year")
+    assert (df2.loc[:2021, "rfactor"] == df.loc[:2021, "rfactor"]).all()
+    assert df2.at[2022, "rfactor"] > df.at[2022, "rfactor"]
@@ -0,0 +1,153 @@
+"""Content addressed storage for seeded climate files.
+
+Seeding an expanded domain copies a few source climate files to many new
+locations.  Instead, one read-only copy of each distinct content is kept in
+`/i/<scenario>/cli_store` and hardlinked (or reflinked when the hardlink
+limit is hit) into place.  Anything editing a climate file in place must
+first call `break_link`, so that the edit is not seen by every location
+sharing the content.
+
+Usage:
+    python clifile_store.py <scenario>
+
+removes store entries that are no longer linked to any climate file.
+"""
+import fcntl
+import hashlib
+import os
+import shutil
+import sys
+
+from pyiem.util import logger
+
+LOG = logger()
+# linux ioctl to clone a file's extents, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+MEMORY = {"digests": {}}
+
+
+def get_store_dir(clifn):
+    """Return the store directory on the same filesystem as the file.
+
+    For example `/i/0/cli/092x041/092.30x041.22.cli` uses `/i/0/cli_store`.
+    """
+    scenariodir = os.path.dirname(os.path.dirname(os.path.dirname(clifn)))
+    return f"{scenariodir}/cli_store"
+
+
+def file_digest(fn):
+    """Return the sha256 hexdigest of the file, cached by mtime and size."""
+    st = os.stat(fn)
+    key = (fn, st.st_mtime_ns, st.st_size)
+    if key not in MEMORY["digests"]:
+        digest = hashlib.sha256()
+        with open(fn, "rb") as fh:
+            for block in iter(lambda: fh.read(1024 * 1024), b""):
+                digest.update(block)
+        MEMORY["digests"][key] = digest.hexdigest()
+    return MEMORY["digests"][key]
+
+
+def _clone(src, dst):
+    """Copy the file, as a copy-on-write reflink when supported."""
+    with open(src, "rb") as sfh, open(dst, "wb") as dfh:
+        try:
+            fcntl.ioctl(dfh.fileno(), FICLONE, sfh.fileno())
+            return
+        except OSError:
+            pass
+        shutil.copyfileobj(sfh, dfh)
+
+
+def store_clifile(src, storedir):
+    """Return the store filename holding the content of src, adding it."""
+    digest = file_digest(src)
+    storefn = f"{storedir}/{digest[:2]}/{digest}.cli"
+    if not os.path.isfile(storefn):
+        os.makedirs(os.path.dirname(storefn), exist_ok=True)
+        tmpfn = f"{storefn}.{os.getpid()}.tmp"
+        _clone(src, tmpfn)
+        # read-only, an in-place edit without break_link should fail
+        os.chmod(tmpfn, 0o444)
+        os.replace(tmpfn, storefn)
+    return storefn
+
+
+def seed_clifile(src, dst):
+    """Put the content of src at dst, sharing storage with other copies."""
+    storefn = store_clifile(src, get_store_dir(dst))
+    tmpfn = f"{dst}.{os.getpid()}.tmp"
+    try:
+        os.link(storefn, tmpfn)
+    except OSError as exp:
+        # Likely too many links, the clone is still copy-on-write on btrfs
+        # and xfs
+        LOG.debug("link %s failed: %s", storefn, exp)
+        _clone(storefn, tmpfn)
+        os.chmod(tmpfn, 0o644)
+    os.replace(tmpfn, dst)
+
+
+def break_link(clifn):
+    """Give the climate file its own copy, if shared, prior to editing.
+
+    Returns:
+      bool if a copy was made
+    """
+    if os.stat(clifn).st_nlink < 2:
+        return False
+    tmpfn = f"{clifn}.{os.getpid()}.tmp"
+    _clone(clifn, tmpfn)
+    os.chmod(tmpfn, 0o644)
+    os.replace(tmpfn, clifn)
+    return True
+
+
+def prune_store(storedir):
+    """Remove the store entries no climate file links to anymore.
+
+    Returns:
+      int number of entries removed
+    """
+    removed = 0
+    for root, _dirs, files in os.walk(storedir):
+        for fn in files:
+            path = os.path.join(root, fn)
+            if os.stat(path).st_nlink == 1:
+                os.unlink(path)
+                removed += 1
+    return removed
+
+
+def main(argv):
+    """Prune the store for a scenario."""
+    storedir = f"/i/{argv[1]}/cli_store"
+    LOG.info("removed %s unused entries", prune_store(storedir))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
+
+
+def test_seed_and_break(tmp_path):
+    """Test that seeded files share storage until edited."""
+    src = tmp_path / "src.cli"
+    src.write_text("4.30\n1\t1\t2007\t0\n")
+    clidir = tmp_path / "0" / "cli" / "092x041"
+    clidir.mkdir(parents=True)
+    fn1 = str(clidir / "092.30x041.22.cli")
+    fn2 = str(clidir / "092.31x041.22.cli")
+    seed_clifile(str(src), fn1)
+    seed_clifile(str(src), fn2)
+    assert os.stat(fn1).st_ino == os.stat(fn2).st_ino
+    storedir = get_store_dir(fn1)
+    assert storedir == str(tmp_path / "0" / "cli_store")
+    assert break_link(fn1)
+    assert not break_link(fn1)
+    with open(fn1, "a", encoding="ascii") as fh:
+        fh.write("2\t1\t2007\t0\n")
+    with open(fn2, encoding="ascii") as fh:
+        assert fh.read() == src.read_text()
+    assert prune_store(storedir) == 0
+    os.unlink(fn2)
+    assert prune_store(storedir) == 1
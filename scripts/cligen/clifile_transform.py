@@ -0,0 +1,389 @@
+"""Streaming transforms of climate files into a derived climate scenario.
+
+A climate file is parsed once into its 15 header lines and a list of
+`Day` records holding the tab delimited day line tokens and the breakpoint
+lines.  A chain of transforms is applied to the days and the result is
+written out in one buffered write, with files spread over a process pool.
+
+Transforms are named in a chain like `multiply:1.1,shift:3`, see
+`TRANSFORMS` for what is available.
+
+Usage:
+    python clifile_transform.py <src scenario> <dst scenario> <chain>
+
+derives every climate file of the source scenario.
+"""
+import datetime
+import os
+import random
+import sys
+import time
+import zlib
+from multiprocessing import Pool
+
+from tqdm import tqdm
+from pyiem.util import logger
+
+LOG = logger()
+HEADER_LINES = 15
+# 1 inch per hour over one hour
+STORM = ["12.00 0.00", "12.25 6.35", "12.50 12.70", "12.75 19.05"]
+STORM.append("13.00 25.40")
+
+
+class Day:
+    """One day of a climate file."""
+
+    __slots__ = ("date", "tokens", "bplines")
+
+    def __init__(self, date, tokens, bplines):
+        """Constructor.
+
+        Args:
+          date (datetime.date): the date
+          tokens (list): the tab delimited day line tokens
+          bplines (list): the breakpoint lines without line endings
+        """
+        self.date = date
+        self.tokens = tokens
+        self.bplines = bplines
+
+    def get_breakpoints(self):
+        """Return the (times, accum) float lists of the breakpoints."""
+        times = []
+        accum = []
+        for line in self.bplines:
+            tokens = line.split()
+            times.append(float(tokens[0]))
+            accum.append(float(tokens[1]))
+        return times, accum
+
+    def set_breakpoints(self, times, accum):
+        """Replace the breakpoints."""
+        self.bplines = [f"{t:.4f} {a:.2f}" for t, a in zip(times, accum)]
+        self.tokens[3] = str(len(self.bplines))
+
+    def copy(self, date=None):
+        """Return a copy of the day, optionally for another date."""
+        res = Day(self.date, list(self.tokens), list(self.bplines))
+        if date is not None:
+            res.date = date
+            res.tokens[0:3] = [str(date.day), str(date.month), str(date.year)]
+        return res
+
+    def text(self):
+        """Return the text of the day."""
+        return "".join(
+            ["\t".join(self.tokens), "\n"]
+            + [f"{line}\n" for line in self.bplines]
+        )
+
+
+def parse_clifile(text):
+    """Parse climate file text into (header lines, list of Day)."""
+    lines = text.split("\n")
+    header = lines[:HEADER_LINES]
+    days = []
+    linenum = HEADER_LINES
+    size = len(lines)
+    while linenum < size:
+        line = lines[linenum].strip()
+        linenum += 1
+        if not line:
+            continue
+        tokens = line.split("\t")
+        breakpoints = int(tokens[3])
+        days.append(
+            Day(
+                datetime.date(int(tokens[2]), int(tokens[1]), int(tokens[0])),
+                tokens,
+                [x.strip() for x in lines[linenum : linenum + breakpoints]],
+            )
+        )
+        linenum += breakpoints
+    return header, days
+
+
+def format_clifile(header, days):
+    """Return the climate file text."""
+    return "".join([f"{line}\n" for line in header] + [d.text() for d in days])
+
+
+def conservative_adjust(times, accum, multipler):
+    """Adjust times to conserve precip, but change intensity, tricky."""
+    # We can't adjust by more than 50%
+    assert 0.5 < multipler < 1.5
+    # If this was a drizzle event, do nothing.
+    if accum[-1] < 5:
+        return times
+    # An algorithm was attempted whereby the peak rate was modified, this
+    # yielded no meaningful change.
+    # Attempt 2: Take a blunt hammer to the time axis.
+    # sometimes there is a danagling midnight
+    if times[-1] > 23.95 and times[-2] < 23:
+        times[-1] = times[-2] + 0.1
+    newtimes = [0]
+    for i in range(1, len(times)):
+        dt = times[i] - times[i - 1]
+        rate = (accum[i] - accum[i - 1]) / dt
+        # only modify rates over 22mm/hr
+        if rate > 22:
+            newtimes.append(newtimes[-1] + dt / multipler)
+        else:
+            newtimes.append(newtimes[-1] + dt)
+    # algo-fail
+    if newtimes[-1] >= 23.99:
+        return times
+    return newtimes
+
+
+def multiply(multiplier):
+    """Multiply the breakpoint accumulations."""
+    multiplier = float(multiplier)
+
+    def _transform(_fn, days):
+        for day in days:
+            if day.bplines:
+                times, accum = day.get_breakpoints()
+                day.set_breakpoints(times, [x * multiplier for x in accum])
+        return days
+
+    return _transform
+
+
+def stretch(multiplier):
+    """Conserve the daily totals, but stretch the time of intense rates."""
+    multiplier = float(multiplier)
+
+    def _transform(_fn, days):
+        for day in days:
+            if day.bplines:
+                times, accum = day.get_breakpoints()
+                times = conservative_adjust(times, accum, multiplier)
+                day.set_breakpoints(times, accum)
+        return days
+
+    return _transform
+
+
+def shift(dayshift, floor="2007-01-01", ceiling="2020-12-31"):
+    """Shift the days by `dayshift` within the floor and ceiling dates.
+
+    The first (last) day is replicated when shifting forward (backward),
+    days shifted outside of the period are dropped.
+    """
+    dayshift = int(dayshift)
+    floor = datetime.date.fromisoformat(floor)
+    ceiling = datetime.date.fromisoformat(ceiling)
+
+    def _transform(_fn, days):
+        res = []
+        for day in days:
+            newvalid = day.date + datetime.timedelta(days=dayshift)
+            if newvalid < floor or newvalid > ceiling:
+                continue
+            if day.date == floor and dayshift > 0:
+                for i in range(dayshift):
+                    res.append(day.copy(floor + datetime.timedelta(days=i)))
+            res.append(day.copy(newvalid))
+            if day.date == ceiling and dayshift < 0:
+                for i in range(dayshift + 1, 1):
+                    res.append(day.copy(ceiling + datetime.timedelta(days=i)))
+        return res
+
+    return _transform
+
+
+def storms(numstorms):
+    """Add one inch per hour storms on dry and warm spring days.
+
+    The days are chosen at random for each year, seeded by the filename so
+    that a file is always derived the same way.
+    """
+    numstorms = int(numstorms)
+
+    def _transform(fn, days):
+        rng = random.Random(zlib.crc32(os.path.basename(fn).encode()))
+        candidates = {}
+        for day in days:
+            if (
+                day.date.month in [3, 4, 5]
+                and not day.bplines
+                and float(day.tokens[5]) > 0
+            ):
+                candidates.setdefault(day.date.year, []).append(day)
+        for year in sorted(candidates):
+            for day in rng.sample(candidates[year], numstorms):
+                day.bplines = list(STORM)
+                day.tokens[3] = str(len(STORM))
+        return days
+
+    return _transform
+
+
+TRANSFORMS = {
+    "multiply": multiply,
+    "stretch": stretch,
+    "shift": shift,
+    "storms": storms,
+}
+
+
+def parse_chain(chain):
+    """Parse `name:arg:arg,name:arg` into a list of (name, args)."""
+    res = []
+    for part in chain.split(","):
+        tokens = part.strip().split(":")
+        if tokens[0] not in TRANSFORMS:
+            raise ValueError(f"Unknown transform {tokens[0]}")
+        res.append((tokens[0], tuple(tokens[1:])))
+    return res
+
+
+def build_chain(spec):
+    """Return the transform callables for a chain string or parsed list."""
+    if isinstance(spec, str):
+        spec = parse_chain(spec)
+    return [TRANSFORMS[name](*args) for name, args in spec]
+
+
+def transform_file(src, dst, chain):
+    """Derive the dst climate file from the src one.
+
+    Args:
+      src (str): the source climate file
+      dst (str): the climate file to write, atomically
+      chain (list): transform callables from `build_chain`
+
+    Returns:
+      (bytes read, bytes written)
+    """
+    with open(src, encoding="ascii") as fh:
+        text = fh.read()
+    header, days = parse_clifile(text)
+    for transform in chain:
+        days = transform(src, days)
+    result = format_clifile(header, days)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmpfn = f"{dst}.{os.getpid()}.tmp"
+    with open(tmpfn, "w", encoding="ascii", buffering=1024 * 1024) as fh:
+        fh.write(result)
+    os.replace(tmpfn, dst)
+    return len(text), len(result)
+
+
+def _worker(arg):
+    """Run a job within the pool, never raise."""
+    src, dst, spec = arg
+    try:
+        return transform_file(src, dst, build_chain(spec))
+    except Exception as exp:  # pylint: disable=broad-except
+        LOG.warning("%s -> %s failed: %s", src, dst, exp)
+        return None
+
+
+def run(jobs, spec, processes=None):
+    """Derive the climate files over a process pool.
+
+    Args:
+      jobs (list): (src, dst) filename pairs
+      spec (str or list): the transform chain
+      processes (int): the pool size, defaults to the CPU count
+
+    Returns:
+      int number of files that failed
+    """
+    if isinstance(spec, str):
+        spec = parse_chain(spec)
+    sts = time.time()
+    failed = 0
+    nbytes = 0
+    args = [(src, dst, spec) for src, dst in jobs]
+    with Pool(processes) as pool:
+        progress = tqdm(
+            pool.imap_unordered(_worker, args, chunksize=64),
+            total=len(args),
+            disable=not sys.stdout.isatty(),
+        )
+        for res in progress:
+            if res is None:
+                failed += 1
+                continue
+            nbytes += res[1]
+    elapsed = max(time.time() - sts, 1e-6)
+    LOG.info(
+        "%s files (%s failed) in %.1fs, %.1f files/s %.1f MB/s written",
+        len(args),
+        failed,
+        elapsed,
+        len(args) / elapsed,
+        nbytes / elapsed / 1e6,
+    )
+    return failed
+
+
+def find_jobs(src_scenario, dst_scenario, basedir="/i"):
+    """Return (src, dst) for all climate files of the source scenario."""
+    res = []
+    srcdir = f"{basedir}/{src_scenario}/cli"
+    for dirname, _dirpath, filenames in os.walk(srcdir):
+        for fn in filenames:
+            if not fn.endswith(".cli"):
+                continue
+            src = f"{dirname}/{fn}"
+            dst = src.replace(
+                f"{basedir}/{src_scenario}/", f"{basedir}/{dst_scenario}/", 1
+            )
+            res.append((src, dst))
+    return res
+
+
+def main(argv):
+    """Go Main Go."""
+    jobs = find_jobs(int(argv[1]), int(argv[2]))
+    sys.exit(1 if run(jobs, argv[3]) else 0)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
+
+
+SAMPLE = "\n".join(
+    ["header"] * HEADER_LINES
+    + [
+        "1\t3\t2007\t0\t10.0\t2.0\t 200\t 3.0\t0\t 1.0",
+        "2\t3\t2007\t2\t10.0\t-2.0\t 200\t 3.0\t0\t 1.0",
+        "01.0000 0.00",
+        "02.0000 30.00",
+        "3\t3\t2007\t0\t10.0\t3.0\t 200\t 3.0\t0\t 1.0",
+        "",
+    ]
+)
+
+
+def test_roundtrip():
+    """Test that no transforms gives back the same text."""
+    header, days = parse_clifile(SAMPLE)
+    assert len(days) == 3
+    assert format_clifile(header, days) == SAMPLE
+
+
+def test_transforms(tmp_path):
+    """Test a chain of transforms."""
+    src = tmp_path / "0" / "cli" / "092x041" / "092.30x041.22.cli"
+    src.parent.mkdir(parents=True)
+    src.write_text(SAMPLE)
+    jobs = find_jobs(0, 5, str(tmp_path))
+    assert run(jobs, "multiply:1.5,shift:1:2007-03-01:2007-03-03", 1) == 0
+    with open(jobs[0][1], encoding="ascii") as fh:
+        _, days = parse_clifile(fh.read())
+    assert [d.date.day for d in days] == [1, 2, 3]
+    assert days[0].bplines == []
+    assert days[2].bplines == ["1.0000 0.00", "2.0000 45.00"]
+    chain = build_chain("storms:1,stretch:0.8")
+    _, days = parse_clifile(SAMPLE)
+    for transform in chain:
+        days = transform(str(src), days)
+    # only two days were dry and warm
+    assert sum(d.tokens[3] == "5" for d in days) == 1
+    assert days[1].get_breakpoints() == ([0.0, 1.25], [0.0, 30.0])
@@ -2,7 +2,10 @@
 
 Usage:
     python daily_climate_editor.py <xtile> <ytile> <tilesz>
-        <scenario> <YYYY> <mm> <dd>
+        <scenario> <YYYY> <mm> <dd> [<YYYY> <mm> <dd>]
+
+The optional second date makes an inclusive backfill range, each climate
+file is then only rewritten once for all of the days.
 
 Where tiles start in the lower left corner and are 5x5 deg in size
 
@@ -15,29 +18,49 @@ except ImportError:
     from backports.zoneinfo import ZoneInfo  # type: ignore
 from collections import namedtuple
 import datetime
+import hashlib
+import heapq
 import sys
 import os
+import threading
+import time
+import traceback
 from multiprocessing import cpu_count
 from multiprocessing.pool import ThreadPool
+from queue import Queue
 
 from tqdm import tqdm
 import numpy as np
-from scipy.interpolate import NearestNDInterpolator
+from scipy.spatial import cKDTree
 from osgeo import gdal
 from pyiem import iemre
 from pyiem.dep import SOUTH, WEST, NORTH, EAST, get_cli_fname
 from pyiem.util import ncopen, logger, convert_value, utc
+from clifile_dirty import is_material, write_dirty
+from clifile_index import splice_days
+from clifile_store import break_link
+from sparse_precip import SparsePrecip
 
 LOG = logger()
 CENTRAL = ZoneInfo("America/Chicago")
 UTC = datetime.timezone.utc
 ST4PATH = "/mesonet/data/stage4"
+# Where the proctor leaves the day-level a2m cube shared by the tiles
+SCRATCHDIR = "/mnt/idep2/data/dailyprecip/scratch"
+# Persistent nearest neighbour gather indices, see get_regrid_index
+REGRIDDIR = "/mnt/idep2/data/regrid_cache"
+# Degrees of padding for windowed source reads, larger than Stage IV and
+# IEMRE grid spacing so nearest neighbour lookups are not impacted
+WINDOW_HALO = 0.5
 # used for breakpoint logic
 ZEROHOUR = datetime.datetime(2000, 1, 1, 0, 0)
 # How many CPUs are we going to burn
 CPUCOUNT = min([4, int(cpu_count() / 4)])
-MEMORY = {"stamp": datetime.datetime.now()}
+MEMORY = {"stamp": datetime.datetime.now(), "regrid": {}, "day_inputs": {}}
 BOUNDS = namedtuple("Bounds", ["south", "north", "east", "west"])
+BREAKPOINTS = namedtuple(
+    "Breakpoints", ["shape", "ptr", "tidx", "accum", "timestrs"]
+)
 
 
 def check_has_clifiles(bounds: BOUNDS):
@@ -96,78 +119,146 @@ def iemre_bounds_check(name, val, lower, upper):
     return val
 
 
-def load_iemre(nc, data, valid):
-    """Use IEM Reanalysis for non-precip data
+def get_regrid_index(src_lons, src_lats, lons, lats):
+    """Return the nearest source grid flat index for each target point.
 
-    24km product is smoothed down to the 0.01 degree grid
+    This is what NearestNDInterpolator would find, but the KD-tree build and
+    query is only done once per (source grid, target grid) pair.  The result
+    is cached in memory and on disk, after which regridding a variable is a
+    single fancy indexing operation.
+
+    Args:
+      src_lons, src_lats (np.ndarray): source grid coordinates
+      lons, lats (np.ndarray): target grid coordinates
+
+    Returns:
+      np.ndarray of the same shape as `lons`
+    """
+    src_lons = np.asarray(src_lons, np.float64)
+    src_lats = np.asarray(src_lats, np.float64)
+    lons = np.asarray(lons, np.float64)
+    lats = np.asarray(lats, np.float64)
+    hasher = hashlib.sha1()
+    for arr in (src_lons, src_lats, lons, lats):
+        hasher.update(str(arr.shape).encode("ascii"))
+        hasher.update(np.ascontiguousarray(arr).tobytes())
+    key = hasher.hexdigest()
+    if key in MEMORY["regrid"]:
+        return MEMORY["regrid"][key]
+    fn = f"{REGRIDDIR}/{key}.npy"
+    if os.path.isfile(fn):
+        idx = np.load(fn)
+    else:
+        LOG.debug("computing regrid index %s", fn)
+        tree = cKDTree(np.c_[np.ravel(src_lons), np.ravel(src_lats)])
+        _, idx = tree.query(np.c_[np.ravel(lons), np.ravel(lats)])
+        idx = idx.reshape(lons.shape).astype(np.int32)
+        try:
+            os.makedirs(REGRIDDIR, exist_ok=True)
+            tmpfn = f"{REGRIDDIR}/{key}.{os.getpid()}.tmp.npy"
+            np.save(tmpfn, idx)
+            # atomic, other tiles may be racing us
+            os.replace(tmpfn, fn)
+        except OSError as exp:
+            LOG.info("failed to save regrid index %s: %s", fn, exp)
+    MEMORY["regrid"][key] = idx
+    return idx
+
+
+def compute_window(lons, lats, bounds, halo=WINDOW_HALO):
+    """Return the source grid window covering the bounds plus a halo.
+
+    The halo needs to be larger than the source grid spacing, so that the
+    nearest neighbour of every point within the bounds is in the window.
+
+    Args:
+      lons, lats (np.ndarray): 2D source grid coordinates
+      bounds (BOUNDS): the area of interest, None for everything
+      halo (float): degrees to pad the bounds by
+
+    Returns:
+      (yslice, xslice)
+    """
+    if bounds is None:
+        return slice(None), slice(None)
+    mask = (
+        (lons >= bounds.west - halo)
+        & (lons <= bounds.east + halo)
+        & (lats >= bounds.south - halo)
+        & (lats <= bounds.north + halo)
+    )
+    yidx, xidx = np.nonzero(np.ma.filled(mask, False))
+    if yidx.size == 0:
+        LOG.warning("window for %s is empty, reading everything", bounds)
+        return slice(None), slice(None)
+    return (
+        slice(yidx.min(), yidx.max() + 1),
+        slice(xidx.min(), xidx.max() + 1),
+    )
+
+
+def read_iemre(nc, valid, bounds=None):
+    """Read the IEM Reanalysis source grids for this date.
+
+    Args:
+      nc (netCDF4.Dataset): the IEMRE daily file
+      valid (date): the date
+      bounds (BOUNDS): only read the hyperslab needed for these bounds
+
+    Returns:
+      dict of the 2D source lons, lats and each variable in our units
     """
     offset = iemre.daily_offset(valid)
     lats = nc.variables["lat"][:]
     lons = nc.variables["lon"][:]
     lons, lats = np.meshgrid(lons, lats)
+    ys, xs = compute_window(lons, lats, bounds)
+    res = {"lons": lons[ys, xs], "lats": lats[ys, xs]}
+
+    def _read(ncname):
+        """Read the window."""
+        return nc.variables[ncname][offset, ys, xs].filled(np.nan)
 
     # Storage is W m-2, we want langleys per day
-    ncdata = (
-        nc.variables["rsds"][offset, :, :].filled(np.nan)
-        * 86400.0
-        / 1000000.0
-        * 23.9
-    )
-    # Default to a value of 300 when this data is missing, for some reason
-    nn = NearestNDInterpolator(
-        (np.ravel(lons), np.ravel(lats)), np.ravel(ncdata)
-    )
-    data["solar"][:] = iemre_bounds_check(
-        "rsds", nn(data["lon"], data["lat"]), 0, 1000
-    )
+    res["solar"] = _read("rsds") * 86400.0 / 1000000.0 * 23.9
+    res["high"] = convert_value(_read("high_tmpk"), "degK", "degC")
+    res["low"] = convert_value(_read("low_tmpk"), "degK", "degC")
+    res["dwpt"] = convert_value(_read("avg_dwpk"), "degK", "degC")
+    # Wind is already in m/s, but could be masked
+    res["wind"] = _read("wind_speed")
+    return res
 
-    ncdata = convert_value(
-        nc.variables["high_tmpk"][offset, :, :].filled(np.nan), "degK", "degC"
-    )
-    nn = NearestNDInterpolator(
-        (np.ravel(lons), np.ravel(lats)), np.ravel(ncdata)
-    )
-    data["high"][:] = iemre_bounds_check(
-        "high_tmpk", nn(data["lon"], data["lat"]), -60, 60
-    )
 
-    ncdata = convert_value(
-        nc.variables["low_tmpk"][offset, :, :].filled(np.nan), "degK", "degC"
-    )
-    nn = NearestNDInterpolator(
-        (np.ravel(lons), np.ravel(lats)), np.ravel(ncdata)
-    )
-    data["low"][:] = iemre_bounds_check(
-        "low_tmpk", nn(data["lon"], data["lat"]), -60, 60
-    )
+def load_iemre(iemre_grids, data):
+    """Use IEM Reanalysis for non-precip data
 
-    ncdata = convert_value(
-        nc.variables["avg_dwpk"][offset, :, :].filled(np.nan), "degK", "degC"
-    )
-    nn = NearestNDInterpolator(
-        (np.ravel(lons), np.ravel(lats)), np.ravel(ncdata)
-    )
-    data["dwpt"][:] = iemre_bounds_check(
-        "avg_dwpk", nn(data["lon"], data["lat"]), -60, 60
-    )
+    24km product is smoothed down to the 0.01 degree grid
+    """
+    lons = iemre_grids["lons"]
+    lats = iemre_grids["lats"]
+    idx = get_regrid_index(lons, lats, data["lon"], data["lat"])
+    for vname, ncname, lower, upper in [
+        ("solar", "rsds", 0, 1000),
+        ("high", "high_tmpk", -60, 60),
+        ("low", "low_tmpk", -60, 60),
+        ("dwpt", "avg_dwpk", -60, 60),
+        ("wind", "wind_speed", 0, 30),
+    ]:
+        data[vname][:] = iemre_bounds_check(
+            ncname, np.ravel(np.asarray(iemre_grids[vname]))[idx], lower, upper
+        )
 
-    # Wind is already in m/s, but could be masked
-    ncdata = nc.variables["wind_speed"][offset, :, :].filled(np.nan)
-    nn = NearestNDInterpolator(
-        (np.ravel(lons), np.ravel(lats)), np.ravel(ncdata)
-    )
-    data["wind"][:] = iemre_bounds_check(
-        "wind_speed", nn(data["lon"], data["lat"]), 0, 30
-    )
 
+def read_stage4(valid, bounds=None):
+    """Read the Stage IV 24 hour totals for this date.
 
-def load_stage4(data, valid, xtile, ytile):
-    """It sucks, but we need to load the stage IV data to give us something
-    to benchmark the MRMS data against, to account for two things:
-    1) Wind Farms
-    2) Over-estimates
+    Args:
+      valid (date): the date
+      bounds (BOUNDS): only read the hyperslab needed for these bounds
+
+    Returns:
+      dict of the 2D source lons, lats and precip totals
     """
-    LOG.debug("called")
     # The stage4 files store precip in the rears, so compute 1 AM
     one_am, tomorrow = get_sts_ets_at_localhour(valid, 1)
 
@@ -185,28 +276,66 @@ def load_stage4(data, valid, xtile, ytile):
 
         lats = nc.variables["lat"][:]
         lons = nc.variables["lon"][:]
+        ys, xs = compute_window(lons, lats, bounds)
+        lats = lats[ys, xs]
+        lons = lons[ys, xs]
         # crossing jan 1
         if ets_tidx < sts_tidx:
             LOG.debug("Exercise special stageIV logic for jan1!")
-            totals = np.sum(p01m[sts_tidx:, :, :], axis=0)
+            totals = np.sum(p01m[sts_tidx:, ys, xs], axis=0)
             with ncopen(f"{ST4PATH}/{tomorrow.year}_stage4_hourly.nc") as nc2:
                 p01m = nc2.variables["p01m"]
-                totals += np.sum(p01m[:ets_tidx, :, :], axis=0)
+                totals += np.sum(p01m[:ets_tidx, ys, xs], axis=0)
         else:
-            totals = np.sum(p01m[sts_tidx:ets_tidx, :, :], axis=0)
+            totals = np.sum(p01m[sts_tidx:ets_tidx, ys, xs], axis=0)
 
     if np.ma.max(totals) > 0:
         pass
+    elif bounds is not None and np.ma.count(totals) > 0:
+        # A dry window is fine, a window without any data is not
+        LOG.info("StageIV window for %s is dry", bounds)
     else:
         LOG.warning("No StageIV data found, aborting...")
         sys.exit(3)
     # set a small non-zero number to keep things non-zero
     totals = np.where(totals > 0.001, totals, 0.001)
+    return {"lons": lons, "lats": lats, "totals": totals}
+
+
+def load_day_inputs(valid, bounds=None):
+    """Read the IEMRE and Stage IV source grids that tiles need.
 
-    nn = NearestNDInterpolator(
-        (lons.flatten(), lats.flatten()), totals.flatten()
+    The result is cached in memory per date and bounds, so a scheduler can
+    load the whole domain once and share it with all of its tiles.
+
+    Args:
+      valid (date): the date
+      bounds (BOUNDS): the area the tiles cover, None for everything
+    """
+    key = (valid, bounds)
+    if key not in MEMORY["day_inputs"]:
+        with ncopen(iemre.get_daily_ncname(valid.year)) as nc:
+            iemre_grids = read_iemre(nc, valid, bounds)
+        MEMORY["day_inputs"] = {
+            key: {
+                "iemre": iemre_grids,
+                "stage4": read_stage4(valid, bounds),
+            }
+        }
+    return MEMORY["day_inputs"][key]
+
+
+def load_stage4(data, valid, xtile, ytile, stage4):
+    """It sucks, but we need to load the stage IV data to give us something
+    to benchmark the MRMS data against, to account for two things:
+    1) Wind Farms
+    2) Over-estimates
+    """
+    LOG.debug("called")
+    idx = get_regrid_index(
+        stage4["lons"], stage4["lats"], data["lon"], data["lat"]
     )
-    data["stage4"][:] = nn(data["lon"], data["lat"])
+    data["stage4"][:] = np.ravel(np.asarray(stage4["totals"]))[idx]
     write_grid(data["stage4"], valid, xtile, ytile, "stage4")
     LOG.debug("finished")
 
@@ -218,7 +347,7 @@ def qc_precip(data, valid, xtile, ytile, tile_bounds):
     Stage IV, then we consider it good.  If not, then we apply a multiplier to
     bring it to near the stage IV value.
     """
-    hires_total = np.sum(data["precip"], 2)
+    hires_total = data["precip"].total()
     if valid.year >= 2015:
         # Do an assessment of the hires_total (A2M MRMS), it may have too many
         # zeros where stage IV has actual data.
@@ -228,7 +357,7 @@ def qc_precip(data, valid, xtile, ytile, tile_bounds):
         if score > 0.005:  # 0.5% is arb, but good enough?
             LOG.warning("MRMS had %.2f%% bad zeros, using legacy", score * 100)
             load_precip_legacy(data, valid, tile_bounds)
-            hires_total = np.sum(data["precip"], 2)
+            hires_total = data["precip"].total()
 
     # prevent zeros
     hires_total = np.where(hires_total < 0.01, 0.01, hires_total)
@@ -240,9 +369,9 @@ def qc_precip(data, valid, xtile, ytile, tile_bounds):
         np.logical_and(multiplier > 0.67, multiplier < 1.33), 1.0, multiplier
     )
     write_grid(multiplier, valid, xtile, ytile, "multiplier")
-    data["precip"][:] *= multiplier[:, :, None]
-    data["precip"][np.isnan(data["precip"])] = 0.0
-    write_grid(np.sum(data["precip"], 2), valid, xtile, ytile, "outqcprecip")
+    # NaN values become zero
+    data["precip"].scale(multiplier)
+    write_grid(data["precip"].total(), valid, xtile, ytile, "outqcprecip")
 
 
 def _reader(filename, tile_bounds):
@@ -302,54 +431,60 @@ def load_precip_legacy(data, valid, tile_bounds):
     wm5 = m5 / m5total[:, :, None]
     LOG.debug("computed weights of m5")
 
-    minute2 = np.arange(0, 60 * 24, 2)
-    minute5 = np.arange(0, 60 * 24, 5)
-
-    def _compute(yidx, xidx):
-        """expensive computation that needs vectorized, somehow"""
-        s4total = data["stage4"][yidx, xidx]
-        # any stage IV totals less than 0.4mm are ignored, so effectively 0
-        if s4total < 0.4:
-            return
-        # Interpolate weights to a 2 minute interval grid
-        # we divide by 2.5 to downscale the 5 minute values to 2 minute
-        weights = np.interp(minute2, minute5, wm5[yidx, xidx, :]) / 2.5
-        # Now apply the weights to the s4total
-        data["precip"][yidx, xidx, :] = weights * s4total
-
-    for x in range(data["solar"].shape[1]):
-        for y in range(data["solar"].shape[0]):
-            _compute(y, x)
-
+    legacy_disaggregate(data["precip"], wm5, data["stage4"])
     LOG.debug("finished precip calculation")
 
 
-def load_precip(data, valid, tile_bounds):
-    """Load the 5 minute precipitation data into our ginormus grid"""
-    LOG.debug("called")
-    ts = 30 * 24  # 2 minute
-
-    midnight, tomorrow = get_sts_ets_at_localhour(valid, 0)
+def legacy_disaggregate(precip, wm5, stage4, chunksize=4096):
+    """Disaggregate the Stage IV totals with the 5 minute N0R weights.
 
-    top = int((55.0 - tile_bounds.north) * 100.0)
-    bottom = int((55.0 - tile_bounds.south) * 100.0)
+    This is `np.interp` from the 5 to 2 minute grid, done for a chunk of
+    pixels at a time to keep the float64 temporaries cache friendly.  The
+    weights have a 0.01 floor, so every wet pixel is wet at every timestep
+    and the precip is stored densely.
 
-    right = int((tile_bounds.east - -130.0) * 100.0)
-    left = int((tile_bounds.west - -130.0) * 100.0)
+    Args:
+      precip (SparsePrecip): (y, x, 720) 2 minute grid to fill in
+      wm5 (np.ndarray): (y, x, 288) 5 minute weights
+      stage4 (np.ndarray): (y, x) Stage IV daily totals
+      chunksize (int): number of pixels to process at once
+    """
+    minute2 = np.arange(0, 60 * 24, 2)
+    minute5 = np.arange(0, 60 * 24, 5)
+    # The interpolation bracket for each 2 minute step, times beyond the last
+    # 5 minute step take its value, like np.interp does
+    left = np.clip(
+        np.searchsorted(minute5, minute2, side="right") - 1,
+        0,
+        minute5.size - 1,
+    )
+    right = np.minimum(left + 1, minute5.size - 1)
+    dx = np.where(right > left, minute5[right] - minute5[left], 1)
+    offset = (minute2 - minute5[left]).astype(np.float64)
+    precip.densify()
+    # any stage IV totals less than 0.4mm are ignored, so effectively 0
+    yidx, xidx = np.nonzero(~(stage4 < 0.4))
+    for sl in range(0, yidx.size, chunksize):
+        yy = yidx[sl : sl + chunksize]
+        xx = xidx[sl : sl + chunksize]
+        w5 = wm5[yy, xx, :].astype(np.float64)
+        slopes = (w5[:, right] - w5[:, left]) / dx
+        # we divide by 2.5 to downscale the 5 minute values to 2 minute
+        weights = (slopes * offset + w5[:, left]) / 2.5
+        # Now apply the weights to the s4total
+        precip.assign_rows(yy, xx, weights * stage4[yy, xx, None])
 
-    # Oopsy we discovered a problem
-    a2m_divisor = 10.0 if (valid < datetime.date(2015, 1, 1)) else 50.0
 
+def get_a2m_fns(valid):
+    """Return the a2m PNG filenames for this date, None when missing."""
+    midnight, tomorrow = get_sts_ets_at_localhour(valid, 0)
     now = midnight
-    # Require at least 75% data coverage, if not, we will abort back to legacy
-    quorum = ts * 0.75
     fns = []
     while now < tomorrow:
         fn = now.astimezone(UTC).strftime(
             "/mesonet/ARCHIVE/data/%Y/%m/%d/GIS/mrms/a2m_%Y%m%d%H%M.png"
         )
         if os.path.isfile(fn):
-            quorum -= 1
             fns.append(fn)
         else:
             fns.append(None)
@@ -357,12 +492,123 @@ def load_precip(data, valid, tile_bounds):
             LOG.info("missing: %s", fn)
 
         now += datetime.timedelta(minutes=2)
+    return fns
+
+
+def get_mrms_cube_fn(valid, suffix=""):
+    """Return the filename of the shared day-level a2m scratch cube."""
+    return f"{SCRATCHDIR}/{valid:%Y%m%d}_a2m{suffix}.npy"
+
+
+def prefetch_mrms(valid, threads=None):
+    """Decode each a2m PNG once for the whole DEP domain.
+
+    The raw image values are written to a (time, y, x) memory mapped scratch
+    cube, flipped so that row zero is SOUTH, which `load_precip` in each tile
+    process then slices out of the shared page cache.
+
+    Returns:
+      str filename of the cube
+    """
+    ts = 30 * 24  # 2 minute
+    fns = get_a2m_fns(valid)
+    top = int((55.0 - NORTH) * 100.0)
+    bottom = int((55.0 - SOUTH) * 100.0)
+    right = int((EAST - -130.0) * 100.0)
+    left = int((WEST - -130.0) * 100.0)
+
+    os.makedirs(SCRATCHDIR, exist_ok=True)
+    cubefn = get_mrms_cube_fn(valid)
+    tmpfn = get_mrms_cube_fn(valid, ".tmp")
+    # Missing timesteps are left as zeros, which is zero precip
+    cube = np.lib.format.open_memmap(
+        tmpfn,
+        mode="w+",
+        dtype=np.uint8,
+        shape=(ts, bottom - top, right - left),
+    )
+
+    def _reader(tidx, fn):
+        """Windowed read of the DEP domain, GDAL releases the GIL."""
+        imgdata = gdal.Open(fn, 0).ReadAsArray(
+            left, top, right - left, bottom - top
+        )
+        cube[tidx] = np.flipud(imgdata)
+
+    # we ignore an hour for CDT->CST, meh
+    jobs = [(tidx, fn) for tidx, fn in enumerate(fns[:ts]) if fn is not None]
+    LOG.debug("decoding %s a2m files into %s", len(jobs), tmpfn)
+    with ThreadPool(threads or cpu_count()) as pool:
+        pool.starmap(_reader, jobs)
+    cube.flush()
+    np.save(
+        get_mrms_cube_fn(valid, "_present"),
+        np.array([fn is not None for fn in fns]),
+    )
+    # Tile processes only look for the final name, so this is atomic
+    os.rename(tmpfn, cubefn)
+    return cubefn
+
+
+def cleanup_mrms(valid):
+    """Remove the shared a2m scratch cube for this date."""
+    for suffix in ["", ".tmp", "_present"]:
+        fn = get_mrms_cube_fn(valid, suffix)
+        if os.path.isfile(fn):
+            os.unlink(fn)
+
+
+def load_precip(data, valid, tile_bounds):
+    """Load the 5 minute precipitation data into our ginormus grid"""
+    LOG.debug("called")
+    ts = 30 * 24  # 2 minute
+
+    # Oopsy we discovered a problem
+    a2m_divisor = 10.0 if (valid < datetime.date(2015, 1, 1)) else 50.0
+
+    cubefn = get_mrms_cube_fn(valid)
+    if os.path.isfile(cubefn):
+        fns = None
+        present = np.load(get_mrms_cube_fn(valid, "_present"))
+    else:
+        fns = get_a2m_fns(valid)
+        present = [fn is not None for fn in fns]
+    # Require at least 75% data coverage, if not, we will abort back to legacy
+    quorum = ts * 0.75 - np.sum(present)
     if quorum > 0:
         LOG.warning(
             "Failed 75%% quorum with MRMS a2m %.1f, loading legacy", quorum
         )
         load_precip_legacy(data, valid, tile_bounds)
         return
+
+    def _cb(args):
+        """write data."""
+        tidx, pdata = args
+        data["precip"].set_step(
+            tidx, np.where(pdata < 255, pdata / a2m_divisor, 0)
+        )
+
+    if fns is None:
+        LOG.debug("slicing shared a2m cube %s", cubefn)
+        cube = np.load(cubefn, mmap_mode="r")
+        yslice = slice(
+            int((tile_bounds.south - SOUTH) * 100.0),
+            int((tile_bounds.north - SOUTH) * 100.0),
+        )
+        xslice = slice(
+            int((tile_bounds.west - WEST) * 100.0),
+            int((tile_bounds.east - WEST) * 100.0),
+        )
+        for tidx in range(cube.shape[0]):
+            _cb((tidx, cube[tidx, yslice, xslice]))
+        return
+
+    top = int((55.0 - tile_bounds.north) * 100.0)
+    bottom = int((55.0 - tile_bounds.south) * 100.0)
+
+    right = int((tile_bounds.east - -130.0) * 100.0)
+    left = int((tile_bounds.west - -130.0) * 100.0)
     LOG.debug("fns[0]: %s fns[-1]: %s", fns[0], fns[-1])
 
     def _reader(tidx, fn):
@@ -370,19 +616,12 @@ def load_precip(data, valid, tile_bounds):
         if fn is None:
             return tidx, 0
         # PIL is not thread safe, so we need to use GDAL
-        imgdata = gdal.Open(fn, 0).ReadAsArray()
-        # sample out and then flip top to bottom!
-        imgdata = np.flipud(np.array(imgdata)[top:bottom, left:right])
-        return tidx, imgdata
-
-    def _cb(args):
-        """write data."""
-        tidx, pdata = args
-        data["precip"][:, :, tidx] = np.where(
-            pdata < 255,
-            pdata / a2m_divisor,
-            0,
+        # windowed read and then flip top to bottom!
+        imgdata = gdal.Open(fn, 0).ReadAsArray(
+            left, top, right - left, bottom - top
         )
+        imgdata = np.flipud(np.array(imgdata))
+        return tidx, imgdata
 
     LOG.debug("starting %s threads to read a2m", CPUCOUNT)
     with ThreadPool(CPUCOUNT) as pool:
@@ -453,6 +692,209 @@ def compute_breakpoint(ar, accumThreshold=2.0, intensityThreshold=1.0):
     return bp
 
 
+def _bp_timestrs(steps):
+    """Return the breakpoint time strings for each 2 minute step index.
+
+    The final entry (index `steps`) is the end of day 23:59 special case.
+    """
+    res = []
+    for i in range(steps):
+        ts = ZEROHOUR + datetime.timedelta(minutes=(i * 2))
+        res.append(bpstr(ts, 0).split()[0])
+    res.append(bpstr(ZEROHOUR.replace(hour=23, minute=59), 0).split()[0])
+    return res
+
+
+def _breakpoint_pass(tcube, accum_thresholds, intensity_thresholds):
+    """Run the `compute_breakpoint` state machine for many pixels at once.
+
+    We loop over the time axis and vectorize over pixels and thresholds,
+    so this is 720 numpy operations and not 720 * pixels python ones.
+
+    Args:
+      tcube (np.ndarray): (timesteps, pixels) precip accumulations
+      accum_thresholds (array-like): (thresholds, ) accumulation thresholds
+      intensity_thresholds (array-like): (thresholds, ) intensity thresholds
+
+    Returns:
+      (counts, events), counts being (thresholds, pixels) breakpoint counts
+      and events a list of (thresh_idx, pixel_idx, time_idx, accum) arrays.
+    """
+    steps, pixels = tcube.shape
+    athres = np.asarray(accum_thresholds, np.float64)[:, None]
+    ithres = np.asarray(intensity_thresholds, np.float64)[:, None]
+    shp = (athres.shape[0], pixels)
+    # accumulate in the input dtype, so to match the scalar version
+    accum = np.zeros(shp, tcube.dtype)
+    lastaccum = np.zeros(shp, tcube.dtype)
+    lasti = np.full(shp, -1, np.int32)
+    events = []
+    for i in range(steps):
+        intensity = tcube[i][None, :]
+        wet = np.broadcast_to(~(intensity < 0.001), shp)
+        if not wet.any():
+            continue
+        started = np.logical_and(wet, lasti < 0)
+        if started.any():
+            tt, pp = np.nonzero(started)
+            zeros = np.zeros(tt.size, accum.dtype)
+            events.append((tt, pp, np.full(tt.size, i), zeros))
+        accum = np.where(wet, accum + intensity, accum)
+        lasti[wet] = i
+        emit = np.logical_and(
+            wet,
+            np.logical_or((accum - lastaccum) > athres, intensity > ithres),
+        )
+        if emit.any():
+            lastaccum = np.where(emit, accum, lastaccum)
+            tt, pp = np.nonzero(emit)
+            events.append((tt, pp, np.full(tt.size, i + 1), accum[tt, pp]))
+    final = np.logical_and(lasti >= 0, (accum - lastaccum) > 0.02)
+    tt, pp = np.nonzero(final)
+    events.append((tt, pp, lasti[tt, pp] + 1, accum[tt, pp]))
+    counts = np.bincount(
+        np.concatenate([ev[0] * pixels + ev[1] for ev in events]),
+        minlength=shp[0] * pixels,
+    ).reshape(shp)
+    return counts, events
+
+
+def simplify_breakpoints(tidx, accum, maxcount):
+    """Reduce a breakpoint series to at most `maxcount` points in one pass.
+
+    This is a Visvalingam-Whyatt reduction of the cumulative precipitation
+    curve, the interior point whose removal changes the curve the least
+    (smallest triangle area with its neighbours) is dropped first.  The
+    first and last points are always kept and the result is a subset, so
+    the times and accumulations remain strictly increasing as WEPP needs.
+
+    Args:
+      tidx (np.ndarray): breakpoint time indices
+      accum (np.ndarray): breakpoint accumulations
+      maxcount (int): the most points to keep
+
+    Returns:
+      np.ndarray of the indices of the kept points
+    """
+    size = len(tidx)
+    if size <= maxcount:
+        return np.arange(size)
+    tt = np.asarray(tidx, np.float64)
+    aa = np.asarray(accum, np.float64)
+    prev = list(range(-1, size - 1))
+    nxt = list(range(1, size + 1))
+
+    def _area(i):
+        """Triangle area of this point and its current neighbours."""
+        p, q = prev[i], nxt[i]
+        return 0.5 * abs(
+            (tt[i] - tt[p]) * (aa[q] - aa[p])
+            - (tt[q] - tt[p]) * (aa[i] - aa[p])
+        )
+
+    areas = [0.0] * size
+    for i in range(1, size - 1):
+        areas[i] = _area(i)
+    heap = [(areas[i], i) for i in range(1, size - 1)]
+    heapq.heapify(heap)
+    removed = np.zeros(size, bool)
+    remaining = size
+    while remaining > max(maxcount, 2):
+        area, i = heapq.heappop(heap)
+        # skip stale entries, the area changed after a neighbour was removed
+        if removed[i] or area != areas[i]:
+            continue
+        removed[i] = True
+        remaining -= 1
+        p, q = prev[i], nxt[i]
+        nxt[p] = q
+        prev[q] = p
+        for j in (p, q):
+            if 0 < j < size - 1:
+                # A point never becomes less significant than one removed
+                areas[j] = max(_area(j), area)
+                heapq.heappush(heap, (areas[j], j))
+    return np.nonzero(~removed)[0]
+
+
+def compute_tile_breakpoints(precip, limit=100, chunksize=16384):
+    """Compute the breakpoint data for a whole (y, x, time) precip tile.
+
+    Pixels get the `compute_breakpoint` defaults.  The intense pixels that
+    end up with `limit` or more breakpoints are then reduced to `limit - 1`
+    by `simplify_breakpoints`, which keeps the most significant changes in
+    rate instead of raising the thresholds until the count drops.
+
+    Args:
+      precip (SparsePrecip or np.ndarray): (y, x, timesteps) accumulations
+      limit (int): the breakpoint count to stay under
+      chunksize (int): number of wet pixels to densify at once
+
+    Returns:
+      BREAKPOINTS with per pixel offsets into the time index and accumulation
+      arrays, see `get_breakpoints`.
+    """
+    if isinstance(precip, np.ndarray):
+        precip = SparsePrecip.from_dense(precip)
+    steps = precip.shape[-1]
+    totals = np.ravel(precip.total(chunksize))
+    # Any total less than (0.01in) is not of concern, might as well be zero
+    wetidx = np.nonzero(totals >= 0.254)[0]
+    chosen = []  # list of (pixel_idx, time_idx, accum)
+
+    for sl in range(0, wetidx.size, chunksize):
+        pixels = wetidx[sl : sl + chunksize]
+        tcube = np.ascontiguousarray(precip.rows(pixels).T)
+        counts, events = _breakpoint_pass(tcube, [2.0], [1.0])
+        over = counts[0] >= limit
+        # events are in time order, so stay in time order per pixel
+        pp = np.concatenate([ev[1] for ev in events])
+        ti = np.concatenate([ev[2] for ev in events])
+        ac = np.concatenate([ev[3] for ev in events])
+        keep = ~over[pp]
+        chosen.append((pixels[pp[keep]], ti[keep], ac[keep]))
+        if not over.any():
+            continue
+        LOG.debug("simplifying %s pixels over %s bps", over.sum(), limit)
+        order = np.argsort(pp, kind="stable")
+        ptr = np.zeros(pixels.size + 1, np.int64)
+        np.cumsum(np.bincount(pp, minlength=pixels.size), out=ptr[1:])
+        for pidx in np.nonzero(over)[0]:
+            sel = order[ptr[pidx] : ptr[pidx + 1]]
+            kept = sel[simplify_breakpoints(ti[sel], ac[sel], limit - 1)]
+            chosen.append((pixels[pp[kept]], ti[kept], ac[kept]))
+
+    if chosen:
+        pixidx = np.concatenate([c[0] for c in chosen])
+        tidx = np.concatenate([c[1] for c in chosen])
+        accum = np.concatenate([c[2] for c in chosen])
+    else:
+        pixidx = np.zeros(0, np.int64)
+        tidx = np.zeros(0, np.int64)
+        accum = np.zeros(0, precip.dtype)
+    # events were collected in time order, a stable sort keeps that per pixel
+    order = np.argsort(pixidx, kind="stable")
+    ptr = np.zeros(precip.npixels + 1, np.int64)
+    np.cumsum(np.bincount(pixidx, minlength=precip.npixels), out=ptr[1:])
+    return BREAKPOINTS(
+        shape=precip.shape[:-1],
+        ptr=ptr,
+        tidx=tidx[order],
+        accum=accum[order],
+        timestrs=_bp_timestrs(steps),
+    )
+
+
+def get_breakpoints(bps, yidx, xidx):
+    """Return the list(str) breakpoint text for the given pixel."""
+    pixel = yidx * bps.shape[1] + xidx
+    sl = slice(bps.ptr[pixel], bps.ptr[pixel + 1])
+    return [
+        f"{bps.timestrs[ti]} {ac:.2f}"
+        for ti, ac in zip(bps.tidx[sl], bps.accum[sl])
+    ]
+
+
 def write_grid(grid, valid, xtile, ytile, fnadd=""):
     """Save off the daily precip totals for usage later in computing huc_12"""
     if fnadd != "" and not sys.stdout.isatty():
@@ -464,9 +906,31 @@ def write_grid(grid, valid, xtile, ytile, fnadd=""):
     np.save(f"{basedir}/{valid:%Y%m%d}{fnadd}.tile_{xtile}_{ytile}", grid)
 
 
-def precip_workflow(data, valid, xtile, ytile, tile_bounds):
+def get_day_grid_fn(valid):
+    """Return the filename of the shared day precip grid the tiles fill."""
+    return f"{SCRATCHDIR}/{valid:%Y%m%d}_precip.npy"
+
+
+def write_tile_total(grid, valid, xtile, ytile, tile_bounds):
+    """Save off the tile's daily precip total for the proctor to assemble.
+
+    When the proctor has created the day grid, the tile is written into its
+    place in that memory map, otherwise into a tile file.
+    """
+    fn = get_day_grid_fn(valid)
+    if not os.path.isfile(fn):
+        write_grid(grid, valid, xtile, ytile)
+        return
+    y0 = int(round((tile_bounds.south - SOUTH) * 100))
+    x0 = int(round((tile_bounds.west - WEST) * 100))
+    daygrid = np.load(fn, mmap_mode="r+")
+    daygrid[y0 : y0 + grid.shape[0], x0 : x0 + grid.shape[1]] = grid
+    daygrid.flush()
+
+
+def precip_workflow(data, valid, xtile, ytile, tile_bounds, stage4):
     """Drive the precipitation workflow"""
-    load_stage4(data, valid, xtile, ytile)
+    load_stage4(data, valid, xtile, ytile, stage4)
     # We have MRMS a2m RASTER files prior to 1 Jan 2015, but these files used
     # a very poor choice of data interval of 0.1mm, which is not large enough
     # to capture low intensity events.  Files after 1 Jan 2015 used a better
@@ -476,40 +940,16 @@ def precip_workflow(data, valid, xtile, ytile, tile_bounds):
     else:
         load_precip(data, valid, tile_bounds)
     qc_precip(data, valid, xtile, ytile, tile_bounds)
-    write_grid(np.sum(data["precip"], 2), valid, xtile, ytile)
+    write_tile_total(data["precip"].total(), valid, xtile, ytile, tile_bounds)
 
 
-def edit_clifile(xidx, yidx, clifn, data, valid):
-    """Edit the climate file, run from thread."""
-    # Okay we have work to do
-    with open(clifn, "r", encoding="utf8") as fh:
-        clidata = fh.read()
-    pos = clidata.find(valid.strftime("%-d\t%-m\t%Y"))
-    if pos == -1:
-        LOG.warning("Date find failure for %s", clifn)
-        return False
+def format_day(xidx, yidx, data, valid):
+    """Return the climate file text for this pixel and day.
 
-    pos2 = clidata[pos:].find(
-        (valid + datetime.timedelta(days=1)).strftime("%-d\t%-m\t%Y")
-    )
-    if pos2 == -1:
-        LOG.warning("Date2 find failure for %s", clifn)
-        return False
-
-    intensity_threshold = 1.0
-    bpdata = compute_breakpoint(
-        data["precip"][yidx, xidx, :],
-    )
-    if bpdata is None:
-        bpdata = []
-    while len(bpdata) >= 100:
-        intensity_threshold += 2
-        LOG.debug("len(bpdata) %s>100 t:%s", len(bpdata), intensity_threshold)
-        bpdata = compute_breakpoint(
-            data["precip"][yidx, xidx, :],
-            accumThreshold=intensity_threshold,
-            intensityThreshold=intensity_threshold,
-        )
+    Returns:
+      str or None when we have missing data
+    """
+    bpdata = get_breakpoints(data["breakpoints"], yidx, xidx)
 
     high = data["high"][yidx, xidx]
     low = data["low"][yidx, xidx]
@@ -517,18 +957,54 @@ def edit_clifile(xidx, yidx, clifn, data, valid):
     wind = data["wind"][yidx, xidx]
     dwpt = data["dwpt"][yidx, xidx]
     if np.isnan([high, low, solar, wind, dwpt]).any():
-        LOG.warning("Missing data for %s", clifn)
-        return False
+        return None
     bptext = "\n".join(bpdata)
     bptext2 = "\n" if bpdata else ""
-    thisday = (
+    return (
         f"{valid.day}\t{valid.month}\t{valid.year}\t{len(bpdata)}\t"
         f"{high:3.1f}\t{low:3.1f}\t{solar:4.0f}\t{wind:4.1f}\t0\t"
         f"{dwpt:4.1f}\n{bptext}{bptext2}"
     )
 
-    with open(clifn, "w", encoding="utf8") as fh:
-        fh.write(clidata[:pos] + thisday + clidata[(pos + pos2) :])
+
+def edit_clifile(xidx, yidx, clifn, data, valid):
+    """Edit the climate file, run from thread."""
+    return edit_clifile_days(xidx, yidx, clifn, {valid: data})
+
+
+def edit_clifile_days(xidx, yidx, clifn, datas, dirty=None):
+    """Edit one or more days of the climate file, run from thread.
+
+    Args:
+      xidx, yidx (int): the pixel within the tile
+      clifn (str): the climate file
+      datas (dict): date to the `compute_tile_day` result
+      dirty (dict): date to a list, the climate file is appended when the
+        day materially changed, see `clifile_dirty`
+    """
+    days = {}
+    for valid, data in datas.items():
+        thisday = format_day(xidx, yidx, data, valid)
+        if thisday is None:
+            LOG.warning("Missing data for %s", clifn)
+            return False
+        days[valid] = thisday
+    # Seeded files may share storage, see clifile_store
+    break_link(clifn)
+    # Only the tail of the file from the first day onward is rewritten
+    previous = {}
+    try:
+        missing = splice_days(clifn, days, previous)
+    except ValueError as exp:
+        LOG.warning("Index failure for %s: %s", clifn, exp)
+        return False
+    if missing:
+        LOG.warning("Date find failure for %s %s", clifn, missing)
+        return False
+    if dirty is not None:
+        for valid, thisday in days.items():
+            if is_material(previous.get(valid), thisday):
+                dirty[valid].append(clifn)
     return True
 
 
@@ -544,22 +1020,12 @@ def compute_tile_bounds(xtile, ytile, tilesize) -> BOUNDS:
     )
 
 
-def main(argv):
-    """The workflow to get the weather data variables we want!"""
-    if len(argv) != 8:
-        print(
-            "Usage: python daily_climate_editor.py <xtile> <ytile> <tilesz> "
-            "<scenario> <YYYY> <mm> <dd>"
-        )
-        return
-    xtile = int(argv[1])
-    ytile = int(argv[2])
-    tilesize = int(argv[3])
-    scenario = int(argv[4])
-    valid = datetime.date(int(argv[5]), int(argv[6]), int(argv[7]))
+def compute_tile_day(xtile, ytile, tile_bounds, valid, day_inputs):
+    """Compute the daily grids and breakpoints for one day of a tile.
 
-    tile_bounds = compute_tile_bounds(xtile, ytile, tilesize)
-    LOG.info("bounds %s", tile_bounds)
+    Returns:
+      dict of the (y, x) daily grids and the day's BREAKPOINTS
+    """
     shp = (
         int((tile_bounds.north - tile_bounds.south) * 100),
         int((tile_bounds.east - tile_bounds.west) * 100),
@@ -568,14 +1034,8 @@ def main(argv):
     for vname in "high low dwpt wind solar stage4".split():
         data[vname] = np.zeros(shp, np.float16)
 
-    # Optimize for continuous memory
-    data["precip"] = np.zeros((*shp, 30 * 24), np.float16)
-
-    # We could be outside conus, if so, just write out zeros
-    if not check_has_clifiles(tile_bounds):
-        LOG.info("Exiting as tile %s %s is outside CONUS", xtile, ytile)
-        write_grid(np.sum(data["precip"], 2), valid, xtile, ytile)
-        return
+    # Only the wet timesteps of wet pixels are stored
+    data["precip"] = SparsePrecip(shp, 30 * 24, np.float16)
 
     xaxis = np.arange(tile_bounds.west, tile_bounds.east, 0.01)
     yaxis = np.arange(tile_bounds.south, tile_bounds.north, 0.01)
@@ -586,11 +1046,61 @@ def main(argv):
     # 3. Radiation l/d
     # 4. wind mps
     # 6. Mean dewpoint C
-    with ncopen(iemre.get_daily_ncname(valid.year)) as nc:
-        load_iemre(nc, data, valid)
+    load_iemre(day_inputs["iemre"], data)
     # 5. wind direction (always zero)
     # 7. breakpoint precip mm
-    precip_workflow(data, valid, xtile, ytile, tile_bounds)
+    precip_workflow(
+        data, valid, xtile, ytile, tile_bounds, day_inputs["stage4"]
+    )
+    data["breakpoints"] = compute_tile_breakpoints(data["precip"])
+    # Everything else is not needed to edit the climate files
+    for vname in ["precip", "lon", "lat", "stage4"]:
+        data.pop(vname)
+    return data
+
+
+def prepare_tile(xtile, ytile, tilesize, scenario, dates, day_inputs=None):
+    """The load stage, compute everything needed to edit a tile's files.
+
+    Args:
+      xtile (int): tile index from the west
+      ytile (int): tile index from the south
+      tilesize (int): tile size in degrees
+      scenario (int): the climate scenario to edit
+      dates (list): the dates to edit, each climate file is only rewritten
+        once for all of them
+      day_inputs (dict): date to the `load_day_inputs` result, when shared
+        by a scheduler running many tiles, otherwise they are loaded here
+
+    Returns:
+      dict of date to `compute_tile_day` results and the list of
+      [xidx, yidx, clifn] files to edit, both empty outside of CONUS
+    """
+    tile_bounds = compute_tile_bounds(xtile, ytile, tilesize)
+    LOG.info("bounds %s", tile_bounds)
+    shp = (
+        int((tile_bounds.north - tile_bounds.south) * 100),
+        int((tile_bounds.east - tile_bounds.west) * 100),
+    )
+
+    # We could be outside conus, if so, just write out zeros
+    if not check_has_clifiles(tile_bounds):
+        LOG.info("Exiting as tile %s %s is outside CONUS", xtile, ytile)
+        for valid in dates:
+            write_tile_total(
+                np.zeros(shp, np.float16), valid, xtile, ytile, tile_bounds
+            )
+        return {}, []
+
+    datas = {}
+    for valid in dates:
+        if day_inputs is None:
+            inputs = load_day_inputs(valid, tile_bounds)
+        else:
+            inputs = day_inputs[valid]
+        datas[valid] = compute_tile_day(
+            xtile, ytile, tile_bounds, valid, inputs
+        )
 
     queue = []
     for yidx in range(shp[0]):
@@ -601,7 +1111,20 @@ def main(argv):
             if not os.path.isfile(clifn):
                 continue
             queue.append([xidx, yidx, clifn])
+    return datas, queue
+
+
+def edit_tile(datas, queue, dirty=None):
+    """The edit stage, splice the days into each of the tile's files.
+
+    Args:
+      datas (dict): see `prepare_tile`
+      queue (list): see `prepare_tile`
+      dirty (dict): see `edit_clifile_days`
 
+    Returns:
+      int count of climate files that failed to edit
+    """
     progress = tqdm(total=len(queue), disable=not sys.stdout.isatty())
     errors = {"cnt": 0}
 
@@ -626,13 +1149,178 @@ def main(argv):
 
         for _, (xidx, yidx, clifn) in enumerate(queue):
             pool.apply_async(
-                edit_clifile,
-                (xidx, yidx, clifn, data, valid),
+                edit_clifile_days,
+                (xidx, yidx, clifn, datas, dirty),
                 callback=_callback,
                 error_callback=_errorback,
             )
         pool.close()
         pool.join()
+    return errors["cnt"]
+
+
+def run_tile(xtile, ytile, tilesize, scenario, dates, day_inputs=None):
+    """The workflow to get the weather data variables we want!
+
+    See `prepare_tile` for the arguments.
+
+    Returns:
+      int count of climate files that failed to edit
+    """
+    datas, queue = prepare_tile(
+        xtile, ytile, tilesize, scenario, dates, day_inputs
+    )
+    dirty = {valid: [] for valid in dates}
+    errors = edit_tile(datas, queue, dirty)
+    write_tile_dirty(xtile, ytile, scenario, queue, dirty)
+    return errors
+
+
+def write_tile_dirty(xtile, ytile, scenario, queue, dirty):
+    """Write the manifests of climate files materially changed by the tile."""
+    if not queue:
+        return
+    for valid, clifns in dirty.items():
+        write_dirty(scenario, valid, f"{xtile}_{ytile}", clifns)
+        LOG.info(
+            "%s %s_%s %s/%s files changed",
+            valid,
+            xtile,
+            ytile,
+            len(clifns),
+            len(queue),
+        )
+
+
+def new_stage_stats():
+    """Return empty per-stage counters for `run_tiles`.
+
+    Each stage counts the tiles and climate files it handled, the seconds
+    spent working and the seconds spent blocked on the other stage.
+    """
+    return {
+        stage: {"tiles": 0, "files": 0, "busy": 0.0, "blocked": 0.0}
+        for stage in ["load", "edit"]
+    }
+
+
+def merge_stage_stats(total, stats):
+    """Add the stats counters into the total counters."""
+    for stage, counters in stats.items():
+        for key, value in counters.items():
+            total[stage][key] += value
+
+
+def log_stage_stats(stats):
+    """Log the throughput of each stage, the slowest stage is the limit."""
+    for stage, counters in stats.items():
+        busy = max(counters["busy"], 1e-6)
+        LOG.info(
+            "%s stage: %s tiles %s files in %.1fs busy (%.2f tiles/s, "
+            "%.0f files/s), %.1fs blocked",
+            stage,
+            counters["tiles"],
+            counters["files"],
+            counters["busy"],
+            counters["tiles"] / busy,
+            counters["files"] / busy,
+            counters["blocked"],
+        )
+
+
+def run_tiles(tiles, scenario, dates, day_inputs=None, stats=None, depth=1):
+    """Run tiles through a two stage load -> edit pipeline.
+
+    A loader thread prepares the following tiles while the current tile's
+    climate files are being edited.  At most `depth` prepared tiles wait
+    in the queue, which bounds the memory use.  The load stage being
+    blocked means editing limits the throughput and vice versa.
+
+    Args:
+      tiles (iterable): (xtile, ytile, tilesize) to process, consumed by
+        the loader thread
+      scenario (int): the climate scenario to edit
+      dates (list): the dates to edit
+      day_inputs (dict): see `prepare_tile`
+      stats (dict): optional `new_stage_stats` counters to update
+      depth (int): how many prepared tiles may wait for the editor
+
+    Returns:
+      list of (xtile, ytile, seconds, edit_errors, error) with error being
+      None on success and otherwise the formatted exception
+    """
+    if stats is None:
+        stats = new_stage_stats()
+    prepared = Queue(maxsize=depth)
+
+    def _loader():
+        """Prepare each tile, never raise."""
+        for xtile, ytile, tilesize in tiles:
+            sts = time.time()
+            result = None
+            error = None
+            try:
+                result = prepare_tile(
+                    xtile, ytile, tilesize, scenario, dates, day_inputs
+                )
+            except SystemExit as exp:
+                error = f"exited with status code {exp.code}"
+            except Exception:  # pylint: disable=broad-except
+                error = traceback.format_exc()
+            seconds = time.time() - sts
+            stats["load"]["busy"] += seconds
+            stats["load"]["tiles"] += 1
+            if result is not None:
+                stats["load"]["files"] += len(result[1])
+            sts = time.time()
+            prepared.put((xtile, ytile, seconds, result, error))
+            stats["load"]["blocked"] += time.time() - sts
+        prepared.put(None)
+
+    thread = threading.Thread(target=_loader, daemon=True)
+    thread.start()
+    results = []
+    while True:
+        sts = time.time()
+        item = prepared.get()
+        stats["edit"]["blocked"] += time.time() - sts
+        if item is None:
+            break
+        xtile, ytile, seconds, result, error = item
+        edit_errors = 0
+        if error is None:
+            sts = time.time()
+            try:
+                dirty = {valid: [] for valid in dates}
+                edit_errors = edit_tile(*result, dirty)
+                write_tile_dirty(xtile, ytile, scenario, result[1], dirty)
+            except Exception:  # pylint: disable=broad-except
+                error = traceback.format_exc()
+            stats["edit"]["busy"] += time.time() - sts
+            seconds += time.time() - sts
+            stats["edit"]["tiles"] += 1
+            stats["edit"]["files"] += len(result[1])
+        results.append((xtile, ytile, seconds, edit_errors, error))
+    thread.join()
+    return results
+
+
+def main(argv):
+    """Run the editor for one tile."""
+    if len(argv) not in [8, 11]:
+        print(
+            "Usage: python daily_climate_editor.py <xtile> <ytile> <tilesz> "
+            "<scenario> <YYYY> <mm> <dd> [<YYYY> <mm> <dd>]"
+        )
+        return
+    sts = datetime.date(int(argv[5]), int(argv[6]), int(argv[7]))
+    ets = sts
+    if len(argv) == 11:
+        ets = datetime.date(int(argv[8]), int(argv[9]), int(argv[10]))
+    dates = [
+        sts + datetime.timedelta(days=i) for i in range((ets - sts).days + 1)
+    ]
+    run_tile(int(argv[1]), int(argv[2]), int(argv[3]), int(argv[4]), dates)
 
 
 if __name__ == "__main__":
@@ -693,3 +1381,192 @@ def test_bp():
                 assert False
             lastts = float(tokens[0])
             lastaccum = float(tokens[1])
+
+
+def test_tile_breakpoints():
+    """Test that the vectorized tile engine matches compute_breakpoint."""
+    rng = np.random.default_rng(42)
+    precip = np.zeros((4, 5, 30 * 24), np.float16)
+    # light drizzle, convective, and saturated pixels
+    precip[0, 1] = rng.random(30 * 24) * 0.05
+    precip[1, 2, 100:300] = rng.random(200) * 4
+    precip[2, 3] = rng.random(30 * 24) * 12
+    precip[3, 4, -4:] = [3.2, 2.009, 0.001, 0]
+    precip[3, 0, 0] = 3.2
+    precip[2, 0, -1] = 10.99
+    bps = compute_tile_breakpoints(precip, chunksize=7)
+    simplified = 0
+    for yidx in range(precip.shape[0]):
+        for xidx in range(precip.shape[1]):
+            full = compute_breakpoint(precip[yidx, xidx])
+            res = get_breakpoints(bps, yidx, xidx)
+            if len(full) < 100:
+                assert res == full
+                continue
+            # Intense pixels are simplified from the default breakpoints
+            simplified += 1
+            assert len(res) == 99
+            assert res[0] == full[0]
+            assert res[-1] == full[-1]
+            assert set(res) <= set(full)
+            times = [float(bp.split()[0]) for bp in res]
+            accums = [float(bp.split()[1]) for bp in res]
+            assert all(np.diff(times) > 0)
+            assert all(np.diff(accums) > 0)
+    assert simplified == 2
+
+
+def test_simplify_breakpoints():
+    """Test that the kink in a cumulative curve survives simplification."""
+    tidx = np.arange(10)
+    accum = np.array([0, 1, 2, 3, 4, 10, 16, 22, 23, 24], np.float64)
+    assert simplify_breakpoints(tidx, accum, 20).tolist() == list(range(10))
+    assert simplify_breakpoints(tidx, accum, 4).tolist() == [0, 4, 7, 9]
+    assert simplify_breakpoints(tidx, accum, 1).tolist() == [0, 9]
+
+
+def test_legacy_disaggregate():
+    """Test that the batched legacy interpolation matches np.interp."""
+    rng = np.random.default_rng(0)
+    m5 = rng.random((3, 4, 288)).astype(np.float16) + np.float16(0.01)
+    wm5 = m5 / np.sum(m5, 2, dtype=np.float32)[:, :, None]
+    stage4 = (rng.random((3, 4)) * 50).astype(np.float16)
+    stage4[0, 0] = 0.3
+    precip = SparsePrecip((3, 4), 720, np.float16)
+    legacy_disaggregate(precip, wm5, stage4, chunksize=5)
+    minute2 = np.arange(0, 60 * 24, 2)
+    minute5 = np.arange(0, 60 * 24, 5)
+    for yidx in range(3):
+        for xidx in range(4):
+            expected = np.zeros(720, np.float16)
+            if stage4[yidx, xidx] >= 0.4:
+                weights = np.interp(minute2, minute5, wm5[yidx, xidx]) / 2.5
+                expected[:] = weights * stage4[yidx, xidx]
+            np.testing.assert_array_equal(precip.row(yidx, xidx), expected)
+
+
+def test_regrid_index(tmp_path, monkeypatch):
+    """Test that the cached gather index matches a brute force lookup."""
+    monkeypatch.setattr(sys.modules[__name__], "REGRIDDIR", str(tmp_path))
+    monkeypatch.setitem(MEMORY, "regrid", {})
+    src_lons, src_lats = np.meshgrid(
+        np.arange(-100, -90, 0.25), np.arange(40, 45, 0.25)
+    )
+    lons, lats = np.meshgrid(
+        np.arange(-96, -95, 0.01), np.arange(42, 43, 0.01)
+    )
+    idx = get_regrid_index(src_lons, src_lats, lons, lats)
+    MEMORY["regrid"].clear()
+    # now from disk
+    assert (idx == get_regrid_index(src_lons, src_lats, lons, lats)).all()
+    dist = (np.ravel(src_lons)[None, :] - np.ravel(lons)[:, None]) ** 2 + (
+        np.ravel(src_lats)[None, :] - np.ravel(lats)[:, None]
+    ) ** 2
+    best = np.min(dist, axis=1)
+    assert np.allclose(dist[np.arange(best.size), np.ravel(idx)], best)
+
+
+def test_compute_window(tmp_path, monkeypatch):
+    """Test that windowed nearest neighbour matches the full grid."""
+    monkeypatch.setattr(sys.modules[__name__], "REGRIDDIR", str(tmp_path))
+    lons, lats = np.meshgrid(
+        np.arange(-110, -80, 0.125), np.arange(30, 50, 0.1)
+    )
+    bounds = compute_tile_bounds(5, 3, 5)
+    ys, xs = compute_window(lons, lats, bounds)
+    assert lons[ys, xs].size < lons.size
+    tlons, tlats = np.meshgrid(
+        np.arange(bounds.west, bounds.east, 0.01),
+        np.arange(bounds.south, bounds.north, 0.01),
+    )
+    full = np.ravel(lons)[get_regrid_index(lons, lats, tlons, tlats)]
+    idx = get_regrid_index(lons[ys, xs], lats[ys, xs], tlons, tlats)
+    assert (np.ravel(lons[ys, xs])[idx] == full).all()
+
+
+def test_edit_clifile(tmp_path):
+    """Test that editing a climate file splices in the new day."""
+    clifn = str(tmp_path / "test.cli")
+    with open(clifn, "w", encoding="ascii") as fh:
+        fh.write("4.30\n")
+        for day in range(1, 4):
+            fh.write(f"{day}\t1\t2007\t0\t1.0\t-1.0\t100\t2.0\t0\t-3.0\n")
+    data = {}
+    for vname in "high low dwpt wind solar".split():
+        data[vname] = np.ones((1, 1), np.float16)
+    precip = np.zeros((1, 1, 30 * 24), np.float16)
+    precip[0, 0, 30] = 3.2
+    data["breakpoints"] = compute_tile_breakpoints(precip)
+    assert edit_clifile(0, 0, clifn, data, datetime.date(2007, 1, 2))
+    with open(clifn, encoding="ascii") as fh:
+        lines = fh.readlines()
+    assert lines[2] == "2\t1\t2007\t2\t1.0\t1.0\t   1\t 1.0\t0\t 1.0\n"
+    assert lines[3] == "01.0000 0.00\n"
+    assert lines[5].startswith("3\t1\t2007")
+    assert not edit_clifile(0, 0, clifn, data, datetime.date(2008, 1, 2))
+    # Backfill two days at once, the wet days are dirty
+    datas = {datetime.date(2007, 1, d): data for d in [1, 3]}
+    dirty = {valid: [] for valid in datas}
+    assert edit_clifile_days(0, 0, clifn, datas, dirty)
+    assert dirty == {valid: [clifn] for valid in datas}
+    with open(clifn, encoding="ascii") as fh:
+        lines = fh.readlines()
+    assert lines[1] == "1\t1\t2007\t2\t1.0\t1.0\t   1\t 1.0\t0\t 1.0\n"
+    assert lines[7].startswith("3\t1\t2007\t2")
+
+
+def test_run_tiles(monkeypatch):
+    """Test that the pipeline keeps going past a failed tile."""
+
+    def _prepare(xtile, ytile, *_args):
+        """Fake the load stage."""
+        if xtile == 1:
+            raise ValueError("bad tile")
+        return {}, [[0, 0, f"{xtile}_{ytile}.cli"]] * (ytile + 1)
+
+    monkeypatch.setattr(sys.modules[__name__], "prepare_tile", _prepare)
+
+    def _edit(_datas, queue, dirty):
+        """Fake the edit stage, the first file changed."""
+        dirty[datetime.date(2021, 1, 1)].append(queue[0][2])
+        return len(queue)
+
+    written = []
+    monkeypatch.setattr(sys.modules[__name__], "edit_tile", _edit)
+    monkeypatch.setattr(
+        sys.modules[__name__],
+        "write_dirty",
+        lambda *args: written.append(args),
+    )
+    stats = new_stage_stats()
+    tiles = [(0, 0, 5), (1, 0, 5), (2, 1, 5)]
+    res = run_tiles(tiles, 0, [datetime.date(2021, 1, 1)], stats=stats)
+    assert [w[2:] for w in written] == [
+        ("0_0", ["0_0.cli"]),
+        ("2_1", ["2_1.cli"]),
+    ]
+    assert [(r[0], r[1], r[3]) for r in res] == [
+        (0, 0, 1),
+        (1, 0, 0),
+        (2, 1, 2),
+    ]
+    assert res[0][4] is None
+    assert "bad tile" in res[1][4]
+    assert stats["load"]["tiles"] == 3
+    assert stats["edit"]["tiles"] == 2
+    assert stats["edit"]["files"] == 3
+
+
+def test_write_tile_total(tmp_path, monkeypatch):
+    """Test that a tile lands in its place within the day grid."""
+    monkeypatch.setattr(sys.modules[__name__], "SCRATCHDIR", str(tmp_path))
+    valid = datetime.date(2021, 6, 1)
+    np.lib.format.open_memmap(
+        get_day_grid_fn(valid), mode="w+", dtype=np.float16, shape=(300, 400)
+    ).flush()
+    tile_bounds = compute_tile_bounds(2, 1, 1)
+    grid = np.ones((100, 100), np.float16)
+    write_tile_total(grid, valid, 2, 1, tile_bounds)
+    daygrid = np.load(get_day_grid_fn(valid))
+    assert daygrid.sum() == 10000
+    assert daygrid[100:200, 200:300].min() == 1
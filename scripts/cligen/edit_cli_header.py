@@ -9,6 +9,7 @@ from tqdm import tqdm
 from pyiem.dep import NORTH, EAST, SOUTH, WEST, get_cli_fname
 from pyiem.iemre import find_ij, get_dailyc_ncname
 from pyiem.util import logger, ncopen, convert_value
+from clifile_store import break_link
 
 LOG = logger()
 REV = "HeaderRev: v20220706.1"
@@ -77,6 +78,8 @@ def process(clifn):
     lines[8] = " ".join(f"{x:-5.1f}" for x in df["lowc"].values) + "\n"
     lines[10] = " ".join(f"{x:-5.1f}" for x in df["swdn"].values) + "\n"
     lines[12] = " ".join(f"{x:-5.1f}" for x in df["p01d"].values) + "\n"
+    # Seeded files may share storage, see clifile_store
+    break_link(clifn)
     with open(clifn, "w", encoding="utf-8") as fh:
         fh.write("".join(lines))
 
@@ -1,4 +1,16 @@
-from daily_clifile_editor import compute_breakpoint
+"""Experiment with the breakpoint thresholds of the Jun 11 2015 storm.
+
+Usage:
+    python exercise.py [benchmark]
+"""
+import sys
+import time
+
+from daily_clifile_editor import (
+    compute_breakpoint,
+    compute_tile_breakpoints,
+    get_breakpoints,
+)
 import pandas as pd
 import subprocess
 import numpy as np
@@ -863,4 +875,56 @@ def plot():
         plt.close()
 
 
-plot()
+def threshold_loop(ar):
+    """The threshold raising loop that edit_clifile used to run."""
+    threshold = 1.0
+    bpdata = compute_breakpoint(ar)
+    passes = 1
+    while len(bpdata) >= 100:
+        threshold += 2
+        bpdata = compute_breakpoint(
+            ar, accumThreshold=threshold, intensityThreshold=threshold
+        )
+        passes += 1
+    return bpdata, passes
+
+
+def benchmark(pixels=200):
+    """Time the breakpoint simplification against the threshold loop.
+
+    The Jun 11 2015 storm is scaled up and shifted in time over a tile of
+    pixels, so that most need to be brought under 100 breakpoints.
+    """
+    rng = np.random.default_rng(2015)
+    rows = []
+    for scale in [1, 2, 4, 8]:
+        tile = np.zeros((1, pixels, len(precip)), np.float16)
+        for i in range(pixels):
+            tile[0, i] = np.roll(precip, rng.integers(-60, 60)) * scale
+        sts = time.perf_counter()
+        loop = [threshold_loop(tile[0, i]) for i in range(pixels)]
+        loop_secs = time.perf_counter() - sts
+        sts = time.perf_counter()
+        bps = compute_tile_breakpoints(tile)
+        single = [get_breakpoints(bps, 0, i) for i in range(pixels)]
+        single_secs = time.perf_counter() - sts
+        rows.append(
+            dict(
+                scale=scale,
+                passes=np.mean([res[1] for res in loop]),
+                loop_bps=np.mean([len(res[0]) for res in loop]),
+                loop_maxrate=np.mean([get_maxrate(res[0]) for res in loop]),
+                loop_secs=loop_secs,
+                single_bps=np.mean([len(res) for res in single]),
+                single_maxrate=np.mean([get_maxrate(res) for res in single]),
+                single_secs=single_secs,
+            )
+        )
+    print(pd.DataFrame(rows).round(3).to_string(index=False))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        benchmark()
+    else:
+        plot()
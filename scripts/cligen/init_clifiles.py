@@ -2,17 +2,26 @@
 
 So lets ensure we have one file per 0.25 degree lat and lon, we can then use
 these to fast-start newly expanded areas...
+
+Usage:
+    python init_clifiles.py [link]
+
+The `link` option hardlinks the files to one stored copy of the source,
+see clifile_store.
 """
 import os
 import shutil
+import sys
 
 import numpy as np
 from pyiem.util import get_dbconn
 from pyiem.dep import SOUTH, EAST, NORTH, WEST, get_cli_fname
+from clifile_store import seed_clifile
 
 
-def main():
+def main(argv):
     """Go Main Go."""
+    link = len(argv) > 1 and argv[1] == "link"
     # We shall use this file, no mater what
     SRC = "/i/0/cli/095x038/095.17x038.13.cli"
     SCENARIO = 0
@@ -43,10 +52,13 @@ def main():
                 os.makedirs(mydir)
             if not os.path.isfile(fn):
                 created += 1
-                shutil.copyfile(SRC, fn)
+                if link:
+                    seed_clifile(SRC, fn)
+                else:
+                    shutil.copyfile(SRC, fn)
 
     print(f"We just created {created} new files, removed {removed} files!")
 
 
 if __name__ == "__main__":
-    main()
+    main(sys.argv)
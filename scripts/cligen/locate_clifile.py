@@ -1,37 +1,41 @@
-"""Find an available precip file after we do expansion."""
+"""Find an available precip file after we do expansion.
+
+Usage:
+    python locate_clifile.py [<scenario> [link]]
+
+The `link` option hardlinks the new files to one stored copy of each
+source, see clifile_store.
+"""
 import os
 import subprocess
 import sys
 
+import numpy as np
 from pyiem.util import get_dbconn, logger
-from pyiem.dep import get_cli_fname
+from clifile_locator import ClifileLocator
+from clifile_store import seed_clifile
 
 LOG = logger()
 
 
-def finder(lon, lat, clscenario):
-    """The logic of finding a file."""
-    # https://stackoverflow.com/questions/398299/looping-in-a-spiral
-    x = y = 0
-    dx = 0
-    dy = -1
+def finder(lon, lat, clscenario, locator=None):
+    """The logic of finding a file.
+
+    Returns:
+      (filename, xoff, yoff) of the nearest file within the 0.4 degree
+      square centered on the point
+    """
+    if locator is None:
+        locator = ClifileLocator(clscenario)
+        locator.refresh()
     # points near the domain edge need to seach a bit further than 0.25deg
-    X = 40
-    Y = 40
-    for _ in range(40**2):
-        if (-X / 2 < x <= X / 2) and (-Y / 2 < y <= Y / 2):
-            newfn = get_cli_fname(lon + x * 0.01, lat + y * 0.01, clscenario)
-            if os.path.isfile(newfn):
-                return newfn, x, y
-        if x == y or (x < 0 and x == -y) or (x > 0 and x == 1 - y):
-            dx, dy = -dy, dx
-        x, y = x + dx, y + dy
-    return None, None, None
+    return locator.nearest(lon, lat, maxdist=20, p=np.inf)
 
 
 def main(argv):
     """Go Main Go."""
     scenario = 0 if len(argv) == 1 else int(argv[1])
+    link = len(argv) > 2 and argv[2] == "link"
     pgconn = get_dbconn("idep")
     cursor = pgconn.cursor()
     # This given scenario may use a different climate scenario's files.
@@ -45,20 +49,23 @@ def main(argv):
         "SELECT climate_file, fid from flowpaths where scenario = %s",
         (scenario,),
     )
+    # One scan of the climate files, instead of a stat per candidate
+    locator = ClifileLocator(clscenario)
+    locator.refresh()
     created = 0
     for row in cursor:
         fn = row[0]
         if fn is None:
             LOG.error("FATAL, found null climate_file, run assign first")
             return
-        if os.path.isfile(fn):
+        if fn in locator or os.path.isfile(fn):
             continue
         created += 1
         # /i/0/cli/092x041/092.30x041.22.cli
         lon, lat = fn.split("/")[-1][:-4].split("x")
         lon = 0 - float(lon)
         lat = float(lat)
-        copyfn, xoff, yoff = finder(lon, lat, clscenario)
+        copyfn, xoff, yoff = finder(lon, lat, clscenario, locator)
         if copyfn is None:
             LOG.info("missing %s for fid: %s ", fn, row[1])
             sys.exit()
@@ -66,7 +73,12 @@ def main(argv):
         mydir = os.path.basename(fn)
         if not os.path.isdir(mydir):
             os.makedirs(mydir)
-        subprocess.call(["cp", copyfn, fn])
+        if link:
+            seed_clifile(copyfn, fn)
+        else:
+            subprocess.call(["cp", copyfn, fn])
+        locator.add(fn)
+    locator.save()
     LOG.info("added %s files", created)
 
 
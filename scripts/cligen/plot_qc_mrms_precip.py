@@ -13,6 +13,7 @@ import matplotlib.pyplot as plt
 from matplotlib.patches import Polygon
 import cartopy.crs as ccrs
 from geopandas import read_postgis
+from precip_archive import read_day
 
 YS = np.arange(SOUTH, NORTH, 0.01)
 XS = np.arange(WEST, EAST, 0.01)
@@ -21,6 +22,11 @@ SECTOR = "iowa"
 
 def load_precip(date, extra=""):
     """Load up our QC'd daily precip dataset"""
+    if extra == "":
+        res = read_day(date)
+        if res is None:
+            print("load_precip(%s) failed, not in archive" % (date,))
+        return res
     fn = date.strftime(
         "/mnt/idep2/data/dailyprecip/%Y/%Y%m%d" + extra + ".npy"
     )
@@ -0,0 +1,295 @@
+"""Yearly chunked archive of the DEP daily precipitation grid.
+
+This replaces the per-day gzipped `.npy` grids.  Each year is a netCDF
+file holding a (time, y, x) `precip` variable that is compressed in
+(1, CHUNK, CHUNK) chunks, so writing a day only touches that day's chunks
+and reading a year for a region only decompresses the chunks covering the
+region.  The `processed` variable records when each day was last written
+and is masked for days not yet written.
+
+As with the tiles, row zero of the grid is the southern edge.
+
+Usage:
+    python precip_archive.py <yyyy> [<yyyy>]
+
+migrates the per-day `%Y/%Y%m%d.npy.gz` files of the inclusive years into
+the archive, the old files are left in place.
+
+When h5py is available, a day's chunks are compressed in threads and
+written directly to the HDF5 storage of the netCDF file, otherwise the
+netCDF library compresses them one at a time.
+"""
+import datetime
+import gzip
+import os
+import sys
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+
+import netCDF4
+import numpy as np
+from pyiem.dep import SOUTH, NORTH, EAST, WEST
+from pyiem.util import ncopen, logger
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+LOG = logger()
+DATADIR = "/mnt/idep2/data/dailyprecip"
+# 1x1 degree blocks, a HUC12 typically falls within a few chunks
+CHUNK = 100
+GRIDSHAPE = (int((NORTH - SOUTH) * 100.0), int((EAST - WEST) * 100.0))
+
+
+def get_archive_fn(year, datadir=DATADIR):
+    """Return the archive filename for this year."""
+    return f"{datadir}/{year}_precip.nc"
+
+
+def create_archive(fn, year, shape=GRIDSHAPE):
+    """Create an empty archive for the year, atomically.
+
+    Args:
+      fn (str): the archive filename
+      year (int): the year
+      shape (tuple): the (y, x) shape of the grid
+    """
+    days = (datetime.date(year + 1, 1, 1) - datetime.date(year, 1, 1)).days
+    tmpfn = f"{fn}.{os.getpid()}.tmp"
+    with netCDF4.Dataset(tmpfn, "w") as nc:
+        nc.title = f"DEP Daily Precipitation {year}"
+        nc.createDimension("time", days)
+        nc.createDimension("y", shape[0])
+        nc.createDimension("x", shape[1])
+        ncv = nc.createVariable("time", float, ("time",))
+        ncv.units = f"days since {year}-01-01 00:00:00"
+        ncv[:] = np.arange(days)
+        ncv = nc.createVariable("lat", float, ("y",))
+        ncv.units = "degrees_north"
+        ncv[:] = SOUTH + np.arange(shape[0]) * 0.01
+        ncv = nc.createVariable("lon", float, ("x",))
+        ncv.units = "degrees_east"
+        ncv[:] = WEST + np.arange(shape[1]) * 0.01
+        ncv = nc.createVariable("processed", float, ("time",))
+        ncv.units = "seconds since 1970-01-01 00:00:00"
+        # The grids are float16 at source, so float32 is lossless
+        ncv = nc.createVariable(
+            "precip",
+            np.float32,
+            ("time", "y", "x"),
+            zlib=True,
+            complevel=1,
+            shuffle=True,
+            chunksizes=(1, min(CHUNK, shape[0]), min(CHUNK, shape[1])),
+        )
+        ncv.units = "mm"
+        ncv.long_name = "Daily Precipitation"
+    os.replace(tmpfn, fn)
+
+
+def _compress_chunk(grid, yslice, xslice, chunks):
+    """Return the HDF5 shuffle + deflate encoded bytes of one chunk."""
+    block = np.zeros(chunks, np.float32)
+    data = grid[yslice, xslice]
+    block[: data.shape[0], : data.shape[1]] = data
+    # The shuffle filter groups the n-th byte of each value together
+    shuffled = block.view(np.uint8).reshape(-1, 4).T.tobytes()
+    return zlib.compress(shuffled, 1)
+
+
+def _write_chunks(fn, offset, grid, threads):
+    """Compress the chunks of the day in threads and write them directly.
+
+    Returns:
+      bool if this was possible with the archive's storage settings
+    """
+    with h5py.File(fn, "r+") as h5:
+        ds = h5["precip"]
+        if ds.compression != "gzip" or not ds.shuffle or ds.fletcher32:
+            return False
+        chunks = ds.chunks[1:]
+        slices = [
+            (slice(y0, y0 + chunks[0]), slice(x0, x0 + chunks[1]))
+            for y0 in range(0, grid.shape[0], chunks[0])
+            for x0 in range(0, grid.shape[1], chunks[1])
+        ]
+        # zlib releases the GIL, so the threads compress in parallel
+        with ThreadPool(threads) as pool:
+            encoded = pool.starmap(
+                _compress_chunk,
+                [(grid, ys, xs, chunks) for ys, xs in slices],
+            )
+        for (ys, xs), data in zip(slices, encoded):
+            ds.id.write_direct_chunk((offset, ys.start, xs.start), data)
+        h5["processed"][offset] = time.time()
+    return True
+
+
+def write_day(date, grid, datadir=DATADIR, threads=None):
+    """Write the (y, x) grid for this date, creating the archive as needed.
+
+    Args:
+      date (date): the date to write
+      grid (np.ndarray): the (y, x) grid, which can be a memmap
+      datadir (str): where the archive lives
+      threads (int): number of compression threads, defaults to the CPUs
+    """
+    fn = get_archive_fn(date.year, datadir)
+    if not os.path.isfile(fn):
+        LOG.info("Creating %s", fn)
+        create_archive(fn, date.year, grid.shape)
+    offset = date.timetuple().tm_yday - 1
+    if h5py is not None and _write_chunks(fn, offset, grid, threads):
+        return
+    # The netCDF library compresses the chunks serially
+    with ncopen(fn, "a") as nc:
+        nc.variables["precip"][offset] = grid
+        nc.variables["processed"][offset] = time.time()
+
+
+def get_last_processed(date, datadir=DATADIR):
+    """Return when this date was last written or None."""
+    fn = get_archive_fn(date.year, datadir)
+    if not os.path.isfile(fn):
+        return None
+    with ncopen(fn) as nc:
+        ts = nc.variables["processed"][date.timetuple().tm_yday - 1]
+    if np.ma.is_masked(ts):
+        return None
+    return time.ctime(float(ts))
+
+
+def read_days(sts, ets, yslice=None, xslice=None, datadir=DATADIR):
+    """Read the inclusive period for a region of the grid.
+
+    Args:
+      sts (date): the first date
+      ets (date): the last date
+      yslice (slice): rows to read, defaults to all
+      xslice (slice): columns to read, defaults to all
+      datadir (str): where the archive lives
+
+    Returns:
+      np.ma.MaskedArray (time, y, x), days not written are masked
+    """
+    yslice = slice(None) if yslice is None else yslice
+    xslice = slice(None) if xslice is None else xslice
+    res = []
+    for year in range(sts.year, ets.year + 1):
+        ysts = max(sts, datetime.date(year, 1, 1))
+        yets = min(ets, datetime.date(year, 12, 31))
+        tslice = slice(ysts.timetuple().tm_yday - 1, yets.timetuple().tm_yday)
+        fn = get_archive_fn(year, datadir)
+        if not os.path.isfile(fn):
+            LOG.info("Missing precip archive: %s", fn)
+            res.append(None)
+            continue
+        with ncopen(fn) as nc:
+            written = ~np.ma.getmaskarray(nc.variables["processed"][tslice])
+            data = nc.variables["precip"][tslice, yslice, xslice]
+        data = np.ma.array(data)
+        data[~written] = np.ma.masked
+        res.append(data)
+    # Whole years missing take the shape of the others
+    shape = None
+    for data in res:
+        if data is not None:
+            shape = data.shape[1:]
+    if shape is None:
+        return None
+    for i, year in enumerate(range(sts.year, ets.year + 1)):
+        if res[i] is None:
+            ysts = max(sts, datetime.date(year, 1, 1))
+            yets = min(ets, datetime.date(year, 12, 31))
+            res[i] = np.ma.masked_all(((yets - ysts).days + 1, *shape))
+    return np.ma.concatenate(res)
+
+
+def read_day(date, datadir=DATADIR):
+    """Return the full (y, x) grid for this date or None when missing."""
+    data = read_days(date, date, datadir=datadir)
+    if data is None or np.ma.count(data) == 0:
+        return None
+    return data[0].filled(np.nan)
+
+
+def migrate(year, datadir=DATADIR):
+    """Write the legacy per-day files of the year into the archive.
+
+    Returns:
+      int count of days migrated
+    """
+    date = datetime.date(year, 1, 1)
+    days = 0
+    while date.year == year:
+        fn = f"{datadir}/{year}/{date:%Y%m%d}.npy.gz"
+        if os.path.isfile(fn):
+            with gzip.GzipFile(fn, "r") as fh:
+                write_day(date, np.load(file=fh), datadir)
+            days += 1
+        date += datetime.timedelta(days=1)
+    return days
+
+
+def main(argv):
+    """Migrate the given years."""
+    year1 = int(argv[1])
+    year2 = int(argv[2]) if len(argv) > 2 else year1
+    for year in range(year1, year2 + 1):
+        LOG.info("Migrated %s days for %s", migrate(year), year)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
+
+
+def test_archive(tmp_path):
+    """Test that we can write and read days from the archive."""
+    datadir = str(tmp_path)
+    rng = np.random.default_rng(0)
+    grid = (rng.random((150, 220)) * 50).astype(np.float16)
+    date = datetime.date(2020, 12, 31)
+    assert read_day(date, datadir) is None
+    write_day(date, grid, datadir)
+    assert get_last_processed(date, datadir) is not None
+    assert (
+        get_last_processed(date - datetime.timedelta(days=1), datadir) is None
+    )
+    np.testing.assert_array_equal(read_day(date, datadir), grid)
+    assert read_day(datetime.date(2020, 1, 1), datadir) is None
+    # Legacy files get migrated
+    os.makedirs(f"{datadir}/2021")
+    with gzip.GzipFile(f"{datadir}/2021/20210102.npy.gz", "w") as fh:
+        np.save(file=fh, arr=grid.astype(np.float64) * 2)
+    assert migrate(2021, datadir) == 1
+    # Read a region spanning the two years
+    data = read_days(
+        datetime.date(2020, 12, 30),
+        datetime.date(2021, 1, 3),
+        slice(100, 120),
+        slice(0, 10),
+        datadir,
+    )
+    assert data.shape == (5, 20, 10)
+    assert np.ma.count(data[0]) == 0
+    np.testing.assert_array_equal(data[1], grid[100:120, :10])
+    np.testing.assert_array_equal(data[3], grid[100:120, :10] * 2)
+    assert np.ma.count(data[4]) == 0
+
+
+def test_write_paths(tmp_path, monkeypatch):
+    """Test that direct chunk writes match the netCDF library's."""
+    datadir = str(tmp_path)
+    rng = np.random.default_rng(1)
+    grid = (rng.random((230, 120)) * 20).astype(np.float16)
+    write_day(datetime.date(2019, 3, 1), grid, datadir, threads=2)
+    monkeypatch.setattr(sys.modules[__name__], "h5py", None)
+    write_day(datetime.date(2019, 3, 2), grid, datadir)
+    data = read_days(
+        datetime.date(2019, 3, 1), datetime.date(2019, 3, 2), datadir=datadir
+    )
+    np.testing.assert_array_equal(data[0], grid)
+    np.testing.assert_array_equal(data[1], grid)
@@ -1,49 +1,65 @@
 """Proctor the editing of DEP CLI files.
 
 Usage:
-    python proctor_tile_edit.py <scenario> <yyyy> <mm> <dd>
+    python proctor_tile_edit.py <scenario> <yyyy> <mm> <dd> \
+        [<yyyy> <mm> <dd>] [subprocess]
+
+By default, the tiles are run by forked workers that share the day's IEMRE
+and Stage IV inputs, each worker loading its next tile while the current
+tile's files are edited.  The `subprocess` option runs the legacy
+one `daily_clifile_editor.py` process per tile workflow.  The optional
+second date backfills the inclusive date range, with each climate file
+opened once per tile for all of the days.
 """
-import gzip
 import sys
 import os
-import stat
 import datetime
+import multiprocessing
 import subprocess
-import time
 from multiprocessing import cpu_count
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import numpy as np
 from pyiem.dep import SOUTH, NORTH, EAST, WEST
 from pyiem.util import logger
+from daily_clifile_editor import (
+    BOUNDS,
+    prefetch_mrms,
+    cleanup_mrms,
+    get_day_grid_fn,
+    load_day_inputs,
+    log_stage_stats,
+    merge_stage_stats,
+    new_stage_stats,
+    run_tiles,
+)
+from precip_archive import GRIDSHAPE, get_last_processed, write_day
 
 LOG = logger()
-DATADIR = "/mnt/idep2/data/dailyprecip"
-
+# 12 Nov 2021 audit showed per process usage in the 2-3 GB range, which was
+# dominated by the dense (500, 500, 720) precip cube.  A SparsePrecip is
+# smaller on dry days, but wet days and the legacy N0R path are still dense.
+TILE_MEMORY = 3 * 1024**3
+# Day inputs and the tile queue are set in the parent before forking, so
+# the workers inherit them
+DAY_INPUTS = {}
 
-def get_fn(date):
-    """Return the filename for this date."""
-    return f"{DATADIR}/{date.year}/{date:%Y%m%d}.npy.gz"
 
+def create_day_grid(date):
+    """Create the zeroed day grid that the tiles write into as they finish."""
+    fn = get_day_grid_fn(date)
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    grid = np.lib.format.open_memmap(
+        fn, mode="w+", dtype=np.float16, shape=GRIDSHAPE
+    )
+    grid.flush()
 
-def assemble_grids(tilesz, date):
-    """Build back the grid from the tiles."""
-    YS = int((NORTH - SOUTH) * 100.0)
-    XS = int((EAST - WEST) * 100.0)
-    res = np.zeros((YS, XS))
-    basedir = f"{DATADIR}/{date.year}"
-    for i, _lon in enumerate(np.arange(WEST, EAST, tilesz)):
-        for j, _lat in enumerate(np.arange(SOUTH, NORTH, tilesz)):
-            fn = f"{basedir}/{date:%Y%m%d}.tile_{i}_{j}.npy"
-            if not os.path.isfile(fn):
-                continue
-            yslice = slice(j * 100 * tilesz, (j + 1) * 100 * tilesz)
-            xslice = slice(i * 100 * tilesz, (i + 1) * 100 * tilesz)
-            res[yslice, xslice] = np.load(fn)
-            os.unlink(fn)
 
-    with gzip.GzipFile(get_fn(date), "w") as fh:
-        np.save(file=fh, arr=res)
+def assemble_grids(date):
+    """Archive the day grid filled in by the tiles."""
+    fn = get_day_grid_fn(date)
+    write_day(date, np.load(fn, mmap_mode="r"))
+    os.unlink(fn)
 
 
 def myjob(cmd):
@@ -62,37 +78,143 @@ def myjob(cmd):
     return proc.returncode
 
 
+def get_available_memory():
+    """Return the bytes of memory available for new work."""
+    try:
+        with open("/proc/meminfo", encoding="ascii") as fh:
+            for line in fh:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def compute_workers(tile_memory=TILE_MEMORY):
+    """How many tiles can we run at once without exhausting memory."""
+    fits = int(get_available_memory() / tile_memory)
+    return max(1, min(cpu_count(), fits))
+
+
+def tile_task(scenario, dates):
+    """Pipeline the shared queue of tiles within a worker, never raise.
+
+    Returns:
+      (list of `run_tiles` results, stage stats)
+    """
+    stats = new_stage_stats()
+    tiles = iter(DAY_INPUTS["tiles"].get, None)
+    results = run_tiles(
+        tiles, scenario, dates, DAY_INPUTS["inputs"], stats=stats
+    )
+    return results, stats
+
+
+def run_inprocess(jobs, scenario, dates):
+    """Run the tiles as tasks of forked workers sharing the day inputs."""
+    # Only read the source hyperslab covering the DEP domain
+    domain = BOUNDS(south=SOUTH, north=NORTH, east=EAST, west=WEST)
+    DAY_INPUTS["inputs"] = {
+        date: load_day_inputs(date, domain) for date in dates
+    }
+    workers = compute_workers()
+    LOG.debug("starting %s in-process workers", workers)
+    # Workers pull tiles as they go, so a slow tile does not stall others
+    ctx = multiprocessing.get_context("fork")
+    DAY_INPUTS["tiles"] = ctx.Queue()
+    for job in jobs:
+        DAY_INPUTS["tiles"].put(job)
+    for _ in range(workers):
+        DAY_INPUTS["tiles"].put(None)
+    failed = False
+    stats = new_stage_stats()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as executor:
+        futures = [
+            executor.submit(tile_task, scenario, dates) for _ in range(workers)
+        ]
+        for future in as_completed(futures):
+            results, worker_stats = future.result()
+            merge_stage_stats(stats, worker_stats)
+            for i, j, seconds, edit_errors, error in results:
+                LOG.info(
+                    "tile %s %s took %.1fs with %s edit errors",
+                    i,
+                    j,
+                    seconds,
+                    edit_errors,
+                )
+                if error is not None:
+                    failed = True
+                    LOG.warning("tile %s %s failed: %s", i, j, error)
+    log_stage_stats(stats)
+    return failed
+
+
+def run_subprocess(jobs, scenario, dates):
+    """Run the tiles as one daily_clifile_editor.py process each."""
+    period = f"{dates[0]:%Y %m %d}"
+    if len(dates) > 1:
+        period += f" {dates[-1]:%Y %m %d}"
+    cmds = [
+        f"python daily_clifile_editor.py {i} {j} {tilesz} "
+        f"{scenario} {period}"
+        for i, j, tilesz in jobs
+    ]
+    failed = False
+    workers = int(min([4, cpu_count() / 4]))
+    LOG.debug("starting %s workers", workers)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for cmd, res in zip(cmds, executor.map(myjob, cmds)):
+            if res != 0:
+                failed = True
+                LOG.warning("job: %s exited with status code %s", cmd, res)
+    return failed
+
+
 def main(argv):
     """Go Main Go."""
     tilesz = 5
     scenario = argv[1]
-    date = datetime.date(int(argv[2]), int(argv[3]), int(argv[4]))
-    fn = get_fn(date)
-    if os.path.isfile(fn):
-        filets = os.stat(fn)[stat.ST_MTIME]
-        LOG.warning("%s was last processed on %s", date, time.ctime(filets))
+    sdate = datetime.date(int(argv[2]), int(argv[3]), int(argv[4]))
+    edate = sdate
+    if len(argv) > 7:
+        edate = datetime.date(int(argv[5]), int(argv[6]), int(argv[7]))
+    use_subprocess = argv[-1] == "subprocess"
+    dates = [
+        sdate + datetime.timedelta(days=i)
+        for i in range((edate - sdate).days + 1)
+    ]
+    for date in dates:
+        processed = get_last_processed(date)
+        if processed is not None:
+            LOG.warning("%s was last processed on %s", date, processed)
     jobs = []
     for i, _lon in enumerate(np.arange(WEST, EAST, tilesz)):
         for j, _lat in enumerate(np.arange(SOUTH, NORTH, tilesz)):
-            cmd = (
-                f"python daily_clifile_editor.py {i} {j} {tilesz} "
-                f"{scenario} {date:%Y %m %d}"
-            )
-            jobs.append(cmd)
-    failed = False
-    # 12 Nov 2021 audit shows per process usage in the 2-3 GB range
-    workers = int(min([4, cpu_count() / 4]))
-    LOG.debug("starting %s workers", workers)
-    with ProcessPoolExecutor(max_workers=workers) as executor:
-        for job, res in zip(jobs, executor.map(myjob, jobs)):
-            if res != 0:
-                failed = True
-                LOG.warning("job: %s exited with status code %s", job, res)
+            jobs.append((i, j, tilesz))
+    for date in dates:
+        create_day_grid(date)
+    # Decode the a2m PNGs once for all of the tiles, see load_precip.  The
+    # cube is large, so a backfill has each tile read its own PNG windows
+    prefetch = len(dates) == 1 and sdate.year >= 2015
+    if prefetch:
+        LOG.debug("prefetching MRMS a2m for %s", sdate)
+        prefetch_mrms(sdate)
+    try:
+        if use_subprocess:
+            failed = run_subprocess(jobs, scenario, dates)
+        else:
+            failed = run_inprocess(jobs, int(scenario), dates)
+    finally:
+        # a BrokenProcessPool must not leave the shared cube behind
+        if prefetch:
+            cleanup_mrms(sdate)
     if failed:
         LOG.warning("Aborting due to job failures")
         sys.exit(3)
 
-    assemble_grids(tilesz, date)
+    for date in dates:
+        assemble_grids(date)
 
 
 if __name__ == "__main__":
@@ -1,6 +1,5 @@
 """R factor work."""
 
-from pyiem.dep import read_cli
 from pyiem.util import get_sqlalchemy_conn
 from pyiem.plot.use_agg import plt
 from pyiem.plot import MapPlot
@@ -8,14 +7,14 @@ import cartopy.crs as ccrs
 import matplotlib.colors as mpcolors
 from matplotlib.patches import Polygon
 import numpy as np
-from tqdm import tqdm
 import geopandas as gpd
 import pandas as pd
+from clifile_rfactor import get_cache_fn, update
 
 
 def plot():
     """Plot."""
-    df2 = pd.read_csv("/tmp/data.csv", dtype={"huc12": str}).set_index("huc12")
+    df2 = pd.read_parquet("/tmp/data.parquet").set_index("huc12")
     with get_sqlalchemy_conn("idep") as conn:
         df = gpd.read_postgis(
             "SELECT huc_12, ST_Transform(simple_geom, 4326) as geom "
@@ -76,32 +75,26 @@ def dump_data():
             conn,
             index_col="huc_12",
         )
-    data = {
-        "huc12": [],
-        "rfactor_yr_avg": [],
-        "rfactor_yr_max": [],
-        "rfactor_yr_min": [],
-        "rfactor_min_year": [],
-        "rfactor_max_year": [],
-    }
-    for year in range(2007, 2022):
-        data[f"rfactor_{year}"] = []
-    for huc_12, row in tqdm(df.iterrows(), total=len(df.index)):
-        fn = row["cli"].replace("/i/", "/mnt/idep2/2/")
-        cdf = read_cli(fn, compute_rfactor=True)
-        data["huc12"].append(huc_12)
-        # drop 2020
-        yearly = cdf["rfactor"].groupby(cdf.index.year).sum().iloc[:-1]
-        data["rfactor_yr_avg"].append(yearly.mean())
-        data["rfactor_yr_min"].append(yearly.min())
-        data["rfactor_yr_max"].append(yearly.max())
-        data["rfactor_min_year"].append(yearly.idxmin())
-        data["rfactor_max_year"].append(yearly.idxmax())
-        for year in range(2007, 2022):
-            data[f"rfactor_{year}"].append(yearly.loc[year])
-
-    df = pd.DataFrame(data)
-    df.to_csv("/tmp/data.csv", index=False)
+    df["cli"] = df["cli"].str.replace("/i/", "/mnt/idep2/2/")
+    yearly = update(
+        df["cli"].unique().tolist(), get_cache_fn(0, "/mnt/idep2/2")
+    ).pivot(index="filename", columns="year", values="rfactor")
+    # drop the current, partial, year
+    yearly = yearly.iloc[:, :-1]
+    data = pd.DataFrame(
+        {
+            "rfactor_yr_avg": yearly.mean(axis=1),
+            "rfactor_yr_max": yearly.max(axis=1),
+            "rfactor_yr_min": yearly.min(axis=1),
+            "rfactor_min_year": yearly.idxmin(axis=1),
+            "rfactor_max_year": yearly.idxmax(axis=1),
+        }
+    )
+    for year in yearly.columns:
+        data[f"rfactor_{year}"] = yearly[year]
+    df = df.join(data, on="cli").drop(columns="cli")
+    df.index.name = "huc12"
+    df.reset_index().to_parquet("/tmp/data.parquet", index=False)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,282 @@
+"""Sparse storage of the 2 minute precipitation for a climate editor tile.
+
+Most pixels are dry on most days, so rather than a dense (y, x, 720) cube,
+we only keep the non-zero values in CSR form, sorted by pixel then time.
+An entry takes 8 bytes against 2 for a dense float16 cell, so past a
+quarter of the cells being wet, the dense array is the smaller one.
+"""
+import numpy as np
+
+# share of wet cells beyond which a tile is stored densely
+DENSE_FRACTION = 0.2
+
+
+class SparsePrecip:
+    """Non-zero 2 minute precip values of a (y, x, timesteps) tile.
+
+    Once more than `dense_fraction` of the cells are wet, the entries are
+    larger than a dense array, so the values move to a dense
+    (pixels, timesteps) array for the rest of the day.
+    """
+
+    def __init__(
+        self,
+        shape,
+        steps=30 * 24,
+        dtype=np.float16,
+        dense_fraction=DENSE_FRACTION,
+    ):
+        """Create an all dry tile.
+
+        Args:
+          shape (tuple): the (y, x) shape of the tile
+          steps (int): number of timesteps in the day
+          dtype (np.dtype): storage type of the values
+          dense_fraction (float): share of wet cells to switch to dense at
+        """
+        self.shape = (shape[0], shape[1], steps)
+        self.dtype = np.dtype(dtype)
+        self.npixels = shape[0] * shape[1]
+        # flat pixel index, time index and value for each entry
+        self.pixel = np.zeros(0, np.int32)
+        self.tidx = np.zeros(0, np.int16)
+        self.values = np.zeros(0, self.dtype)
+        self.ptr = np.zeros(self.npixels + 1, np.int64)
+        self.dense = None
+        self.maxentries = int(dense_fraction * self.npixels * steps)
+        self._pending = []
+        self._npending = 0
+        # pixels replaced by assign_rows since the last consolidation
+        self._replaced = None
+
+    @classmethod
+    def from_dense(cls, cube):
+        """Build from a dense (y, x, timesteps) array."""
+        res = cls(cube.shape[:2], cube.shape[2], cube.dtype)
+        flat = cube.reshape(res.npixels, res.shape[2])
+        pixel, tidx = np.nonzero(flat != 0)
+        res._append(pixel, tidx, flat[pixel, tidx])
+        res._consolidate()
+        return res
+
+    @property
+    def nbytes(self):
+        """Memory used by the entries."""
+        if self.dense is not None:
+            return self.dense.nbytes
+        return (
+            self.pixel.nbytes
+            + self.tidx.nbytes
+            + self.values.nbytes
+            + self.ptr.nbytes
+        )
+
+    def _append(self, pixel, tidx, values):
+        """Queue entries, switching to dense when they get too many."""
+        self._pending.append(
+            (
+                pixel.astype(np.int32),
+                tidx.astype(np.int16),
+                values.astype(self.dtype),
+            )
+        )
+        self._npending += pixel.size
+        if self.values.size + self._npending > self.maxentries:
+            self.densify()
+
+    def _current(self):
+        """Return the consolidated entries not replaced by assign_rows."""
+        if self._replaced is None:
+            return self.pixel, self.tidx, self.values
+        keep = ~self._replaced[self.pixel]
+        return self.pixel[keep], self.tidx[keep], self.values[keep]
+
+    def _consolidate(self):
+        """Merge pending entries and rebuild the CSR offsets."""
+        if self.dense is not None or (
+            not self._pending and self._replaced is None
+        ):
+            return
+        current = self._current()
+        pixel = np.concatenate([current[0], *[p[0] for p in self._pending]])
+        tidx = np.concatenate([current[1], *[p[1] for p in self._pending]])
+        values = np.concatenate([current[2], *[p[2] for p in self._pending]])
+        self._pending = []
+        self._npending = 0
+        self._replaced = None
+        order = np.argsort(
+            pixel.astype(np.int64) * self.shape[2] + tidx, kind="stable"
+        )
+        self.pixel = pixel[order]
+        self.tidx = tidx[order]
+        self.values = values[order]
+        self.ptr[0] = 0
+        np.cumsum(
+            np.bincount(self.pixel, minlength=self.npixels), out=self.ptr[1:]
+        )
+
+    def densify(self):
+        """Move the values to a dense array, without sorting the entries."""
+        if self.dense is not None:
+            return
+        dense = np.zeros((self.npixels, self.shape[2]), self.dtype)
+        pixel, tidx, values = self._current()
+        dense[pixel, tidx] = values
+        for pixel, tidx, values in self._pending:
+            dense[pixel, tidx] = values
+        self.dense = dense
+        self.pixel = np.zeros(0, np.int32)
+        self.tidx = np.zeros(0, np.int16)
+        self.values = np.zeros(0, self.dtype)
+        self._pending = []
+        self._npending = 0
+        self._replaced = None
+
+    def set_step(self, tidx, grid):
+        """Set the (y, x) grid of values for a timestep that is still dry."""
+        vals = np.asarray(grid).astype(self.dtype).ravel()
+        if self.dense is not None:
+            self.dense[:, tidx] = vals
+            return
+        pixel = np.nonzero(vals != 0)[0]
+        self._append(pixel, np.full(pixel.size, tidx), vals[pixel])
+
+    def assign_rows(self, yidx, xidx, rows):
+        """Replace all timesteps of the given pixels.
+
+        The entries are merged once when next read, so a pixel must only
+        be assigned once in between.
+
+        Args:
+          yidx, xidx (np.ndarray): the pixels to replace
+          rows (np.ndarray): (pixels, timesteps) new values
+        """
+        pixels = np.ravel_multi_index((yidx, xidx), self.shape[:2])
+        rows = np.asarray(rows).astype(self.dtype)
+        if self.dense is not None:
+            self.dense[pixels] = rows
+            return
+        if self._replaced is None:
+            # set_step entries of these pixels must go before we queue more
+            self._consolidate()
+            self._replaced = np.zeros(self.npixels, bool)
+        self._replaced[pixels] = True
+        ridx, tidx = np.nonzero(rows != 0)
+        self._append(pixels[ridx], tidx, rows[ridx, tidx])
+
+    def wet_pixels(self):
+        """Return the flat index of the pixels with any entries."""
+        if self.dense is not None:
+            return np.nonzero(np.any(self.dense != 0, axis=1))[0]
+        self._consolidate()
+        return np.nonzero(np.diff(self.ptr) > 0)[0]
+
+    def rows(self, pixels):
+        """Return the dense (len(pixels), timesteps) values for pixels."""
+        pixels = np.asarray(pixels)
+        if self.dense is not None:
+            return self.dense[pixels]
+        self._consolidate()
+        res = np.zeros((pixels.size, self.shape[2]), self.dtype)
+        starts = self.ptr[pixels]
+        counts = self.ptr[pixels + 1] - starts
+        ridx = np.repeat(np.arange(pixels.size), counts)
+        # offsets of every entry belonging to the requested pixels
+        eidx = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        eidx += np.arange(ridx.size)
+        res[ridx, self.tidx[eidx]] = self.values[eidx]
+        return res
+
+    def row(self, yidx, xidx):
+        """Return the dense timesteps for one pixel."""
+        return self.rows([yidx * self.shape[1] + xidx])[0]
+
+    def total(self, chunksize=16384):
+        """Return the (y, x) daily total, the same as a dense np.sum."""
+        res = np.zeros(self.npixels, self.dtype)
+        wet = self.wet_pixels()
+        for sl in range(0, wet.size, chunksize):
+            pixels = wet[sl : sl + chunksize]
+            res[pixels] = np.sum(self.rows(pixels), axis=1)
+        return res.reshape(self.shape[:2])
+
+    def scale(self, multiplier, chunksize=16384):
+        """Multiply each pixel by the (y, x) multiplier, NaN becomes zero."""
+        mul = np.ravel(multiplier)
+        if self.dense is not None:
+            for sl in range(0, self.npixels, chunksize):
+                block = (
+                    self.dense[sl : sl + chunksize]
+                    * mul[sl : sl + chunksize, None]
+                ).astype(self.dtype)
+                block[np.isnan(block)] = 0
+                self.dense[sl : sl + chunksize] = block
+            return
+        self._consolidate()
+        values = (self.values * mul[self.pixel]).astype(self.dtype)
+        keep = np.logical_and(~np.isnan(values), values != 0)
+        self.pixel = self.pixel[keep]
+        self.tidx = self.tidx[keep]
+        self.values = values[keep]
+        np.cumsum(
+            np.bincount(self.pixel, minlength=self.npixels), out=self.ptr[1:]
+        )
+
+
+def test_roundtrip():
+    """Test that we get back what we put in."""
+    rng = np.random.default_rng(3)
+    cube = (rng.random((3, 4, 20)) * (rng.random((3, 4, 20)) < 0.3)).astype(
+        np.float16
+    )
+    sp = SparsePrecip((3, 4), 20, dense_fraction=1.0)
+    for tidx in range(20):
+        sp.set_step(tidx, cube[:, :, tidx])
+    assert sp.dense is None
+    assert sp.nbytes > 0
+    for yidx in range(3):
+        for xidx in range(4):
+            np.testing.assert_array_equal(sp.row(yidx, xidx), cube[yidx, xidx])
+    np.testing.assert_array_equal(sp.total(chunksize=5), np.sum(cube, 2))
+    newrows = np.ones((2, 20))
+    sp.assign_rows(np.array([0, 2]), np.array([1, 3]), newrows)
+    cube[0, 1] = 1
+    cube[2, 3] = 1
+    np.testing.assert_array_equal(
+        SparsePrecip.from_dense(cube).rows(np.arange(12)),
+        sp.rows(np.arange(12)),
+    )
+    mul = rng.random((3, 4)) * 2
+    mul[1, 1] = np.nan
+    sp.scale(mul)
+    cube[:] *= mul[:, :, None]
+    cube[np.isnan(cube)] = 0
+    np.testing.assert_array_equal(sp.rows(np.arange(12)), cube.reshape(12, 20))
+
+
+def test_dense_fallback():
+    """Test that a wet tile switches to dense storage and reads the same."""
+    rng = np.random.default_rng(5)
+    cube = (rng.random((3, 4, 20)) * (rng.random((3, 4, 20)) < 0.5)).astype(
+        np.float16
+    )
+    sp = SparsePrecip((3, 4), 20)
+    for tidx in range(3):
+        sp.set_step(tidx, cube[:, :, tidx])
+    assert sp.dense is None
+    assert sp._pending[0][0].dtype == np.int32
+    for tidx in range(3, 20):
+        sp.set_step(tidx, cube[:, :, tidx])
+    assert sp.dense is not None
+    assert sp.nbytes == 3 * 4 * 20 * 2
+    np.testing.assert_array_equal(sp.rows(np.arange(12)), cube.reshape(12, 20))
+    np.testing.assert_array_equal(sp.total(), np.sum(cube, 2))
+    sp.assign_rows(np.array([1]), np.array([2]), np.zeros((1, 20)))
+    cube[1, 2] = 0
+    assert 6 not in sp.wet_pixels()
+    mul = rng.random((3, 4)) * 2
+    mul[0, 0] = np.nan
+    sp.scale(mul, chunksize=5)
+    cube[:] *= mul[:, :, None]
+    cube[np.isnan(cube)] = 0
+    np.testing.assert_array_equal(sp.rows(np.arange(12)), cube.reshape(12, 20))
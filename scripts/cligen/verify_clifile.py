@@ -1,61 +1,294 @@
-"""Verify that a climate file is well formed."""
+"""Verify that climate files are well formed.
+
+Usage:
+    python verify_clifile.py <clifile>
+    python verify_clifile.py <scenario> [incremental] [<report.csv|parquet>]
+
+The first prints the violations found in one file.  The second checks the
+`/i/<scenario>/cli` tree over a process pool and writes the violations to
+a report, by default `/i/<scenario>/cli_verify.csv`.  With `incremental`,
+only files modified since the last run are checked and their previous
+violations in the report are replaced.
+"""
+import json
+import os
 import sys
-import datetime
+import time
+from multiprocessing import Pool
 
+import numpy as np
+import pandas as pd
+from pyiem.util import logger
 
-def main(argv):
-    """Run for a given file."""
-    with open(argv[1], encoding="ascii") as fh:
-        lines = fh.readlines()
-    tokens = lines[4].strip().split()
-    syear = int(tokens[4])
-    # simyears = int(tokens[5])
-    linenum = 15
-    yesterday = datetime.date(syear - 1, 12, 31)
-    while linenum < len(lines):
-        tokens = lines[linenum].split()
-        if len(tokens) < 4:
-            print(f"linenum: {linenum} has len(tokens): {len(tokens)}")
-        thisdate = datetime.date(
-            int(tokens[2]), int(tokens[1]), int(tokens[0])
+LOG = logger()
+HEADER_LINES = 15
+MAX_BREAKPOINTS = 100
+# inclusive valid ranges of the day line values by token index
+RANGES = {
+    4: ("tmax", -60.0, 60.0),
+    5: ("tmin", -60.0, 60.0),
+    6: ("rad", 0.0, 1500.0),
+    7: ("wvl", 0.0, 60.0),
+    8: ("wdir", 0.0, 360.0),
+    9: ("tdew", -60.0, 60.0),
+}
+COLUMNS = ["filename", "linenum", "date", "check", "value"]
+
+
+def _ordinal(dates):
+    """Convert (n, 3) day, month, year ints to datetime64[D]."""
+    ymd = (
+        (dates[:, 2] - 1970).astype("datetime64[Y]").astype("datetime64[M]")
+        + (dates[:, 1] - 1).astype("timedelta64[M]")
+    ).astype("datetime64[D]")
+    return ymd + (dates[:, 0] - 1).astype("timedelta64[D]")
+
+
+def check_text(data):
+    """Check the climate file text.
+
+    Args:
+      data (bytes): the climate file content
+
+    Returns:
+      list of (linenum, date, check, value) violations, linenum is 1-based
+    """
+    res = []
+    lines = np.array(data.split(b"\n")[HEADER_LINES:])
+    lines = lines[np.char.str_len(np.char.strip(lines)) > 0]
+    linenums = np.arange(len(lines)) + HEADER_LINES + 1
+    if not len(lines):
+        return [(HEADER_LINES, None, "empty", "")]
+    # Day lines are tab delimited, breakpoints are space delimited
+    isday = np.char.find(lines, b"\t") >= 0
+    if not isday[0]:
+        return [(int(linenums[0]), None, "tokens", lines[0].decode())]
+    daylinenums = linenums[isday]
+    ntokens = np.char.count(lines[isday], b"\t") + 1
+    for idx in np.where(ntokens != 10)[0]:
+        res.append((int(daylinenums[idx]), None, "tokens", ntokens[idx]))
+    if res:
+        return res
+    # Tokenize and convert all of the day lines at once
+    values = np.array(
+        list(map(float, b"\t".join(lines[isday]).split(b"\t")))
+    ).reshape(-1, 10)
+    dates = _ordinal(values[:, :3].astype(int))
+    datestr = np.datetime_as_string(dates)
+    syear = int(data.split(b"\n")[4].split()[4])
+    gaps = np.diff(dates, prepend=np.datetime64(f"{syear - 1}-12-31"))
+    for idx in np.where(gaps != np.timedelta64(1, "D"))[0]:
+        res.append(
+            (int(daylinenums[idx]), datestr[idx], "date", str(gaps[idx]))
+        )
+    nbp = values[:, 3].astype(int)
+    for idx in np.where(nbp > MAX_BREAKPOINTS)[0]:
+        res.append((int(daylinenums[idx]), datestr[idx], "bpcount", nbp[idx]))
+    for col, (name, low, high) in RANGES.items():
+        vals = values[:, col]
+        for idx in np.where((vals < low) | (vals > high))[0]:
+            res.append((int(daylinenums[idx]), datestr[idx], name, vals[idx]))
+    # Breakpoint lines, assigned to the preceding day
+    dayidx = np.cumsum(isday)[~isday] - 1
+    found = np.bincount(dayidx, minlength=len(nbp))
+    for idx in np.where(found != nbp)[0]:
+        res.append(
+            (int(daylinenums[idx]), datestr[idx], "bplines", found[idx])
         )
-        if (thisdate - yesterday) != datetime.timedelta(days=1):
-            print(
-                f"linenum: {linenum} has date: {thisdate}, "
-                f"not {yesterday + datetime.timedelta(days=1)}"
+    if not len(dayidx):
+        return res
+    bplinenums = linenums[~isday]
+    tokens = b" ".join(lines[~isday]).split()
+    if len(tokens) != 2 * len(bplinenums):
+        for idx, line in enumerate(lines[~isday]):
+            if len(line.split()) != 2:
+                res.append(
+                    (
+                        int(bplinenums[idx]),
+                        datestr[dayidx[idx]],
+                        "tokens",
+                        len(line.split()),
+                    )
+                )
+        return res
+    bp = np.array(list(map(float, tokens))).reshape(-1, 2)
+    # the first breakpoint of each day has nothing to compare against
+    first = np.diff(dayidx, prepend=-1) != 0
+    # times and accumulations must strictly increase, as repeated
+    # accumulations crash WEPP
+    for col, name, high in [(0, "time", 24.0), (1, "accum", 350.0)]:
+        vals = bp[:, col]
+        for idx in np.where((vals < 0) | (vals >= high))[0]:
+            res.append(
+                (int(bplinenums[idx]), datestr[dayidx[idx]], name, vals[idx])
             )
-        yesterday = thisdate
-        lastprecip = -1
-        lasttime = ""
-        ftime = 0
-        nrbkpts = int(tokens[3])
-        if nrbkpts > 100:
-            print(f"Date: {thisdate} has nrbkpts: {nrbkpts} > 100")
-        for _ in range(nrbkpts):
-            linenum += 1
-            tokens = lines[linenum].split()
-            if len(tokens) != 2:
-                print(f"linenum: {linenum} has bad token count")
-            if tokens[0] == lasttime:
-                print(f"linenum: {linenum} has duplicated time")
-            if float(tokens[0]) < ftime:
-                print(f"linenum: {linenum} has time {tokens[0]} < {ftime}")
-            ftime = float(tokens[0])
-            lasttime = tokens[0]
-            tm = float(tokens[0])
-            if tm < 0 or tm >= 24:
-                print(f"linenum: {linenum} has bad time: {tokens[0]}")
-            precip = float(tokens[1])
-            if precip < 0 or precip >= 350:
-                print(f"{thisdate} line: {linenum} has bad prec: {tokens[1]}")
-            if precip <= lastprecip:
-                print(
-                    f"{thisdate} line: {linenum} has decreasing "
-                    f"prec: {tokens[1]}, last {lastprecip}"
+        delta = np.diff(vals, prepend=-1)
+        decreasing = (delta <= 0) & ~first
+        for idx in np.where(decreasing)[0]:
+            res.append(
+                (
+                    int(bplinenums[idx]),
+                    datestr[dayidx[idx]],
+                    f"{name}_order",
+                    vals[idx],
                 )
-            lastprecip = precip
-        linenum += 1
+            )
+    return res
+
+
+def check_file(fn):
+    """Check one climate file, never raise.
+
+    Returns:
+      (filename, list of violations)
+    """
+    try:
+        with open(fn, "rb") as fh:
+            return fn, check_text(fh.read())
+    except Exception as exp:  # pylint: disable=broad-except
+        return fn, [(0, None, "exception", str(exp))]
+
+
+def find_files(clidir, since=None):
+    """Return the climate files within the directory modified since."""
+    res = []
+    with os.scandir(clidir) as it:
+        for entry in it:
+            if not entry.is_dir():
+                continue
+            with os.scandir(entry.path) as it2:
+                for entry2 in it2:
+                    if not entry2.name.endswith(".cli"):
+                        continue
+                    if since is None or entry2.stat().st_mtime >= since:
+                        res.append(entry2.path)
+    return res
+
+
+def read_report(fn):
+    """Return the report dataframe, empty if it does not exist."""
+    if not os.path.isfile(fn):
+        return pd.DataFrame(columns=COLUMNS)
+    if fn.endswith(".parquet"):
+        return pd.read_parquet(fn)
+    return pd.read_csv(fn, dtype={"value": str})
+
+
+def write_report(df, fn):
+    """Write the report atomically."""
+    tmpfn = f"{fn}.{os.getpid()}.tmp"
+    if fn.endswith(".parquet"):
+        df.to_parquet(tmpfn, index=False)
+    else:
+        df.to_csv(tmpfn, index=False)
+    os.replace(tmpfn, fn)
+
+
+def verify_tree(clidir, reportfn, incremental=False, processes=None):
+    """Check the climate files and update the report.
+
+    Args:
+      clidir (str): the climate file tree
+      reportfn (str): the report filename, `.parquet` or csv
+      incremental (bool): only check files modified since the last run
+      processes (int): the pool size, defaults to the CPU count
+
+    Returns:
+      pd.DataFrame of the violations found this run
+    """
+    statefn = f"{reportfn}.json"
+    since = None
+    if incremental and os.path.isfile(statefn):
+        with open(statefn, encoding="utf-8") as fh:
+            since = json.load(fh)["started"]
+    started = time.time()
+    fns = find_files(clidir, since)
+    rows = []
+    with Pool(processes) as pool:
+        for fn, violations in pool.imap_unordered(
+            check_file, fns, chunksize=64
+        ):
+            rows.extend((fn, *row) for row in violations)
+    df = pd.DataFrame(rows, columns=COLUMNS)
+    df["value"] = df["value"].astype(str)
+    report = df
+    if since is not None:
+        # keep the previous violations of the files not checked now
+        previous = read_report(reportfn)
+        previous = previous[~previous["filename"].isin(fns)]
+        report = pd.concat([previous, df], ignore_index=True)
+    write_report(report.sort_values(["filename", "linenum"]), reportfn)
+    with open(statefn, "w", encoding="utf-8") as fh:
+        json.dump({"started": started}, fh)
+    elapsed = max(time.time() - started, 1e-6)
+    LOG.info(
+        "checked %s files in %.1fs (%.0f files/s), %s files with %s "
+        "violations",
+        len(fns),
+        elapsed,
+        len(fns) / elapsed,
+        df["filename"].nunique(),
+        len(df.index),
+    )
+    return df
+
+
+def main(argv):
+    """Go Main Go."""
+    if os.path.isfile(argv[1]):
+        for row in check_file(argv[1])[1]:
+            print("linenum: %s date: %s %s: %s" % row)
+        return
+    scenario = int(argv[1])
+    incremental = "incremental" in argv[2:]
+    reportfn = f"/i/{scenario}/cli_verify.csv"
+    for arg in argv[2:]:
+        if arg != "incremental":
+            reportfn = arg
+    df = verify_tree(f"/i/{scenario}/cli", reportfn, incremental)
+    if not df.empty:
+        LOG.warning("\n%s", df["check"].value_counts())
+        sys.exit(1)
 
 
 if __name__ == "__main__":
     main(sys.argv)
+
+
+def test_regression_file():
+    """Test the regression climate file, which has a few flat accumulations."""
+    fn = os.path.join(
+        os.path.dirname(__file__),
+        "../../src/regression_tests/common/092.51x042.00.cli",
+    )
+    res = check_file(fn)[1]
+    assert [row[0] for row in res] == [2079, 2552, 7307, 7728]
+    assert {row[2] for row in res} == {"accum_order"}
+
+
+def test_violations(tmp_path):
+    """Test that problems are found and reported incrementally."""
+    header = "\n" * 4 + "  42.00   -92.51   289   1   2007   1\n"
+    header += "\n" * (HEADER_LINES - 5)
+    good = "1\t1\t2007\t2\t1.0\t-1.0\t200\t3.0\t0\t-2.0\n1.00 0.00\n2.00 5.0\n"
+    bad = (
+        "1\t1\t2007\t3\t1.0\t-1.0\t200\t3.0\t0\t-2.0\n1.00 0.00\n0.50 5.0\n"
+        "2.00 1.0\n3\t1\t2007\t0\t1.0\t99.0\t200\t3.0\t0\t-2.0\n"
+    )
+    checks = [row[2] for row in check_text((header + bad).encode())]
+    assert sorted(checks) == ["accum_order", "date", "time_order", "tmin"]
+    clidir = tmp_path / "cli" / "092x042"
+    clidir.mkdir(parents=True)
+    (clidir / "092.51x042.00.cli").write_text(header + bad)
+    (clidir / "092.52x042.00.cli").write_text(header + bad)
+    reportfn = str(tmp_path / "report.csv")
+    df = verify_tree(str(tmp_path / "cli"), reportfn, True, 1)
+    assert len(df.index) == 8
+    # Only the fixed file is checked, the other's violations are kept
+    os.utime(clidir / "092.51x042.00.cli", (0, 0))
+    (clidir / "092.52x042.00.cli").write_text(header + good)
+    df = verify_tree(str(tmp_path / "cli"), reportfn, True, 1)
+    assert df.empty
+    report = read_report(reportfn)
+    assert len(report.index) == 4
+    assert report["filename"].str.endswith("092.51x042.00.cli").all()